@@ -0,0 +1,96 @@
+"""Конкуренция чтения и записи: параллельные webhook-запросы с отзывами
+(чтение pair_exists, запись feedback/user_ratings/состояния) и одновременно
+поток, который читает active_match и замеряет задержку.
+
+python bench/bench_contention.py [число отзывов]
+"""
+import json
+import threading
+import time
+
+from common import main2, print_table, seed_users, sizes
+
+POSTERS = 8  # параллельных HTTP-клиентов
+
+
+def update_body(update_id, chat_id):
+    return json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': '5,4,5 отлично',
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}})
+
+
+def read_latencies(stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        main2.db.query('active_match', (1, int(time.time())))
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.001)
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+
+def main():
+    count = sizes([2000])[0]
+    seed_users(2 * count)
+    now = int(time.time())
+    pairs = [(chat_id, count + chat_id, now, now + main2.MATCH_DURATION) for chat_id in range(1, count + 1)]
+    main2.db.transaction(lambda conn: conn.executemany(main2.QUERIES['insert_match'].sql, pairs))
+    for chat_id in range(1, count + 1):
+        main2.user_state.set(chat_id, {'step': 'awaiting_feedback', 'partner_id': count + chat_id})
+
+    idle = []
+    stop = threading.Event()
+    reader = threading.Thread(target=read_latencies, args=(stop, idle))
+    reader.start()
+    time.sleep(1)
+    stop.set()
+    reader.join()
+
+    busy = []
+    stop = threading.Event()
+    reader = threading.Thread(target=read_latencies, args=(stop, busy))
+    bodies = [update_body(chat_id, chat_id) for chat_id in range(1, count + 1)]
+    url = '/' + main2.BOT_TOKEN
+    statuses = []
+
+    def post(chunk):
+        client = main2.app.test_client()
+        for body in chunk:
+            statuses.append(client.post(url, data=body, content_type='application/json').status_code)
+
+    posters = [threading.Thread(target=post, args=(bodies[i::POSTERS],)) for i in range(POSTERS)]
+    reader.start()
+    started = time.perf_counter()
+    for poster in posters:
+        poster.start()
+    for poster in posters:
+        poster.join()
+    accepted = time.perf_counter() - started
+    while main2.update_queue.snapshot()['processed'] + main2.update_queue.snapshot()['failed'] < count:
+        time.sleep(0.01)
+    processed = time.perf_counter() - started
+    stop.set()
+    reader.join()
+
+    writer = main2.db.stats()['writer']
+    saved = main2.db.execute("SELECT COUNT(*) FROM feedback", fetch=main2.FETCH_SCALAR)
+    print(f'{count} отзывов через webhook, {POSTERS} клиентов, {main2.UPDATE_WORKERS} воркеров')
+    print(f'приняты за {accepted:.2f}с, обработаны за {processed:.2f}с ({count / processed:,.0f} обновлений/с)')
+    print(f'ответы webhook: {dict((code, statuses.count(code)) for code in set(statuses))}, '
+          f'отзывов в БД: {saved}')
+    print(f"писатель: {writer['writes']} записей в {writer['batches']} коммитах "
+          f"(в среднем {writer['writes'] / max(writer['batches'], 1):.1f} на коммит), ошибок: {writer['errors']}")
+    print_table(['чтение active_match', 'замеров', 'p50, мс', 'p99, мс', 'max, мс'], [
+        ['без нагрузки', len(idle), f'{percentile(idle, 0.5):.3f}', f'{percentile(idle, 0.99):.3f}',
+         f'{max(idle) * 1000:.3f}'],
+        ['под записью', len(busy), f'{percentile(busy, 0.5):.3f}', f'{percentile(busy, 0.99):.3f}',
+         f'{max(busy) * 1000:.3f}'],
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Подготовка запроса кандидатов в зависимости от истории пар: прежний
+NOT IN с плейсхолдером на каждого исключённого против match_candidates
+с анти-join по индексам (текст запроса постоянный).
+
+Подготовка - компиляция и привязка параметров на соединении без кэша
+выражений (первый шаг EXPLAIN: запрос скомпилирован, таблицы не читаются).
+Запрос - полный подбор кандидатов: для старого пути вместе со сбором
+списка исключений.
+
+python bench/bench_exclusion.py [числа пар...]   (по умолчанию 100 1000 10000 100000 1000000)
+"""
+import sqlite3
+import time
+
+from common import main2, print_table, seed_users, sizes, wipe
+
+USERS = 10000
+HISTORY_ID = 10 ** 7  # партнёры из истории - id вне диапазона анкет
+REPEAT = 5
+
+# find_match до анти-join: исключались все, кто есть в matches, и прошлые партнёры
+NOT_IN_SQL = """SELECT
+    u.id, u.name, u.age, u.kazakh_level,
+    u.gender, u.preferred_gender, u.telegram_username,
+    COALESCE(f.avg_rating, 3.0) as rating
+FROM users u
+LEFT JOIN (
+    SELECT
+        user_id,
+        (sum_q1 + sum_q2 + sum_q3) / (3.0 * feedback_count) as avg_rating
+    FROM user_ratings
+    WHERE feedback_count > 0
+) f ON u.id = f.user_id
+WHERE u.id NOT IN ({})
+AND u.preferred_gender IN (?, 'Не важно')
+AND (? = 'Не важно' OR u.gender = ?)
+ORDER BY ABS(COALESCE(f.avg_rating, 3.0) - ?) ASC
+LIMIT 50"""
+
+
+def seed_history(count):
+    """count завершившихся пар: половина - прошлые партнёры пользователя 1, половина - чужие пары в matches"""
+    now = int(time.time())
+    past = [(1, HISTORY_ID + i, 0) for i in range(count // 2)]
+    ended = [(HISTORY_ID + i, 1, 0, now - 1) for i in range(count // 2, count)]
+
+    def write(conn):
+        conn.executemany("INSERT INTO past_matches (user1, user2, match_ts) VALUES (?, ?, ?)", past)
+        conn.executemany(main2.QUERIES['insert_match'].sql, ended)
+    main2.db.transaction(write)
+
+
+def not_in_query(user, rating):
+    exclude = {row['user1'] for row in main2.db.execute("SELECT user1 FROM matches")} | {user['id']}
+    exclude |= {row['user2'] for row in main2.db.query('past_partner_ids', (user['id'],))}
+    return NOT_IN_SQL.format(','.join('?' * len(exclude))), [
+        *exclude, user['gender'], user['preferred_gender'], user['preferred_gender'], rating]
+
+
+def best_ms(function, *args):
+    best = float('inf')
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    compile_conn = sqlite3.connect(main2.DB_PATH, cached_statements=0)
+    new_sql = main2.QUERIES['match_candidates'].sql
+    rows = []
+    for count in sizes([100, 1000, 10000, 100000, 1000000]):
+        wipe()
+        seed_users(USERS)
+        seed_history(count)
+        user = dict(main2.db.query('user_by_id', (1,)))
+        new_params = (1, int(time.time()), user['gender'], user['preferred_gender'], 3.0)
+        new_prep = best_ms(lambda: compile_conn.execute('EXPLAIN ' + new_sql, new_params))
+        new_query = best_ms(main2.find_candidates_sql, user, 3.0)
+        sql, params = not_in_query(user, 3.0)
+        try:
+            old_prep = f"{best_ms(lambda: compile_conn.execute('EXPLAIN ' + sql, params)):.3f}"
+            old_query = f"{best_ms(lambda: main2.db.execute(*not_in_query(user, 3.0))):.3f}"
+        except sqlite3.OperationalError as e:
+            old_prep = old_query = f'ошибка: {e}'
+        rows.append([f'{count:,}', len(params), old_prep, old_query, len(new_params),
+                     f'{new_prep:.3f}', f'{new_query:.3f}'])
+    compile_conn.close()
+    print(f'мс, лучшее из {REPEAT}; {USERS} анкет')
+    print_table(['пар в истории', 'NOT IN: параметров', 'подготовка', 'запрос',
+                 'анти-join: параметров', 'подготовка', 'запрос'], rows)
+
+
+if __name__ == '__main__':
+    main()
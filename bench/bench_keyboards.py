@@ -0,0 +1,51 @@
+"""Стоимость клавиатуры на один шаг: InlineKeyboardMarkup, собранный и
+сериализованный на каждую отправку (как было), против готового JSON.
+
+Замеряется то, что telebot кладёт в reply_markup (apihelper._convert_markup):
+для объекта - to_json(), для строки - сама строка.
+
+python bench/bench_keyboards.py
+"""
+from telebot import apihelper, types
+
+from common import main2, per_call, print_table
+
+import chck2  # после common: путь к корню репозитория добавляет он
+
+CALLS = 20000
+
+
+def markup(options):
+    """ask_question до кэша клавиатур"""
+    keyboard = types.InlineKeyboardMarkup()
+    for option in options:
+        keyboard.add(types.InlineKeyboardButton(option, callback_data=option))
+    return keyboard
+
+
+def topic_markup(selected):
+    """show_topic_options в chck2.py до инкрементальной сборки"""
+    keyboard = types.InlineKeyboardMarkup()
+    for topic in chck2.topic_options[:-1]:
+        label = f"✅ {topic}" if topic in selected else topic
+        keyboard.add(types.InlineKeyboardButton(text=label, callback_data=topic))
+    keyboard.add(types.InlineKeyboardButton(text="✅ Отправить", callback_data="✅Отправить"))
+    return keyboard
+
+
+def main():
+    rows = []
+    for step, options in main2.REGISTRATION_OPTIONS.items():
+        old = per_call(lambda: apihelper._convert_markup(markup(options)), CALLS) * 1e6
+        new = per_call(lambda: apihelper._convert_markup(main2.KEYBOARDS[step]), CALLS) * 1e6
+        rows.append([step, len(options), f'{old:.2f}', f'{new:.2f}', f'{old / new:.0f}x'])
+    selected = chck2.topic_options[:3]
+    old = per_call(lambda: apihelper._convert_markup(topic_markup(selected)), CALLS) * 1e6
+    new = per_call(lambda: apihelper._convert_markup(chck2.topic_keyboard(selected)), CALLS) * 1e6
+    rows.append(['темы chck2.py', len(chck2.topic_options), f'{old:.2f}', f'{new:.2f}', f'{old / new:.0f}x'])
+    print(f'мкс на клавиатуру, {CALLS} сборок')
+    print_table(['шаг', 'кнопок', 'InlineKeyboardMarkup', 'готовый JSON', 'ускорение'], rows)
+
+
+if __name__ == '__main__':
+    main()
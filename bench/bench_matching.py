@@ -0,0 +1,121 @@
+"""Подбор кандидата для find_match: индекс в памяти (MatchIndex) против SQL
+
+Для каждого размера база заполняется случайными анкетами; у части
+пользователей есть отзывы, активные и прошлые пары. Сравниваются:
+  - index: MatchIndex.find (основной путь find_match);
+  - sql: запрос match_candidates (запасной путь без индекса);
+  - sql до индекса: прежний запрос find_match с NOT IN по всем занятым
+    и GROUP BY по всей таблице feedback.
+
+python bench/bench_matching.py [размеры...]   (по умолчанию 10000 100000 1000000)
+"""
+import random
+import sqlite3
+import time
+
+from common import main2, print_table, seed_users, sizes, wipe
+
+RATED_SHARE = 0.3    # доля пользователей с отзывами
+ACTIVE_SHARE = 0.02  # доля пользователей в активной паре
+PAST_PARTNERS = 5    # прошлых партнёров у каждого, для кого ищем пару
+INDEX_LOOKUPS = 2000
+SQL_LOOKUPS = 5
+
+# find_match до индекса: исключения - плейсхолдер на каждого занятого пользователя
+BASELINE_SQL = """SELECT
+    u.id, u.name, u.age, u.kazakh_level,
+    u.gender, u.preferred_gender, u.telegram_username,
+    COALESCE(f.avg_rating, 3.0) as rating
+FROM users u
+LEFT JOIN (
+    SELECT
+        to_user,
+        (AVG(question1) + AVG(question2) + AVG(question3)) / 3.0 as avg_rating
+    FROM feedback
+    GROUP BY to_user
+) f ON u.id = f.to_user
+WHERE u.id NOT IN ({})
+AND u.preferred_gender IN (?, 'Не важно')
+AND u.gender IN (?, 'Не важно')
+ORDER BY ABS(COALESCE(f.avg_rating, 3.0) - ?) ASC
+LIMIT 50"""
+
+
+def seed_history(count, rng):
+    """Отзывы, агрегаты рейтинга и активные пары"""
+    now = int(time.time())
+    feedback, ratings = [], []
+    for user_id in rng.sample(range(1, count + 1), int(count * RATED_SHARE)):
+        scores = [rng.randint(1, 5) for _ in range(3)]
+        feedback.append((rng.randint(1, count), user_id, *scores, None, now))
+        ratings.append((user_id, *scores, now))
+    active = rng.sample(range(1, count + 1), int(count * ACTIVE_SHARE) // 2 * 2)
+    matches = []
+    for user1, user2 in zip(active[::2], active[1::2]):
+        matches += [(user1, user2, now, now + main2.MATCH_DURATION), (user2, user1, now, now + main2.MATCH_DURATION)]
+
+    def write(conn):
+        conn.executemany(main2.QUERIES['insert_feedback'].sql, feedback)
+        conn.executemany(main2.QUERIES['add_rating'].sql, ratings)
+        conn.executemany(main2.QUERIES['insert_match'].sql, matches)
+    main2.db.transaction(write)
+
+
+def pick_users(count, lookups, rng):
+    """Пользователи, для которых ищем пару: анкета, рейтинг и прошлые партнёры"""
+    users, past = [], []
+    for user_id in rng.sample(range(1, count + 1), lookups):
+        partners = {rng.randint(1, count) for _ in range(PAST_PARTNERS)} - {user_id}
+        past += [(user_id, partner, 0) for partner in partners]
+        user = dict(main2.db.query('user_by_id', (user_id,)))
+        users.append((user, main2.get_average_feedback(user_id) or 3.0, partners))
+    main2.db.transaction(lambda conn: conn.executemany(
+        "INSERT OR IGNORE INTO past_matches (user1, user2, match_ts) VALUES (?, ?, ?)", past))
+    return users
+
+
+def baseline_lookup(user, rating, past_partners):
+    exclude = {row['user1'] for row in main2.db.execute("SELECT user1 FROM matches")} | {user['id']}
+    exclude |= past_partners
+    return main2.db.execute(BASELINE_SQL.format(','.join('?' * len(exclude))),
+                            [*exclude, user['gender'], user['preferred_gender'], rating])
+
+
+def timed_lookups(lookup, users):
+    started = time.perf_counter()
+    for user, rating, past_partners in users:
+        lookup(user, rating, past_partners)
+    return (time.perf_counter() - started) / len(users) * 1000
+
+
+def main():
+    rows = []
+    for count in sizes([10000, 100000, 1000000]):
+        rng = random.Random(count)
+        wipe()
+        seed_users(count)
+        seed_history(count, rng)
+        users = pick_users(count, INDEX_LOOKUPS, rng)
+
+        index = main2.MatchIndex()
+        started = time.perf_counter()
+        index.load(main2.db)
+        load_s = time.perf_counter() - started
+
+        index_ms = timed_lookups(lambda user, rating, past: index.find(user, rating, exclude=past), users)
+        sql_ms = timed_lookups(lambda user, rating, past: main2.find_candidates_sql(user, rating),
+                               users[:SQL_LOOKUPS])
+        try:
+            baseline_ms = f'{timed_lookups(baseline_lookup, users[:SQL_LOOKUPS]):.3f}'
+        except sqlite3.OperationalError as e:
+            baseline_ms = f'ошибка: {e}'
+        rows.append([f'{count:,}', f'{load_s:.2f}', f'{index_ms:.4f}', f'{sql_ms:.3f}', baseline_ms,
+                     f'{sql_ms / index_ms:,.0f}x'])
+        del index
+    print(f'мс на подбор кандидата; индекс - {INDEX_LOOKUPS} поисков, SQL - {SQL_LOOKUPS}')
+    print_table(['пользователей', 'загрузка индекса, с', 'index, мс', 'sql, мс', 'sql до индекса, мс',
+                 'index быстрее sql'], rows)
+
+
+if __name__ == '__main__':
+    main()
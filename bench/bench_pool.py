@@ -0,0 +1,65 @@
+"""Запросов в секунду: соединение на каждый запрос под общей блокировкой
+(как Database.execute до пула) против постоянных соединений ConnectionPool.
+
+python bench/bench_pool.py [число пользователей]
+"""
+import random
+import sqlite3
+import threading
+import time
+
+from common import main2, print_table, seed_users, sizes
+
+THREADS = (1, 4, 8)  # как threads у waitress
+QUERIES_PER_THREAD = 2000
+
+
+class ConnectPerQuery:
+    """Прежний Database.execute: новое соединение на запрос, всё под self.lock"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+
+    def query(self, name, params=()):
+        with self.lock:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.row_factory = sqlite3.Row
+                return conn.execute(main2.QUERIES[name].sql, params).fetchone()
+
+
+def queries_per_second(database, threads, users):
+    barrier = threading.Barrier(threads + 1)
+
+    def run(seed):
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(QUERIES_PER_THREAD):
+            database.query('user_by_id', (rng.randint(1, users),))
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return threads * QUERIES_PER_THREAD / (time.perf_counter() - started)
+
+
+def main():
+    users = sizes([10000])[0]
+    seed_users(users)
+    before = ConnectPerQuery(main2.DB_PATH)
+    rows = []
+    for threads in THREADS:
+        old = queries_per_second(before, threads, users)
+        new = queries_per_second(main2.db, threads, users)
+        rows.append([threads, f'{old:,.0f}', f'{new:,.0f}', f'{new / old:.1f}x'])
+    print(f'user_by_id, {users} пользователей, {QUERIES_PER_THREAD} запросов на поток')
+    print_table(['потоков', 'соединение/запрос', 'пул', 'ускорение'], rows)
+    print(f"соединений в пуле: {main2.db.pool.size()}")
+
+
+if __name__ == '__main__':
+    main()
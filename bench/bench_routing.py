@@ -0,0 +1,63 @@
+"""Выбор обработчика сообщения: цепочка фильтров telebot (как было до таблиц
+маршрутизации) против route_message. Обработчики заменены пустыми, так что
+замеряется только выбор. К реальным командам добавляется N лишних - стоимость
+маршрутизации не должна расти вместе с числом команд. Для обычного текста
+route_message читает шаг диалога из хранилища состояния (user_data, user_state),
+а старая цепочка - из словаря процесса.
+
+python bench/bench_routing.py [N...]   (по умолчанию 0 50 500)
+"""
+from telebot import TeleBot, types
+
+from common import main2, per_call, print_table, sizes
+
+CALLS = 5000
+
+
+def noop(*args):
+    pass
+
+
+def message(text, chat_id=42):
+    return types.Message.de_json({
+        'message_id': 1, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench', 'username': 'bench'}})
+
+
+def filter_chain_bot(extra):
+    """Обработчики в том виде, в каком их регистрировал main2 до таблиц маршрутизации"""
+    bot = TeleBot(main2.BOT_TOKEN, threaded=False)
+    user_state = {}
+    for command in ('start', 'restart', 'guidebook', 'echo', 'test'):
+        bot.register_message_handler(noop, commands=[command])
+    for i in range(extra):
+        bot.register_message_handler(noop, commands=[f'extra{i}'])
+    bot.register_message_handler(
+        noop, func=lambda m: user_state.get(m.chat.id, {}).get('step') == 'awaiting_feedback')
+    bot.register_message_handler(noop, func=lambda message: not message.text.strip().startswith('/'))
+    return bot
+
+
+def main():
+    for table in (main2.COMMANDS, main2.STEP_HANDLERS):
+        for name in table:
+            table[name] = noop
+    main2.handle_all_messages = noop
+    samples = {'/start': message('/start'), 'текст': message('Сәлем!')}
+    rows = []
+    for extra in sizes([0, 50, 500]):
+        bot = filter_chain_bot(extra)
+        main2.COMMANDS.update({f'extra{i}': noop for i in range(extra)})
+        samples['последняя команда'] = message(f'/extra{extra - 1}' if extra else '/test')
+        for label, sample in samples.items():
+            old = per_call(bot.process_new_messages, CALLS, [sample]) * 1e6
+            new = per_call(main2.route_message, CALLS, sample) * 1e6
+            rows.append([len(main2.COMMANDS), label, f'{old:.1f}', f'{new:.1f}', f'{old / new:.1f}x'])
+        for i in range(extra):
+            del main2.COMMANDS[f'extra{i}']
+    print(f'мкс на выбор обработчика, {CALLS} сообщений')
+    print_table(['команд', 'сообщение', 'фильтры telebot', 'route_message', 'ускорение'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Разбор тела webhook-запроса: прежний путь (decode, срез в лог,
+Update.de_json всего дерева, f-строка с объектом в лог) против parse_update.
+
+Корпус - JSON-строки обновлений, по одному на строку. Без аргумента
+используется синтетический корпус той же формы, что шлёт Bot API: команды,
+ответы на ForceReply (с reply_to_message), нажатия кнопок (с исходным
+сообщением и клавиатурой) и типы, на которые бот не подписан.
+
+python bench/bench_webhook.py [updates.jsonl]
+"""
+import json
+import logging
+import random
+import sys
+import time
+
+from telebot import types
+
+from common import main2, print_table
+
+ROUNDS = 5
+
+# Прежний webhook логировал на уровне INFO; обработчик пустой, чтобы мерить разбор, а не вывод
+old_log = logging.getLogger('bench.webhook')
+old_log.setLevel(logging.INFO)
+old_log.propagate = False
+old_log.addHandler(logging.NullHandler())
+
+
+def old_parse(body):
+    json_data = body.decode('utf-8')
+    old_log.info(f"Webhook data: {json_data[:200]}...")
+    update = types.Update.de_json(json_data)
+    old_log.info(f"Update object created: {update}")
+    return update
+
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Пользователь {user_id}',
+            'last_name': 'Тестов', 'username': f'user{user_id}', 'language_code': 'ru'}
+
+
+def message(rng, chat_id, text, **extra):
+    entry = {'message_id': rng.randint(1, 10 ** 6), 'date': int(time.time()), 'text': text,
+             'from': user(chat_id),
+             'chat': {'id': chat_id, 'first_name': f'Пользователь {chat_id}', 'username': f'user{chat_id}',
+                      'type': 'private'}}
+    if text.startswith('/'):
+        entry['entities'] = [{'offset': 0, 'length': len(text.split()[0]), 'type': 'bot_command'}]
+    entry.update(extra)
+    return entry
+
+
+def bot_message(rng, chat_id, text, keyboard=None):
+    entry = message(rng, chat_id, text)
+    entry['from'] = {'id': 7000000000, 'is_bot': True, 'first_name': 'QazaqTalk', 'username': 'QazaqTalkBot'}
+    if keyboard is not None:
+        entry['reply_markup'] = json.loads(keyboard)
+    return entry
+
+
+def synthetic_corpus(size=1000, seed=1):
+    rng = random.Random(seed)
+    corpus = []
+    for update_id in range(1, size + 1):
+        chat_id = rng.randint(10 ** 8, 10 ** 9)
+        kind = rng.random()
+        if kind < 0.4:
+            update = {'message': message(rng, chat_id, rng.choice(['/start', '/restart', '/guidebook', 'Айгерим']))}
+        elif kind < 0.6:
+            prompt = bot_message(rng, chat_id, '📝 Время оставить отзыв о вашей практике ' * 4)
+            update = {'message': message(rng, chat_id, '5,4,5 Отличная практика!', reply_to_message=prompt)}
+        elif kind < 0.9:
+            step = rng.choice(list(main2.KEYBOARDS))
+            update = {'callback_query': {
+                'id': str(rng.randint(10 ** 17, 10 ** 18)), 'from': user(chat_id), 'chat_instance': '-42',
+                'message': bot_message(rng, chat_id, 'Сколько вам лет?', main2.KEYBOARDS[step]),
+                'data': f'{step}:{rng.choice(main2.REGISTRATION_OPTIONS[step])}'}}
+        elif kind < 0.95:
+            update = {'edited_message': message(rng, chat_id, 'исправленный текст', edit_date=int(time.time()))}
+        else:
+            update = {'my_chat_member': {
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': user(chat_id), 'date': int(time.time()),
+                'old_chat_member': {'user': user(7000000000), 'status': 'member'},
+                'new_chat_member': {'user': user(7000000000), 'status': 'kicked', 'until_date': 0}}}
+        update['update_id'] = update_id
+        corpus.append(json.dumps(update, ensure_ascii=False).encode())
+    return corpus
+
+
+def load_corpus(path):
+    with open(path, 'rb') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def best_time(parse, corpus):
+    best = float('inf')
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for body in corpus:
+            parse(body)
+        best = min(best, time.perf_counter() - started)
+    return best / len(corpus) * 1e6
+
+
+def main():
+    corpus = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else synthetic_corpus()
+    old = best_time(old_parse, corpus)
+    new = best_time(main2.parse_update, corpus)
+    skipped = sum(main2.parse_update(body) is None for body in corpus)
+    print(f'{len(corpus)} обновлений, {sum(map(len, corpus)) / len(corpus):.0f} байт в среднем, '
+          f'пропущено по типу: {skipped}')
+    print_table(['путь', 'мкс на обновление'], [
+        ['decode + de_json + лог объекта', f'{old:.1f}'],
+        ['parse_update', f'{new:.1f}'],
+        ['ускорение', f'{old / new:.1f}x'],
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Общая подготовка бенчмарков
+
+main2 импортируется с фиктивным токеном и временной БД (как в tests/conftest.py),
+вызовы Bot API никуда не отправляются. Запуск: python bench/<скрипт>.py
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ['BOT_TOKEN'] = '123456:bench-token'
+os.environ['LOG_LEVEL'] = os.getenv('BENCH_LOG_LEVEL', 'WARNING')
+os.environ['OUTBOX_GLOBAL_RATE'] = os.environ['OUTBOX_CHAT_RATE'] = '1000000'
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='qazaqtalk-bench-'), 'bench.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main2
+
+BOT_METHODS = ('send_message', 'send_document', 'send_chat_action', 'answer_callback_query')
+for method in BOT_METHODS:
+    setattr(main2.bot, method, lambda *args, **kwargs: None)
+
+TABLES = ('users', 'matches', 'past_matches', 'feedback', 'user_ratings', 'review_queue',
+          'conversation_state', 'media_cache')
+
+
+def sizes(default):
+    """Размеры из аргументов командной строки или значения по умолчанию"""
+    return [int(arg.replace('_', '')) for arg in sys.argv[1:]] or default
+
+
+def wipe():
+    def delete(conn):
+        for table in TABLES:
+            conn.execute(f'DELETE FROM {table}')
+    main2.db.transaction(delete)
+
+
+def random_profile(rng, user_id):
+    return (user_id, f'user{user_id}', rng.choice(main2.AGE_OPTIONS), rng.choice(main2.LEVELS),
+            rng.choice(main2.GENDERS), rng.choice(main2.GENDERS + [main2.ANY_GENDER]), f'user{user_id}')
+
+
+def seed_users(count, seed=1, chunk=50000):
+    """Заполняет users случайными анкетами с id 1..count"""
+    rng = random.Random(seed)
+    for first in range(1, count + 1, chunk):
+        rows = [random_profile(rng, user_id) for user_id in range(first, min(first + chunk, count + 1))]
+        main2.db.transaction(lambda conn: conn.executemany(
+            main2.QUERIES['upsert_user'].sql, rows))
+
+
+def per_call(function, calls, *args):
+    """Среднее время одного вызова function(*args) в секундах"""
+    started = time.perf_counter()
+    for _ in range(calls):
+        function(*args)
+    return (time.perf_counter() - started) / calls
+
+
+def print_table(header, rows):
+    widths = [max(len(str(cell)) for cell in column) for column in zip(header, *rows)]
+    for row in [header, ['-' * width for width in widths], *rows]:
+        print('  '.join(str(cell).rjust(width) for cell, width in zip(row, widths)))
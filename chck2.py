@@ -1,33 +1,253 @@
 import telebot
 import sqlite3
+import json
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import difflib
+import functools
+import heapq
+import threading
 
 bot = telebot.TeleBot("7671940309:AAECI8c7p3loeQ8aFzZ0dEuyXw_OYwp3mR8")
 user_data = {}
 
 topic_options = ["Путешествия", "Спорт", "Музыка", "Казахская культура и традиции", "История", "Политика", "Образование", "Фильмы и сериалы", "Бизнес и экономика", "Еда и кулинария", "Повседневная жизнь", "Другое", "✅Отправить"]
 
-def has_common_language(lang1, lang2):
-    set1 = set(map(str.strip, lang1.lower().split(',')))
-    set2 = set(map(str.strip, lang2.lower().split(',')))
-    return not set1.isdisjoint(set2)
+# Ряды клавиатуры тем сериализуются один раз: (не выбрана, выбрана) для каждой темы
+def _button_row(text, data):
+    return json.dumps([{'text': text, 'callback_data': data}], ensure_ascii=False)
+
+topic_rows = {topic: (_button_row(topic, topic), _button_row(f"✅ {topic}", topic)) for topic in topic_options[:-1]}
+submit_row = _button_row("✅ Отправить", "✅Отправить")
+
+def topic_keyboard(selected):
+    """JSON клавиатуры тем: склеивает готовые ряды, отмечая выбранные"""
+    rows = [topic_rows[topic][topic in selected] for topic in topic_options[:-1]]
+    rows.append(submit_row)
+    return '{"inline_keyboard":[' + ','.join(rows) + ']}'
+
+# --- Нормализация строк ---
+SIMILARITY_CACHE_SIZE = 65536
+ALIAS_THRESHOLD = 0.85  # выше этого значение считается написанием уже известного
+
+# Известные варианты, которые difflib не свяжет (другой алфавит, сокращения)
+SEED_ALIASES = {
+    'country': {'kazakhstan': 'казахстан', 'kz': 'казахстан', 'рк': 'казахстан', 'russia': 'россия', 'рф': 'россия'},
+    'native_language': {'russian': 'русский', 'kazakh': 'казахский', 'english': 'английский'},
+    'other_languages': {'russian': 'русский', 'kazakh': 'казахский', 'english': 'английский'},
+}
+
+@functools.lru_cache(maxsize=SIMILARITY_CACHE_SIZE)
+def _similarity(str1, str2):
+    return difflib.SequenceMatcher(None, str1, str2).ratio()
+
+def similarity(str1, str2):
+    """Сходство строк без учёта регистра; пара упорядочена, чтобы (a, b) и (b, a) делили запись кэша"""
+    a, b = str1.lower(), str2.lower()
+    if a > b:
+        a, b = b, a
+    return _similarity(a, b)
 
 def fuzzy_match(str1, str2, threshold=0.7):
-    return difflib.SequenceMatcher(None, str1.lower(), str2.lower()).ratio() >= threshold
-
-@bot.message_handler(commands=['start'])
-def start(message):
+    return similarity(str1, str2) >= threshold
+
+# --- Профили для подбора ---
+# Текстовые поля кодируются один раз при регистрации: значение получает номер,
+# а для нечётких полей ещё и маску номеров похожих значений. Подбор потом
+# сводится к битовым операциям над колонками, без difflib на каждого кандидата.
+
+class Vocabulary:
+    """Словарь значений поля: номер значения и маска похожих на него.
+    Варианты написания сводятся к каноническому значению через таблицу алиасов."""
+    def __init__(self, name, fuzzy=False):
+        self.name = name
+        self.fuzzy = fuzzy
+        self.codes = {}
+        self.values = []
+        self.similar = []
+        self.aliases = dict(SEED_ALIASES.get(name, {}))
+        self.learned = []
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def canonical(self, value):
+        key = value.strip().lower()
+        if key in self.codes:
+            self.hits += 1
+            return key
+        canonical = self.aliases.get(key)
+        if canonical is not None:
+            self.hits += 1
+            return canonical
+        self.misses += 1
+        if self.fuzzy and self.values:
+            best = max(self.values, key=lambda text: similarity(key, text))
+            if similarity(key, best) >= ALIAS_THRESHOLD:
+                self.aliases[key] = best
+                self.learned.append((key, best))
+                return best
+        return key
+
+    def code(self, value):
+        with self._lock:
+            key = self.canonical(value)
+            code = self.codes.get(key)
+            if code is None:
+                code = len(self.values)
+                mask = 1 << code
+                if self.fuzzy:
+                    # Сравниваем новое значение со всеми известными только один раз
+                    for other, text in enumerate(self.values):
+                        if fuzzy_match(key, text):
+                            mask |= 1 << other
+                            self.similar[other] |= 1 << code
+                self.codes[key] = code
+                self.values.append(key)
+                self.similar.append(mask)
+            return code
+
+    def bits(self, values):
+        """Маска для списка через запятую"""
+        mask = 0
+        for value in values.split(','):
+            mask |= 1 << self.code(value)
+        return mask
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'values': len(self.values), 'aliases': len(self.aliases), 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class ProfileIndex:
+    """Колонки закодированных профилей: одна позиция на пользователя.
+    Обработчики telebot идут в нескольких потоках, поэтому колонки меняются и читаются под блокировкой."""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.countries = Vocabulary('country', fuzzy=True)
+        self.native_languages = Vocabulary('native_language', fuzzy=True)
+        self.levels = Vocabulary('kazakh_level', fuzzy=True)
+        self.reasons = Vocabulary('learning_reason', fuzzy=True)
+        self.languages = Vocabulary('other_languages')
+        self.topic_codes = Vocabulary('topics')
+        self.vocabularies = {vocab.name: vocab for vocab in (self.countries, self.native_languages, self.levels,
+                                                             self.reasons, self.languages, self.topic_codes)}
+        self.other_reason = self.reasons.code("Другое")
+        self.positions = {}
+        self.ids = []
+        self.country = []
+        self.native = []
+        self.level = []
+        self.langs = []
+        self.reason = []
+        self.topics = []
+        self.topic_count = []
+
+    def add(self, user_id, country, native_language, kazakh_level, other_languages, learning_reason, topics):
+        with self._lock:
+            topics = self.topic_codes.bits(topics or '')
+            values = (user_id, self.countries.code(country or ''), self.native_languages.code(native_language or ''),
+                      self.levels.code(kazakh_level or ''), self.languages.bits(other_languages or ''),
+                      self.reasons.code(learning_reason or ''), topics, topics.bit_count())
+            columns = (self.ids, self.country, self.native, self.level, self.langs, self.reason, self.topics, self.topic_count)
+            pos = self.positions.get(user_id)
+            if pos is None:
+                self.positions[user_id] = len(self.ids)
+                for column, value in zip(columns, values):
+                    column.append(value)
+            else:
+                for column, value in zip(columns, values):
+                    column[pos] = value
+
+    def load(self, conn):
+        with self._lock:
+            # Сначала алиасы, чтобы варианты написания сразу получили канонические номера
+            for field, alias, canonical in conn.execute("SELECT field, alias, canonical FROM aliases"):
+                if field in self.vocabularies:
+                    self.vocabularies[field].aliases[alias] = canonical
+            for row in conn.execute("SELECT id, country, native_language, kazakh_level, other_languages, learning_reason, topics FROM users"):
+                self.add(*row)
+
+    def top_matches(self, user_id, k=1):
+        """Лучшие k кандидатов (score, id) с учётом порога совместимости"""
+        with self._lock:
+            return self._top_matches(user_id, k)
+
+    def _top_matches(self, user_id, k):
+        me = self.positions[user_id]
+        country = self.countries.similar[self.country[me]]
+        native = self.native_languages.similar[self.native[me]]
+        level = self.levels.similar[self.level[me]]
+        langs = self.langs[me]
+        my_reason = self.reason[me]
+        reason = self.reasons.similar[my_reason]
+        other = self.other_reason
+        topics = self.topics[me]
+        topic_count = self.topic_count[me]
+
+        def scored():
+            for uid, c, n, l, lg, r, t, tc in zip(self.ids, self.country, self.native, self.level,
+                                                  self.langs, self.reason, self.topics, self.topic_count):
+                if uid == user_id:
+                    continue
+                score = (country >> c & 1) + (native >> n & 1) + (level >> l & 1) + (lg & langs != 0)
+                # проверка на причину изучения
+                if my_reason == other or r == other:
+                    required = 2  # понижаем порог
+                else:
+                    required = 3
+                    score += reason >> r & 1
+                # проверка на совпадение тем
+                shared = (t & topics).bit_count()
+                if topic_count <= 2 or tc <= 2:
+                    score += shared > 0
+                else:
+                    score += shared / max(topic_count, tc) >= 0.5
+                if score >= required:
+                    yield score, uid
+
+        return heapq.nlargest(k, scored(), key=lambda item: item[0])
+
+    def save_aliases(self, conn):
+        """Сохраняет алиасы, выученные с последнего вызова"""
+        with self._lock:
+            rows = [(vocab.name, alias, canonical) for vocab in self.vocabularies.values() for alias, canonical in vocab.learned]
+            for vocab in self.vocabularies.values():
+                vocab.learned.clear()
+        conn.executemany("INSERT OR REPLACE INTO aliases (field, alias, canonical) VALUES (?, ?, ?)", rows)
+
+
+profiles = ProfileIndex()
+
+def cache_stats():
+    """Попадания в кэш сходства и в словари полей"""
+    info = _similarity.cache_info()
+    lookups = info.hits + info.misses
+    stats = {'similarity': {'size': info.currsize, 'hits': info.hits, 'misses': info.misses,
+                            'hit_rate': info.hits / lookups if lookups else 0.0}}
+    for name, vocab in profiles.vocabularies.items():
+        stats[name] = vocab.stats()
+    return stats
+
+def init_db():
     conn = sqlite3.connect('chck.db')
     cur = conn.cursor()
 
     # Создаём таблицу с нужными колонками
     cur.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY,name TEXT,password TEXT,age TEXT,country TEXT,native_language TEXT,kazakh_level TEXT,other_languages TEXT,learning_reason TEXT,topics TEXT,conversation_partner TEXT,opposite_gender TEXT,telegram_username TEXT,likes TEXT)''')
 
+    cur.execute('''CREATE TABLE IF NOT EXISTS aliases (field TEXT, alias TEXT, canonical TEXT, PRIMARY KEY (field, alias))''')
+
     conn.commit()
+    try:
+        profiles.load(conn)
+    except sqlite3.OperationalError as e:
+        print(f"Профили не загружены: {e}")
     cur.close()
     conn.close()
 
+@bot.message_handler(commands=['start'])
+def start(message):
     username = message.from_user.username if message.from_user.username else None
     if username:
         user_data[message.chat.id] = {'telegram_username': username}
@@ -76,28 +296,14 @@ def save_learning_reason(chat_id, reason):
     user_data[chat_id]['topics'] = []
 
     # Отправляем сообщение и сохраняем ID
-    selected = user_data[chat_id]['topics']
-    markup = InlineKeyboardMarkup()
-    for topic in topic_options[:-1]:
-        label = topic
-        markup.add(InlineKeyboardButton(text=label, callback_data=topic))
-    markup.add(InlineKeyboardButton(text="✅ Отправить", callback_data="✅Отправить"))
-
-    msg = bot.send_message(chat_id, "Выберите темы для разговора (3-5):", reply_markup=markup)
+    msg = bot.send_message(chat_id, "Выберите темы для разговора (3-5):", reply_markup=topic_keyboard(()))
     user_data[chat_id]['topic_msg_id'] = msg.message_id
 
 def show_topic_options(chat_id):
     selected = user_data[chat_id].get('topics', [])
-    markup = InlineKeyboardMarkup()
-
-    for topic in topic_options[:-1]:
-        label = f"✅ {topic}" if topic in selected else topic
-        markup.add(InlineKeyboardButton(text=label, callback_data=topic))
-
-    markup.add(InlineKeyboardButton(text="✅ Отправить", callback_data="✅Отправить"))
 
     # Редактируем клавиатуру вместо отправки нового сообщения
-    bot.edit_message_reply_markup(chat_id=chat_id, message_id=user_data[chat_id]['topic_msg_id'], reply_markup=markup)
+    bot.edit_message_reply_markup(chat_id=chat_id, message_id=user_data[chat_id]['topic_msg_id'], reply_markup=topic_keyboard(selected))
 
 def ask_question(chat_id, question, options):
     markup = InlineKeyboardMarkup()
@@ -148,68 +354,37 @@ def handle_callback(call):
             show_topic_options(chat_id)  # обновим кнопки
 
 def save_to_db(chat_id):
+    row = (chat_id, user_data[chat_id]['name'], user_data[chat_id]['password'], user_data[chat_id]['age'],user_data[chat_id]['country'], user_data[chat_id]['native_language'], user_data[chat_id]['kazakh_level'],user_data[chat_id]['other_languages'], user_data[chat_id]['learning_reason'], ','.join(user_data[chat_id]['topics']),'', '', user_data[chat_id]['telegram_username'], '')
     conn = sqlite3.connect('chck.db')
     cur = conn.cursor()
-    cur.execute("""REPLACE INTO users (id, name, password, age, country, native_language, kazakh_level, other_languages, learning_reason, topics, conversation_partner, opposite_gender, telegram_username, likes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '')""", (chat_id, user_data[chat_id]['name'], user_data[chat_id]['password'], user_data[chat_id]['age'],user_data[chat_id]['country'], user_data[chat_id]['native_language'], user_data[chat_id]['kazakh_level'],user_data[chat_id]['other_languages'], user_data[chat_id]['learning_reason'], ','.join(user_data[chat_id]['topics']),'', '', user_data[chat_id]['telegram_username']))
+    cur.execute("""REPLACE INTO users (id, name, password, age, country, native_language, kazakh_level, other_languages, learning_reason, topics, conversation_partner, opposite_gender, telegram_username, likes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", row)
+    profiles.add(chat_id, *row[4:10])
+    profiles.save_aliases(conn)
     conn.commit()
     cur.close()
     conn.close()
     find_match(chat_id)
 
 def find_match(chat_id):
+    best = profiles.top_matches(chat_id)
+    if not best:
+        bot.send_message(chat_id, "Пока нет совпадений, попробуйте позже.")
+        return
+
     conn = sqlite3.connect('chck.db')
     cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id != ?", (chat_id,))
-    users = cur.fetchall()
+    cur.execute("SELECT * FROM users WHERE id = ?", (best[0][1],))
+    user = cur.fetchone()
     cur.close()
     conn.close()
 
     current_user = user_data[chat_id]
-    for user in users:
-        match_score = 0
-        required_score = 3  # порог совместимости
-
-        if fuzzy_match(current_user['country'], user[4]):
-            match_score += 1
-
-        if fuzzy_match(current_user['native_language'], user[5]):
-            match_score += 1
-
-        if fuzzy_match(current_user['kazakh_level'], user[6]):
-            match_score += 1
-
-        if has_common_language(current_user['other_languages'], user[7]):
-            match_score += 1
-
-        # проверка на причину изучения
-        if current_user['learning_reason'] == "Другое" or user[8] == "Другое":
-            required_score -= 1  # понижаем порог
-        else:
-            if fuzzy_match(current_user['learning_reason'], user[8]):
-                match_score += 1
-
-        # проверка на совпадение тем
-        user_topics = set(map(str.strip, user[9].lower().split(',')))
-        current_topics = set(map(str.strip, current_user['topics']))
-
-        shared = user_topics.intersection(current_topics)
-
-        if len(current_topics) <= 2 or len(user_topics) <= 2:
-            if shared:
-                match_score += 1
-        else:
-            total = max(len(current_topics), len(user_topics))
-            if len(shared) / total >= 0.5:
-                match_score += 1
-
-        if match_score >= required_score:
-            match_message = (f"Вы совпали с @{user[12]}!\n"
-                             f"Имя: {user[1]}\nВозраст: {user[3]}\nСтрана: {user[4]}\n"
-                             f"Родной язык: {user[5]}\nУровень казахского: {user[6]}\n")
-            bot.send_message(chat_id, match_message)
-            bot.send_message(user[0], match_message.replace(f"@{user[12]}", f"@{current_user['telegram_username']}"))
-            return
-
-    bot.send_message(chat_id, "Пока нет совпадений, попробуйте позже.")
-
-bot.polling(none_stop=True)
+    match_message = (f"Вы совпали с @{user[12]}!\n"
+                     f"Имя: {user[1]}\nВозраст: {user[3]}\nСтрана: {user[4]}\n"
+                     f"Родной язык: {user[5]}\nУровень казахского: {user[6]}\n")
+    bot.send_message(chat_id, match_message)
+    bot.send_message(user[0], match_message.replace(f"@{user[12]}", f"@{current_user['telegram_username']}"))
+
+if __name__ == '__main__':
+    init_db()
+    bot.polling(none_stop=True)
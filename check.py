@@ -3,6 +3,7 @@ import threading
 import sqlite3
 import difflib
 import telebot
+from functools import lru_cache
 import traceback
 from datetime import datetime, timezone, timedelta
 from datetime import timezone
@@ -259,17 +260,23 @@ def init_review_queue():
     cur.close()
     conn.close()
 
+# Возраст и уровень выбираются из фиксированных списков, поэтому различных
+# пар значений немного: результаты сравнений кэшируются и не пересчитываются
+# для каждого кандидата.
+@lru_cache(maxsize=None)
 def age_range_to_tuple(age_str):
     if '+' in age_str:
         return (int(age_str.replace('+', '')), 99)
     start, end = map(int, age_str.split('-'))
     return (start, end)
 
+@lru_cache(maxsize=None)
 def age_overlap(age1, age2):
     r1 = age_range_to_tuple(age1)
     r2 = age_range_to_tuple(age2)
     return max(r1[0], r2[0]) <= min(r1[1], r2[1])
 
+@lru_cache(maxsize=None)
 def level_match(level1, level2):
     return level1 == level2 or (level1 in level2 or level2 in level1)
 
@@ -479,22 +486,15 @@ def find_match(chat_id):
                 cur.close()
                 conn.close()
                 return
-            else:
-                # Удаляем устаревшую пару
-                cur.execute("DELETE FROM matches WHERE chat_id = ?", (chat_id,))
-                conn.commit()
-
-        # ✅ Получаем список пользователей, которые уже в паре (актуальной)
-        cur.execute("SELECT user1, user2, match_time FROM matches")
-        busy_users = {row[0]: row[1] for row in cur.fetchall()}
 
+        # ✅ Устаревшие пары удаляем одним запросом (match_time - ISO-строка в UTC, сравнивается как текст)
         now = datetime.now(timezone.utc)
+        cur.execute("DELETE FROM matches WHERE match_time <= ?", ((now - timedelta(hours=48)).isoformat(),))
+        conn.commit()
 
-        to_remove = [uid for uid, m_time in busy_users.items()
-                    if datetime.fromisoformat(m_time) + timedelta(hours=48) <= now]
-        for uid in to_remove:
-            cur.execute("DELETE FROM matches WHERE chat_id = ?", (uid,))
-            busy_users.pop(uid)
+        # ✅ Получаем список пользователей, которые уже в паре (актуальной)
+        cur.execute("SELECT user1, user2 FROM matches")
+        busy_users = {user for row in cur.fetchall() for user in row}
 
         # ✅ Получаем всех доступных пользователей, исключая текущего и тех, кто уже в паре
         placeholders = ','.join(['?'] * len(busy_users)) if busy_users else '0'
@@ -503,7 +503,7 @@ def find_match(chat_id):
             FROM users
             WHERE id != ? AND id NOT IN ({placeholders})
         """
-        args = [chat_id] + list(busy_users.keys()) if busy_users else [chat_id]
+        args = [chat_id] + list(busy_users) if busy_users else [chat_id]
         cur.execute(query, args)
         users = cur.fetchall()
 
@@ -540,8 +540,8 @@ def find_match(chat_id):
                 bot.send_message(other_id, f"🎉 Вы совпали с @{current['telegram_username']}!\n👤 Имя: {current['name']}\n📅 Возраст: {current['age']}\n⚧ Пол: {current['gender']}\n🗣 Уровень казахского: {current['kazakh_level']}")
 
                 match_time = datetime.now(timezone.utc).isoformat()
-                cur.execute("REPLACE INTO matches (chat_id, partner_id, match_time) VALUES (?, ?, ?)", (chat_id, other_id, match_time))
-                cur.execute("REPLACE INTO matches (chat_id, partner_id, match_time) VALUES (?, ?, ?)", (other_id, chat_id, match_time))
+                cur.execute("INSERT INTO matches (user1, user2, match_time) VALUES (?, ?, ?)", (chat_id, other_id, match_time))
+                cur.execute("INSERT INTO matches (user1, user2, match_time) VALUES (?, ?, ?)", (other_id, chat_id, match_time))
                 cur.execute("INSERT INTO past_matches (user1, user2, match_time) VALUES (?, ?, ?)", (chat_id, other_id, match_time))
                 cur.execute("INSERT INTO past_matches (user1, user2, match_time) VALUES (?, ?, ?)", (other_id, chat_id, match_time))
                 conn.commit()
@@ -1,11 +1,27 @@
 import os
+import io
+import sys
+import json
+import atexit
+import signal
 import traceback
 import time
 import threading
 import sqlite3
 import logging
-from datetime import datetime, timezone, timedelta
-from telebot import TeleBot, types
+import random
+import queue
+import bisect
+import heapq
+import hashlib
+import itertools
+from collections import namedtuple, OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import Future
+from datetime import datetime, timezone
+import requests
+from telebot import TeleBot, types, apihelper
+from telebot.apihelper import ApiTelegramException
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 
@@ -17,28 +33,319 @@ DB_PATH = os.getenv('DATABASE_PATH', '/data/database.db')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 8080))
+MATCH_DURATION = 48 * 60 * 60  # длительность пары, секунд
+
+# --- Логирование ---
+# Записи только кладутся в очередь, а форматирует и пишет их отдельный
+# поток (QueueListener), поэтому вывод логов не задерживает обработку.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json | text
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')      # уровни категорий, например "handlers=WARNING,webhook=DEBUG"
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '')      # доля записей ниже WARNING, например "handlers=0.1"
+
+def parse_log_settings(value):
+    """ "a=1,b=2" -> {'a': '1', 'b': '2'}"""
+    return {key.strip(): setting.strip() for key, _, setting in
+            (item.partition('=') for item in value.split(',') if '=' in item)}
+
+log_context = threading.local()  # chat_id/update_id обновления, которое обрабатывает поток
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи chat_id/update_id и прореживает категории по LOG_SAMPLE"""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            rate = self.sample_rates.get(record.name.rsplit('.', 1)[-1])
+            if rate is not None and random.random() >= rate:
+                return False
+        record.chat_id = getattr(log_context, 'chat_id', None)
+        record.update_id = getattr(log_context, 'update_id', None)
+        return True
+
+class RedactingFormatter(logging.Formatter):
+    """JSON или текст; секреты (токен бота) вырезаются из итоговой строки"""
+
+    def __init__(self, kind, secrets):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.kind = kind
+        self.secrets = [secret for secret in secrets if secret]
+
+    def redact(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, '<redacted>')
+        return text
+
+    def format(self, record):
+        if self.kind != 'json':
+            return self.redact(super().format(record))
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage()}
+        for field in ('chat_id', 'update_id'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        # Трассировку QueueHandler.prepare уже дописал в текст сообщения (exc_info обнулён)
+        return self.redact(json.dumps(entry, ensure_ascii=False))
+
+def setup_logging(stream=None):
+    """Корневой логгер пишет через очередь; поток-писатель останавливается при выходе"""
+    output = logging.StreamHandler(stream)
+    output.setFormatter(RedactingFormatter(LOG_FORMAT, [BOT_TOKEN]))
+    log_queue = queue.Queue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter(
+        {category: float(rate) for category, rate in parse_log_settings(LOG_SAMPLE).items()}))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # telebot вешает на свой логгер синхронный вывод в stderr - без очереди и
+    # без вырезания токена; убираем его, записи дойдут до корня
+    telebot_logger = logging.getLogger('TeleBot')
+    telebot_logger.handlers.clear()
+    telebot_logger.propagate = True
+    for category, level in parse_log_settings(LOG_LEVELS).items():
+        logging.getLogger(f'qazaqtalk.{category}').setLevel(level.upper())
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)  # регистрируется первым, значит дописывает логи последним
+    return listener
+
+setup_logging()
+logger = logging.getLogger('qazaqtalk')
+# Логгеры на каждое обновление пишут с %-аргументами: строка собирается,
+# только если запись прошла уровень категории и LOG_SAMPLE
+handler_log = logger.getChild('handlers')  # вход в обработчики, по записи на обновление
+webhook_log = logger.getChild('webhook')
 
-# Debug logging for configuration
 logger.info(f"Configuration loaded:")
 logger.info(f"DB_PATH: {DB_PATH}")
 logger.info(f"BOT_TOKEN: {'Set' if BOT_TOKEN else 'Not set'}")
 logger.info(f"WEBHOOK_URL: {WEBHOOK_URL}")
 logger.info(f"PORT: {PORT}")
 
-# Настройка логгирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-bot = TeleBot(BOT_TOKEN)
-logger.info(f"Bot initialized with token: {BOT_TOKEN[:10]}..." if BOT_TOKEN else "Bot token not set!")
+# Обработчики выполняются в собственном пуле воркеров (UpdateQueue), а не в пуле telebot
+bot = TeleBot(BOT_TOKEN, threaded=False)
+if not BOT_TOKEN:
+    logger.error("Bot token not set!")
 app = Flask(__name__)
 
-# Глобальные переменные
-user_data = {}
-user_state = {}
+
+# --- Исходящие сообщения ---
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', 30))  # сообщений/с на бота
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))       # сообщений/с в один чат
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', 5))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # например, локальная заглушка Bot API для нагрузочных тестов
+
+# Общая keep-alive сессия с пулом соединений для всех вызовов Bot API
+api_session = requests.Session()
+api_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=OUTBOX_WORKERS * 2))
+api_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=OUTBOX_WORKERS * 2))
+apihelper.session = api_session
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Через сколько секунд появится свободный токен (ничего не резервирует)"""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def reserve(self, now):
+        """Резервирует токен и возвращает, сколько секунд нужно подождать"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class Outbox:
+    """Диспетчер исходящих вызовов Bot API
+
+    Вызовы ставятся в очередь воркера по chat_id (порядок внутри чата
+    сохраняется) и отправляются с учётом глобального и початового лимитов
+    Telegram. Чат, которому пока нельзя отправлять (початовый лимит, 429 с
+    retry_after, сетевая ошибка или 5xx), откладывается вместе со своими
+    следующими вызовами, а воркер тем временем обслуживает остальные чаты.
+    Каждый вызов возвращает Future.
+    """
+
+    _STOP = object()
+
+    def __init__(self, workers=4, global_rate=30, chat_rate=1, max_retries=5):
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._bucket_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._sequence = itertools.count()  # разрешает равенство времени в куче отложенных
+        self.stats = {'sent': 0, 'retried': 0, 'failed': 0, 'deferred': 0}
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._worker, args=(q,), name=f'outbox-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def call(self, chat_id, method, *args, **kwargs):
+        """Ставит в очередь вызов bot.<method>(*args, **kwargs) для чата chat_id"""
+        future = Future()
+        self._queues[hash(chat_id) % len(self._queues)].put({
+            'chat_id': chat_id, 'method': method, 'args': args, 'kwargs': kwargs,
+            'future': future, 'attempt': 0, 'backoff': 1, 'streams': self._streams(args, kwargs),
+        })
+        return future
+
+    @staticmethod
+    def _streams(args, kwargs):
+        """Файловые аргументы и их начальные позиции: перед повтором их перематываем,
+        иначе повторная загрузка отправит уже прочитанный до конца файл"""
+        return [(arg, arg.tell()) for arg in itertools.chain(args, kwargs.values())
+                if hasattr(arg, 'seek') and hasattr(arg, 'tell')]
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.call(chat_id, 'send_message', chat_id, text, **kwargs)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _reserve(self, chat_id):
+        """Токены на отправку: 0 - можно слать, иначе через сколько секунд повторить.
+        Глобальный токен берётся, только когда лимит чата уже позволяет отправку."""
+        with self._bucket_lock:
+            now = time.monotonic()
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) > 10000:
+                    # Забываем чаты, лимит которых уже полностью восстановился
+                    self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items()
+                                          if not b.is_full(now)}
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            delay = bucket.wait_time(now)
+            if delay > 0:
+                return delay
+            bucket.reserve(now)
+            global_delay = self._global_bucket.reserve(now)
+        if global_delay > 0:
+            # Общий лимит бота одинаково касается всех чатов, ждать его можно на месте
+            time.sleep(global_delay)
+        return 0
+
+    def _retry(self, call, delay):
+        call['attempt'] += 1
+        call['backoff'] = min(call['backoff'] * 2, 30)
+        self._count('retried')
+        logger.warning(f"Повтор {call['method']} для {call['chat_id']} через {delay}с")
+        return max(delay, 0.01)
+
+    def _fail(self, call, error):
+        logger.error(f"Не удалось выполнить {call['method']} для {call['chat_id']}: {error}")
+        self._count('failed')
+        call['future'].set_exception(error)
+
+    def _attempt(self, call):
+        """Одна попытка вызова; 0 - вызов завершён, иначе через сколько секунд повторить"""
+        delay = self._reserve(call['chat_id'])
+        if delay:
+            return delay
+        can_retry = call['attempt'] < self.max_retries
+        try:
+            if call['attempt']:
+                for stream, position in call['streams']:
+                    stream.seek(position)
+            result = getattr(bot, call['method'])(*call['args'], **call['kwargs'])
+        except ApiTelegramException as e:
+            if can_retry and e.error_code == 429:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after')
+                return self._retry(call, retry_after or call['backoff'])
+            if can_retry and e.error_code >= 500:
+                return self._retry(call, call['backoff'])
+            self._fail(call, e)
+            return 0
+        except requests.exceptions.RequestException as e:
+            if can_retry:
+                return self._retry(call, call['backoff'])
+            self._fail(call, e)
+            return 0
+        except Exception as e:
+            self._fail(call, e)
+            return 0
+        self._count('sent')
+        call['future'].set_result(result)
+        return 0
+
+    def _drain_chat(self, calls, waiting, due):
+        """Отправляет вызовы чата по порядку; если чату рано, откладывает остаток"""
+        while calls:
+            delay = self._attempt(calls[0])
+            if delay:
+                chat_id = calls[0]['chat_id']
+                waiting[chat_id] = calls
+                heapq.heappush(due, (time.monotonic() + delay, next(self._sequence), chat_id))
+                self._count('deferred')
+                return
+            calls.popleft()
+
+    def _worker(self, calls):
+        waiting = {}  # chat_id -> deque отложенных вызовов чата
+        due = []      # куча (время повтора, номер, chat_id)
+        stopping = False
+        while not (stopping and not due):
+            timeout = max(0, due[0][0] - time.monotonic()) if due else None
+            if stopping:
+                time.sleep(timeout)
+            else:
+                try:
+                    call = calls.get(timeout=timeout)
+                except queue.Empty:
+                    call = None
+                if call is self._STOP:
+                    stopping = True
+                elif call is not None:
+                    if call['chat_id'] in waiting:
+                        # Чат отложен - новый вызов встаёт за его очередью
+                        waiting[call['chat_id']].append(call)
+                    else:
+                        self._drain_chat(deque([call]), waiting, due)
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                _, _, chat_id = heapq.heappop(due)
+                self._drain_chat(waiting.pop(chat_id), waiting, due)
+
+    def stop(self, timeout=30):
+        """Отправляет накопленные сообщения (в том числе отложенные) и останавливает воркеров"""
+        for q in self._queues:
+            q.put(self._STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['depth'] = [q.qsize() for q in self._queues]
+        return stats
+
+outbox = Outbox(workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE,
+                chat_rate=OUTBOX_CHAT_RATE, max_retries=OUTBOX_MAX_RETRIES)
+atexit.register(outbox.stop)
 
 # Debug: List all registered handlers
 def list_handlers():
@@ -46,42 +353,531 @@ def list_handlers():
     logger.info("Registered message handlers:")
     for handler in bot.message_handlers:
         logger.info(f"  - {handler['function'].__name__}: {handler['filters']}")
+    logger.info(f"Commands: {', '.join(COMMANDS)}; steps: {', '.join(STEP_HANDLERS)}")
 
 # --- База данных ---
+class ConnectionPool:
+    """Пул соединений SQLite: одно постоянное соединение на поток"""
+
+    PRAGMAS = (
+        "PRAGMA busy_timeout = 5000",
+        "PRAGMA synchronous = NORMAL",       # в режиме WAL fsync только на checkpoint
+        "PRAGMA cache_size = -16000",        # ~16 MB страничного кэша на соединение
+        "PRAGMA mmap_size = 268435456",      # 256 MB memory-mapped I/O для чтения
+        "PRAGMA temp_store = MEMORY",
+    )
+
+    def __init__(self, db_path, health_check_interval=60):
+        self.db_path = db_path
+        self.health_check_interval = health_check_interval
+        self._local = threading.local()
+        self._connections = {}  # соединение -> поток-владелец
+        self._registry_lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        """Открывает новое соединение и один раз применяет PRAGMA"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        with self._registry_lock:
+            self._prune_dead_threads()
+            self._connections[conn] = threading.current_thread()
+        return conn
+
+    def _prune_dead_threads(self):
+        """Закрывает соединения завершившихся потоков"""
+        for conn, owner in list(self._connections.items()):
+            if not owner.is_alive():
+                del self._connections[conn]
+                conn.close()
+
+    def _discard(self, conn):
+        """Закрывает соединение и убирает его из реестра"""
+        with self._registry_lock:
+            self._connections.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_healthy(self, conn):
+        """Проверяет, что соединение живо"""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def get(self):
+        """Возвращает соединение текущего потока, при необходимости переподключаясь"""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Пул соединений закрыт")
+        conn = getattr(self._local, 'conn', None)
+        now = time.monotonic()
+        if conn is not None and now - self._local.checked_at >= self.health_check_interval:
+            if not self._is_healthy(conn):
+                logger.warning("Соединение с БД неисправно, переподключаемся")
+                self._discard(conn)
+                conn = None
+            self._local.checked_at = now
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.checked_at = now
+        return conn
+
+    def invalidate(self):
+        """Сбрасывает соединение текущего потока (например, после ошибки)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self._discard(conn)
+
+    def size(self):
+        with self._registry_lock:
+            return len(self._connections)
+
+    def close(self):
+        """Закрывает все соединения пула (graceful shutdown)"""
+        if self._closed:
+            return
+        self._closed = True
+        with self._registry_lock:
+            connections, self._connections = list(self._connections), {}
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        logger.info(f"Пул соединений закрыт ({len(connections)} соединений)")
+
+
+class DatabaseWriter:
+    """Единственный поток-писатель: сериализует записи и группирует их в общие коммиты"""
+
+    _STOP = object()
+
+    def __init__(self, pool, max_batch=100):
+        self.pool = pool
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.stats = {'batches': 0, 'writes': 0, 'errors': 0}
+        self._thread.start()
+
+    def in_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, operation):
+        """Ставит операцию operation(conn) в очередь и возвращает Future с её результатом"""
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        """Выполняет пачку операций в одной транзакции, каждую в своём SAVEPOINT"""
+        results = []
+        try:
+            conn = self.pool.get()
+            conn.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                conn.execute("SAVEPOINT write_op")
+                try:
+                    results.append((future, operation(conn), None))
+                    conn.execute("RELEASE write_op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_op")
+                    conn.execute("RELEASE write_op")
+                    results.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи в БД: {traceback.format_exc()}")
+            try:
+                self.pool.get().rollback()
+            except sqlite3.Error:
+                self.pool.invalidate()
+            self.stats['errors'] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.stats['batches'] += 1
+        self.stats['writes'] += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                self.stats['errors'] += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stop(self, timeout=10):
+        """Дописывает очередь и останавливает поток-писатель"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+
+# --- Реестр SQL-запросов ---
+FETCH_NONE = 'none'      # количество затронутых строк
+FETCH_ONE = 'one'        # одна строка или None
+FETCH_ALL = 'all'        # список строк
+FETCH_SCALAR = 'scalar'  # первое значение первой строки или None
+
+Statement = namedtuple('Statement', 'sql fetch write')
+
+# Именованные запросы объявляются один раз; sqlite3 кэширует подготовленные
+# выражения по тексту SQL, поэтому каждое компилируется один раз на соединение.
+QUERIES = {
+    'user_by_id': Statement(
+        "SELECT * FROM users WHERE id = ?", FETCH_ONE, False),
+    'user_contact': Statement(
+        "SELECT name, telegram_username FROM users WHERE id = ?", FETCH_ONE, False),
+    'upsert_user': Statement(
+        """INSERT OR REPLACE INTO users
+        (id, name, age, kazakh_level, gender, preferred_gender, telegram_username)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""", FETCH_NONE, True),
+    'delete_user': Statement(
+        "DELETE FROM users WHERE id = ?", FETCH_NONE, True),
+    'delete_user_matches': Statement(
+        "DELETE FROM matches WHERE user1 = ? OR user2 = ?", FETCH_NONE, True),
+    'active_match': Statement(
+        "SELECT user2, active_until FROM matches WHERE user1 = ? AND active_until > ? LIMIT 1",
+        FETCH_ONE, False),
+    'match_partner_ids': Statement(
+        "SELECT user2 FROM matches WHERE user1 = ?", FETCH_ALL, False),
+    'active_pairs': Statement(
+        "SELECT user1, active_until FROM matches WHERE active_until > ?", FETCH_ALL, False),
+    # Закончившиеся пары переносятся в историю
+    'archive_expired_matches': Statement(
+        """INSERT OR IGNORE INTO past_matches (user1, user2, match_ts)
+        SELECT user1, user2, match_ts FROM matches WHERE active_until <= ?""", FETCH_NONE, True),
+    'delete_expired_matches': Statement(
+        "DELETE FROM matches WHERE active_until <= ?", FETCH_NONE, True),
+    # Рейтинг берётся из агрегата: users.rating сбрасывается при повторной регистрации
+    'indexed_users': Statement(
+        """SELECT u.id, u.name, u.age, u.kazakh_level, u.gender, u.preferred_gender,
+        u.telegram_username,
+        COALESCE((r.sum_q1 + r.sum_q2 + r.sum_q3) / (3.0 * r.feedback_count), 3.0) AS rating
+        FROM users u
+        LEFT JOIN user_ratings r ON r.user_id = u.id AND r.feedback_count > 0""", FETCH_ALL, False),
+    # Кандидаты для find_match без индекса в памяти. Исключения (сам пользователь,
+    # активные пары, прошлые партнёры) - анти-join по индексам, поэтому текст
+    # запроса и число параметров не зависят от истории пар.
+    'match_candidates': Statement(
+        """SELECT
+            u.id, u.name, u.age, u.kazakh_level,
+            u.gender, u.preferred_gender, u.telegram_username,
+            COALESCE(f.avg_rating, 3.0) as rating
+        FROM users u
+        LEFT JOIN (
+            SELECT
+                user_id,
+                (sum_q1 + sum_q2 + sum_q3) / (3.0 * feedback_count) as avg_rating
+            FROM user_ratings
+            WHERE feedback_count > 0
+        ) f ON u.id = f.user_id
+        WHERE u.id != ?1
+        AND NOT EXISTS (
+            SELECT 1 FROM matches m WHERE m.user1 = u.id AND m.active_until > ?2
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM past_matches p WHERE p.user1 = ?1 AND p.user2 = u.id
+        )
+        AND u.preferred_gender IN (?3, 'Не важно')
+        AND (?4 = 'Не важно' OR u.gender = ?4)
+        ORDER BY ABS(COALESCE(f.avg_rating, 3.0) - ?5) ASC
+        LIMIT 50""", FETCH_ALL, False),
+    'known_pairs': Statement(
+        """SELECT user1, user2 FROM past_matches
+        UNION SELECT user1, user2 FROM matches""", FETCH_ALL, False),
+    'past_partner_ids': Statement(
+        "SELECT user2 FROM past_matches WHERE user1 = ?", FETCH_ALL, False),
+    # Пара текущая или уже перенесённая в историю (отзыв приходит после окончания пары)
+    'pair_exists': Statement(
+        """SELECT 1 FROM matches WHERE user1 = ?1 AND user2 = ?2
+        UNION ALL SELECT 1 FROM past_matches WHERE user1 = ?1 AND user2 = ?2 LIMIT 1""",
+        FETCH_SCALAR, False),
+    'insert_match': Statement(
+        "INSERT INTO matches (user1, user2, match_ts, active_until) VALUES (?, ?, ?, ?)",
+        FETCH_NONE, True),
+    # Вставка только если ни у одного из двоих нет активной пары и они ещё не были парой
+    'claim_match': Statement(
+        """INSERT INTO matches (user1, user2, match_ts, active_until)
+        SELECT ?1, ?2, ?3, ?4 WHERE NOT EXISTS (
+            SELECT 1 FROM matches
+            WHERE (user1 IN (?1, ?2) AND active_until > ?3) OR (user1 = ?1 AND user2 = ?2))""",
+        FETCH_NONE, True),
+    'avg_feedback': Statement(
+        """SELECT (sum_q1 + sum_q2 + sum_q3) / (3.0 * feedback_count)
+        FROM user_ratings WHERE user_id = ? AND feedback_count > 0""", FETCH_SCALAR, False),
+    'add_rating': Statement(
+        """INSERT INTO user_ratings
+        (user_id, feedback_count, sum_q1, sum_q2, sum_q3, last_updated)
+        VALUES (?, 1, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            feedback_count = feedback_count + 1,
+            sum_q1 = sum_q1 + excluded.sum_q1,
+            sum_q2 = sum_q2 + excluded.sum_q2,
+            sum_q3 = sum_q3 + excluded.sum_q3,
+            last_updated = excluded.last_updated""", FETCH_NONE, True),
+    'set_rating': Statement(
+        "UPDATE users SET rating = ? WHERE id = ?", FETCH_NONE, True),
+    'insert_feedback': Statement(
+        """INSERT INTO feedback
+        (from_user, to_user, question1, question2, question3, comment, created_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""", FETCH_NONE, True),
+    'insert_review': Statement(
+        "INSERT OR REPLACE INTO review_queue (chat_id1, chat_id2, send_ts) VALUES (?, ?, ?)",
+        FETCH_NONE, True),
+    'pending_reviews': Statement(
+        "SELECT chat_id1, chat_id2, send_ts FROM review_queue", FETCH_ALL, False),
+    'claim_review': Statement(
+        "DELETE FROM review_queue WHERE chat_id1 = ? AND chat_id2 = ? AND send_ts <= ?",
+        FETCH_NONE, True),
+    'media_get': Statement(
+        "SELECT file_id, fingerprint FROM media_cache WHERE name = ?", FETCH_ONE, False),
+    'media_put': Statement(
+        """INSERT OR REPLACE INTO media_cache (name, fingerprint, file_id, updated_ts)
+        VALUES (?, ?, ?, ?)""", FETCH_NONE, True),
+    'state_get': Statement(
+        "SELECT data, updated_ts FROM conversation_state WHERE kind = ? AND chat_id = ?",
+        FETCH_ONE, False),
+    'state_put': Statement(
+        """INSERT OR REPLACE INTO conversation_state (kind, chat_id, data, updated_ts)
+        VALUES (?, ?, ?, ?)""", FETCH_NONE, True),
+    'state_delete': Statement(
+        "DELETE FROM conversation_state WHERE kind = ? AND chat_id = ?", FETCH_NONE, True),
+    'state_expire': Statement(
+        "DELETE FROM conversation_state WHERE kind = ? AND updated_ts < ?", FETCH_NONE, True),
+}
+
+
+def fetch_result(cur, fetch):
+    """Забирает результат курсора согласно режиму выборки"""
+    if fetch == FETCH_ALL:
+        return cur.fetchall()
+    if fetch == FETCH_ONE:
+        return cur.fetchone()
+    if fetch == FETCH_SCALAR:
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+    return cur.rowcount
+
+
+class QueryStats:
+    """Счётчики и гистограммы задержек по именованным запросам"""
+
+    BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'histogram': [0] * (len(self.BUCKETS_MS) + 1),
+                }
+            entry['count'] += 1
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            entry['histogram'][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+
+    def snapshot(self):
+        """Возвращает копию статистики с подписанными корзинами гистограммы"""
+        labels = [f"<={b}ms" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        with self._lock:
+            return {
+                name: {
+                    'count': entry['count'],
+                    'avg_ms': round(entry['total_ms'] / entry['count'], 3),
+                    'max_ms': round(entry['max_ms'], 3),
+                    'histogram': dict(zip(labels, entry['histogram'])),
+                }
+                for name, entry in self._stats.items()
+            }
+
+
 class Database:
     def __init__(self, db_path):
         self.db_path = db_path
-        self.lock = threading.Lock()
+        self._ensure_db_dir()
+        self.pool = ConnectionPool(db_path)
+        self.query_stats = QueryStats()
         self._init_db()
-    
+        self.writer = DatabaseWriter(self.pool)
+
     def _get_connection(self):
-        """Возвращает соединение с базой данных"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
+        """Возвращает соединение с базой данных из пула"""
+        return self.pool.get()
+
+    def close(self):
+        """Дописывает очередь записи и закрывает соединения с базой данных"""
+        self.writer.stop()
+        self.pool.close()
+
+    def transaction(self, operation):
+        """Атомарно выполняет operation(conn) в потоке-писателе и возвращает её результат"""
+        if self.writer.in_writer_thread():
+            return operation(self._get_connection())
+        return self.writer.submit(operation).result()
+
+    def run(self, conn, name, params=()):
+        """Выполняет именованный запрос на данном соединении (внутри transaction)"""
+        statement = QUERIES[name]
+        started = time.perf_counter()
+        try:
+            return fetch_result(conn.execute(statement.sql, params), statement.fetch)
+        finally:
+            self.query_stats.record(name, time.perf_counter() - started)
+
+    def query(self, name, params=()):
+        """Выполняет именованный запрос из QUERIES: запись через писателя, чтение напрямую"""
+        statement = QUERIES[name]
+        try:
+            if statement.write:
+                return self.transaction(lambda conn: self.run(conn, name, params))
+            return self.run(self._get_connection(), name, params)
+        except Exception as e:
+            logger.error(f"Ошибка БД: {e}\nЗапрос: {name}\nПараметры: {params}")
+            raise
+
+    def stats(self):
+        """Метрики БД для /metrics"""
+        return {
+            'connections': self.pool.size(),
+            'writer': dict(self.writer.stats),
+            'queries': self.query_stats.snapshot(),
+        }
+
     def _ensure_db_dir(self):
         """Создает папку для БД, если её нет"""
         db_dir = os.path.dirname(self.db_path)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
     
-    def execute(self, query, params=(), commit=False):
-        """Безопасное выполнение SQL-запроса"""
-        with self.lock:
-            with self._get_connection() as conn:
-                cur = conn.cursor()
-                try:
-                    cur.execute(query, params)
-                    if commit:
-                        conn.commit()
-                    if query.strip().upper().startswith('SELECT'):
-                        return cur.fetchall()
-                    return True
-                except Exception as e:
-                    logger.error(f"Ошибка БД: {e}\nЗапрос: {query}\nПараметры: {params}")
-                    conn.rollback()
-                    raise
+    def execute(self, query, params=(), commit=False, fetch=None):
+        """Выполнение произвольного SQL-запроса (для динамических запросов и DDL)
+
+        Запросы с commit=True уходят в очередь потока-писателя,
+        чтение идёт параллельно через соединения текущего потока (WAL).
+        По умолчанию чтение возвращает все строки, запись - количество строк.
+        """
+        if fetch is None:
+            fetch = FETCH_NONE if commit else FETCH_ALL
+        if commit:
+            def write(conn):
+                return fetch_result(conn.execute(query, params), fetch)
+            try:
+                return self.transaction(write)
+            except Exception as e:
+                logger.error(f"Ошибка БД: {e}\nЗапрос: {query}\nПараметры: {params}")
+                raise
+
+        conn = self._get_connection()
+        try:
+            return fetch_result(conn.execute(query, params), fetch)
+        except Exception as e:
+            logger.error(f"Ошибка БД: {e}\nЗапрос: {query}\nПараметры: {params}")
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    # Столбцы времени: (таблица, старый ISO-столбец, новый столбец с эпохой в секундах)
+    EPOCH_COLUMNS = (
+        ('matches', 'match_time', 'match_ts'),
+        ('past_matches', 'match_time', 'match_ts'),
+        ('feedback', 'timestamp', 'created_ts'),
+        ('review_queue', 'send_time', 'send_ts'),
+    )
+
+    INDEXES = (
+        '''CREATE INDEX IF NOT EXISTS idx_review_queue_send_ts ON review_queue(send_ts)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_review_queue_pair ON review_queue(chat_id1, chat_id2)''',
+        '''CREATE INDEX IF NOT EXISTS idx_matches_match_ts ON matches(match_ts)''',
+        # Частичный индекс активных пар: проверка занятости и анти-join кандидатов
+        '''CREATE INDEX IF NOT EXISTS idx_matches_active ON matches(user1, active_until)
+        WHERE active_until IS NOT NULL''',
+        '''CREATE INDEX IF NOT EXISTS idx_feedback_created_ts ON feedback(created_ts)''',
+    )
+
+    @staticmethod
+    def _iso_to_epoch(value):
+        """Переводит ISO-строку в секунды эпохи (время без пояса считается UTC)"""
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return int(parsed.timestamp())
+
+    def migrate_timestamps(self):
+        """Переводит ISO-строки времени в целочисленные столбцы и создаёт индексы"""
+        def migrate(conn):
+            converted = 0
+            for table, old_column, new_column in self.EPOCH_COLUMNS:
+                columns = [c[1] for c in conn.execute(f"PRAGMA table_info({table})")]
+                if new_column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {new_column} INTEGER")
+                    logger.info(f"Добавлен столбец {new_column} в таблицу {table}")
+                if old_column not in columns:
+                    continue
+                rows = conn.execute(
+                    f"SELECT rowid, {old_column} FROM {table} "
+                    f"WHERE {new_column} IS NULL AND {old_column} IS NOT NULL").fetchall()
+                updates = []
+                for rowid, value in rows:
+                    try:
+                        updates.append((self._iso_to_epoch(value), rowid))
+                    except (TypeError, ValueError):
+                        logger.warning(f"Неверный формат времени в {table}.{old_column}: {value}")
+                conn.executemany(f"UPDATE {table} SET {new_column} = ? WHERE rowid = ?", updates)
+                converted += len(updates)
+
+            # Конец пары хранится явно, по нему работают частичный индекс и очистка пар
+            if 'active_until' not in [c[1] for c in conn.execute("PRAGMA table_info(matches)")]:
+                conn.execute("ALTER TABLE matches ADD COLUMN active_until INTEGER")
+                logger.info("Добавлен столбец active_until в таблицу matches")
+            conn.execute("UPDATE matches SET active_until = match_ts + ? "
+                         "WHERE active_until IS NULL AND match_ts IS NOT NULL", (MATCH_DURATION,))
+
+            # Перед уникальным индексом оставляем по одному запросу отзыва на пару
+            conn.execute(
+                '''DELETE FROM review_queue WHERE rowid NOT IN (
+                    SELECT MIN(rowid) FROM review_queue GROUP BY chat_id1, chat_id2)''')
+            for index in self.INDEXES:
+                conn.execute(index)
+            return converted
+
+        converted = self.transaction(migrate)
+        if converted:
+            logger.info(f"Время переведено в секунды эпохи: {converted} строк")
+        return converted
 
     def add_missing_columns(self):
         """Добавляет отсутствующие столбцы в таблицы"""
@@ -95,10 +891,59 @@ class Database:
                         commit=True
                     )
                     logger.info("Добавлен столбец rating в таблицу users")
+
+            self.migrate_timestamps()
+
+            # Агрегаты рейтинга появились позже отзывов: заполняем их для старых БД
+            if (self.execute("SELECT 1 FROM feedback LIMIT 1")
+                    and not self.execute("SELECT 1 FROM user_ratings LIMIT 1")):
+                self.rebuild_ratings()
         except Exception as e:
             logger.error(f"Ошибка проверки/добавления столбцов: {e}")
             raise
 
+    # Агрегат, пересчитанный заново из всех отзывов
+    _RATINGS_FROM_FEEDBACK = '''
+        SELECT to_user AS user_id, COUNT(*) AS feedback_count,
+               SUM(question1) AS sum_q1, SUM(question2) AS sum_q2, SUM(question3) AS sum_q3
+        FROM feedback GROUP BY to_user'''
+
+    def rebuild_ratings(self):
+        """Пересчитывает user_ratings и users.rating по таблице feedback"""
+        now = int(time.time())
+
+        def rebuild(conn):
+            conn.execute("DELETE FROM user_ratings")
+            conn.execute(
+                f'''INSERT INTO user_ratings
+                (user_id, feedback_count, sum_q1, sum_q2, sum_q3, last_updated)
+                SELECT user_id, feedback_count, sum_q1, sum_q2, sum_q3, ?
+                FROM ({self._RATINGS_FROM_FEEDBACK})''', (now,))
+            conn.execute(
+                '''UPDATE users SET rating = (
+                    SELECT ROUND((sum_q1 + sum_q2 + sum_q3) / (3.0 * feedback_count), 2)
+                    FROM user_ratings WHERE user_id = users.id)
+                WHERE id IN (SELECT user_id FROM user_ratings)''')
+            return conn.execute("SELECT COUNT(*) FROM user_ratings").fetchone()[0]
+
+        count = self.transaction(rebuild)
+        logger.info(f"Агрегаты рейтинга пересчитаны: {count} пользователей")
+        return count
+
+    def check_ratings(self):
+        """Возвращает id пользователей, чей агрегат расходится с таблицей feedback"""
+        rows = self.execute(
+            f'''SELECT f.user_id
+            FROM ({self._RATINGS_FROM_FEEDBACK}) f
+            LEFT JOIN user_ratings r ON r.user_id = f.user_id
+            WHERE r.user_id IS NULL
+               OR r.feedback_count != f.feedback_count
+               OR r.sum_q1 != f.sum_q1 OR r.sum_q2 != f.sum_q2 OR r.sum_q3 != f.sum_q3
+            UNION
+            SELECT user_id FROM user_ratings
+            WHERE user_id NOT IN (SELECT to_user FROM feedback)''')
+        return [row['user_id'] for row in rows]
+
     def _init_db(self):
         """Инициализация таблиц в базе данных"""
         tables = [
@@ -114,7 +959,8 @@ class Database:
             '''CREATE TABLE IF NOT EXISTS matches (
                 user1 INTEGER,
                 user2 INTEGER,
-                match_time TEXT,
+                match_ts INTEGER,
+                active_until INTEGER,
                 PRIMARY KEY (user1, user2)
             )''',
             '''CREATE TABLE IF NOT EXISTS feedback (
@@ -125,25 +971,49 @@ class Database:
                 question2 INTEGER,
                 question3 INTEGER,
                 comment TEXT,
-                timestamp TEXT
+                created_ts INTEGER
             )''',
             '''CREATE TABLE IF NOT EXISTS past_matches (
                 user1 INTEGER,
                 user2 INTEGER,
-                match_time TEXT,
+                match_ts INTEGER,
                 PRIMARY KEY (user1, user2)
             )''',
+            '''CREATE TABLE IF NOT EXISTS user_ratings (
+                user_id INTEGER PRIMARY KEY,
+                feedback_count INTEGER NOT NULL DEFAULT 0,
+                sum_q1 INTEGER NOT NULL DEFAULT 0,
+                sum_q2 INTEGER NOT NULL DEFAULT 0,
+                sum_q3 INTEGER NOT NULL DEFAULT 0,
+                last_updated INTEGER
+            )''',
             '''CREATE TABLE IF NOT EXISTS review_queue (
                 chat_id1 INTEGER,
                 chat_id2 INTEGER,
-                send_time TEXT
-            )''',  
+                send_ts INTEGER
+            )''',
+            '''CREATE TABLE IF NOT EXISTS conversation_state (
+                kind TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_ts INTEGER NOT NULL,
+                PRIMARY KEY (kind, chat_id)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS media_cache (
+                name TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_ts INTEGER NOT NULL
+            )''',
             '''CREATE INDEX IF NOT EXISTS idx_feedback_to_user ON feedback(to_user)''',
             '''CREATE INDEX IF NOT EXISTS idx_matches_user1 ON matches(user1)''',
-            '''CREATE INDEX IF NOT EXISTS idx_matches_user2 ON matches(user2)'''
+            '''CREATE INDEX IF NOT EXISTS idx_matches_user2 ON matches(user2)''',
+            '''CREATE INDEX IF NOT EXISTS idx_conversation_state_updated ON conversation_state(kind, updated_ts)'''
         ]
         
-        with self._get_connection() as conn: 
+        with self._get_connection() as conn:
+            # WAL сохраняется в файле БД: читатели не блокируют писателя и наоборот
+            conn.execute("PRAGMA journal_mode = WAL")
             cur = conn.cursor()
             for table in tables:
                 cur.execute(table)
@@ -155,420 +1025,1158 @@ try:
     logger.info(f"Initializing database at: {DB_PATH}")
     db = Database(DB_PATH)
     db.add_missing_columns()
+    atexit.register(db.close)
     logger.info("Database initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize database: {traceback.format_exc()}")
     raise
 
+# --- Состояние диалогов ---
+# Шаг регистрации и ожидание отзыва хранятся в общем хранилище, а не в
+# словарях процесса и не в next-step обработчиках telebot: после рестарта
+# незаконченные анкеты не теряются, а брошенные сессии удаляются по TTL.
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')  # sqlite | memory
+STATE_TTL = int(os.getenv('STATE_TTL', 24 * 60 * 60))
+STATE_CACHE = os.getenv('STATE_CACHE', '1') == '1'  # 0 - без кэша, для нескольких процессов
+STATE_SWEEP_INTERVAL = int(os.getenv('STATE_SWEEP_INTERVAL', 600))
+STATE_MAX_SESSIONS = int(os.getenv('STATE_MAX_SESSIONS', 10000))  # на хранилище в памяти процесса
+
+class MemoryStateStore:
+    """Состояние диалогов в памяти процесса: LRU с TTL и ограничением размера
+
+    Используется как бэкенд (тесты, один воркер) и как кэш SqliteStateStore.
+    При превышении max_sessions вытесняются давно не использованные чаты.
+    """
+
+    def __init__(self, kind, ttl, max_sessions=10000):
+        self.kind = kind
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._items = OrderedDict()  # chat_id -> (data, updated_ts), от старых к свежим
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evicted': 0, 'expired': 0}
+
+    def get(self, chat_id):
+        """Копия состояния чата или None, если его нет или оно устарело"""
+        with self._lock:
+            item = self._items.get(chat_id)
+            if item is None:
+                self.counters['misses'] += 1
+                return None
+            if item[1] + self.ttl < int(time.time()):
+                del self._items[chat_id]
+                self.counters['expired'] += 1
+                self.counters['misses'] += 1
+                return None
+            self._items.move_to_end(chat_id)
+            self.counters['hits'] += 1
+        return dict(item[0])
+
+    def set(self, chat_id, data):
+        with self._lock:
+            self._items[chat_id] = (dict(data), int(time.time()))
+            self._items.move_to_end(chat_id)
+            while len(self._items) > self.max_sessions:
+                self._items.popitem(last=False)
+                self.counters['evicted'] += 1
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._items.pop(chat_id, None)
+
+    def expire(self):
+        """Удаляет брошенные сессии; возвращает их количество"""
+        deadline = int(time.time()) - self.ttl
+        with self._lock:
+            stale = [chat_id for chat_id, (_, updated) in self._items.items() if updated < deadline]
+            for chat_id in stale:
+                del self._items[chat_id]
+            self.counters['expired'] += len(stale)
+        return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, backend='memory', sessions=len(self._items),
+                        max_sessions=self.max_sessions)
+
+class SqliteStateStore:
+    """Состояние диалогов в таблице conversation_state с кэшем и отложенной записью
+
+    Записи уходят в поток DatabaseWriter без ожидания и группируются с
+    остальными в общие коммиты; чтение обслуживает кэш процесса. Без
+    кэша (STATE_CACHE=0) каждая запись ждёт коммита, а чтение идёт в БД,
+    так что состояние согласовано между несколькими процессами.
+    """
+
+    def __init__(self, database, kind, ttl, cache=True, max_sessions=10000):
+        self.db = database
+        self.kind = kind
+        self.ttl = ttl
+        self.cache = MemoryStateStore(kind, ttl, max_sessions) if cache else None
+        self.errors = 0
+
+    def get(self, chat_id):
+        if self.cache is not None:
+            data = self.cache.get(chat_id)
+            if data is not None:
+                return data
+        row = self.db.query('state_get', (self.kind, chat_id))
+        if row is None or row['updated_ts'] + self.ttl < int(time.time()):
+            return None
+        data = json.loads(row['data'])
+        if self.cache is not None:
+            self.cache.set(chat_id, data)
+        return data
+
+    def _write(self, name, params, wait=False):
+        future = self.db.writer.submit(lambda conn: self.db.run(conn, name, params))
+        if wait or self.cache is None:
+            future.result()
+        else:
+            future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            self.errors += 1
+            logger.error(f"Не удалось сохранить состояние {self.kind}: {future.exception()}")
+
+    def set(self, chat_id, data):
+        if self.cache is not None:
+            self.cache.set(chat_id, data)
+        self._write('state_put', (self.kind, chat_id, json.dumps(data, ensure_ascii=False),
+                                  int(time.time())))
+
+    def delete(self, chat_id):
+        # Удаление ждёт коммита, иначе промах кэша прочитал бы из БД старую запись
+        self._write('state_delete', (self.kind, chat_id), wait=True)
+        if self.cache is not None:
+            self.cache.delete(chat_id)
+
+    def expire(self):
+        if self.cache is not None:
+            self.cache.expire()
+        return self.db.query('state_expire', (self.kind, int(time.time()) - self.ttl))
+
+    def stats(self):
+        return {'backend': 'sqlite',
+                'cache': self.cache.stats() if self.cache is not None else None,
+                'errors': self.errors}
+
+def make_state_store(kind):
+    """Хранилище состояния выбранного бэкенда (STATE_BACKEND)"""
+    if STATE_BACKEND == 'memory':
+        return MemoryStateStore(kind, STATE_TTL, STATE_MAX_SESSIONS)
+    return SqliteStateStore(db, kind, STATE_TTL, cache=STATE_CACHE, max_sessions=STATE_MAX_SESSIONS)
+
+user_data = make_state_store('registration')  # анкета в процессе регистрации
+user_state = make_state_store('review')       # ожидание отзыва
+
+def sweep_states():
+    """Фоновое удаление брошенных сессий"""
+    while True:
+        time.sleep(STATE_SWEEP_INTERVAL)
+        for store in (user_data, user_state):
+            try:
+                removed = store.expire()
+                if removed:
+                    logger.info(f"Удалено устаревших сессий {store.kind}: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки сессий: {traceback.format_exc()}")
+
+# --- Статические файлы ---
+# Каталог с материалами сканируется один раз при старте: размеры и хэши
+# считаются заранее, слишком большие файлы отклоняются сразу, а небольшие
+# держатся в памяти. Обработчики берут готовый Asset без обращения к диску.
+ASSETS_DIR = os.getenv('ASSETS_DIR', os.path.dirname(os.path.abspath(__file__)))
+ASSET_EXTENSIONS = tuple(os.getenv('ASSET_EXTENSIONS', '.docx,.pdf,.mp3,.ogg,.m4a,.jpg,.jpeg,.png').split(','))
+ASSET_MAX_SIZE = 50 * 1024 * 1024  # Telegram ограничивает 50MB для ботов
+ASSET_MEMORY_LIMIT = int(os.getenv('ASSET_MEMORY_LIMIT', 2 * 1024 * 1024))  # файлы меньше держим в памяти
+
+Asset = namedtuple('Asset', 'name path size sha256 data')  # data = None: читать с диска
+
+class AssetRegistry:
+    """Реестр статических файлов, собранный при запуске"""
+
+    def __init__(self, directory, extensions=ASSET_EXTENSIONS, memory_limit=ASSET_MEMORY_LIMIT):
+        self.directory = directory
+        self.extensions = extensions
+        self.memory_limit = memory_limit
+        self.assets = {}
+        self.rejected = {}  # имя -> причина
+
+    def scan(self):
+        """Читает каталог: считает sha256, отклоняет слишком большие файлы"""
+        assets, rejected = {}, {}
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if not entry.is_file() or not entry.name.lower().endswith(self.extensions):
+                continue
+            size = entry.stat().st_size
+            if size > ASSET_MAX_SIZE:
+                rejected[entry.name] = f"слишком большой: {size / (1024 * 1024):.2f}MB"
+                logger.error(f"Файл {entry.name} отклонён, {rejected[entry.name]}")
+                continue
+            digest = hashlib.sha256()
+            data = bytearray() if size <= self.memory_limit else None
+            with open(entry.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(chunk)
+                    if data is not None:
+                        data += chunk
+            assets[entry.name] = Asset(entry.name, entry.path, size, digest.hexdigest(),
+                                       bytes(data) if data is not None else None)
+        self.assets, self.rejected = assets, rejected
+        logger.info(f"Загружено файлов: {len(assets)}, отклонено: {len(rejected)}")
+
+    def get(self, name):
+        return self.assets.get(name)
+
+    def open(self, asset):
+        """Файловый объект для загрузки в Telegram"""
+        if asset.data is None:
+            return open(asset.path, 'rb')
+        stream = io.BytesIO(asset.data)
+        stream.name = asset.name
+        return stream
+
+    def snapshot(self):
+        return {
+            'directory': self.directory,
+            'assets': [{'name': a.name, 'size': a.size, 'sha256': a.sha256,
+                        'in_memory': a.data is not None} for a in self.assets.values()],
+            'rejected': dict(self.rejected),
+        }
+
+assets = AssetRegistry(ASSETS_DIR)
+try:
+    assets.scan()
+except OSError as e:
+    logger.error(f"Не удалось прочитать каталог файлов {ASSETS_DIR}: {e}")
+
+# --- Кэш медиафайлов ---
+# Статический файл загружается в Telegram один раз, а полученный file_id
+# хранится в media_cache и переиспользуется. Запись сбрасывается, когда
+# меняется содержимое файла (sha256 из реестра файлов).
+
+# Тип медиа -> (метод бота, действие "отправляет...", file_id из ответа)
+MEDIA_METHODS = {
+    'document': ('send_document', 'upload_document', lambda msg: msg.document.file_id),
+    'audio': ('send_audio', 'upload_voice', lambda msg: msg.audio.file_id),
+    'photo': ('send_photo', 'upload_photo', lambda msg: msg.photo[-1].file_id),
+}
+
+class MediaCache:
+    """file_id статических файлов, уже загруженных в Telegram"""
+
+    def __init__(self, database):
+        self.db = database
+        self._upload_locks = {}  # имя -> Lock, чтобы параллельные запросы не грузили файл дважды
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'uploads': 0, 'invalidated': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _file_id_rejected(error):
+        """Telegram не принял сам file_id (а не подпись, чат и т.п.)"""
+        description = (getattr(error, 'description', '') or '').lower()
+        return error.error_code == 400 and ('file identifier' in description or 'file_id' in description)
+
+    def _send_cached(self, chat_id, method, row, **kwargs):
+        """Отправка по file_id; None, если Telegram file_id больше не принимает"""
+        try:
+            result = outbox.call(chat_id, method, chat_id, row['file_id'], **kwargs).result()
+        except ApiTelegramException as e:
+            if not self._file_id_rejected(e):
+                raise
+            return None
+        self._count('hits')
+        return result
+
+    def send(self, chat_id, asset, kind='document', upload_kwargs=None, **kwargs):
+        """Отправляет файл из реестра по сохранённому file_id или загружает его и запоминает file_id"""
+        method, action, file_id_of = MEDIA_METHODS[kind]
+        name, fingerprint = asset.name, asset.sha256
+
+        # Обычный случай - file_id уже есть, блокировка не нужна
+        row = self.db.query('media_get', (name,))
+        rejected = None
+        if row is not None and row['fingerprint'] == fingerprint:
+            result = self._send_cached(chat_id, method, row, **kwargs)
+            if result is not None:
+                return result
+            rejected = row['file_id']
+            logger.warning(f"file_id для {name} отклонён Telegram, загружаем заново")
+
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(name, threading.Lock())
+        with upload_lock:
+            # Пока ждали блокировку, файл мог загрузить параллельный запрос
+            row = self.db.query('media_get', (name,))
+            if row is not None and row['fingerprint'] == fingerprint and row['file_id'] != rejected:
+                result = self._send_cached(chat_id, method, row, **kwargs)
+                if result is not None:
+                    return result
+            if row is not None:
+                self._count('invalidated')
+
+            outbox.call(chat_id, 'send_chat_action', chat_id, action)
+            with assets.open(asset) as f:
+                # Ждём отправки, пока файл открыт
+                result = outbox.call(chat_id, method, chat_id, f, **kwargs, **(upload_kwargs or {})).result()
+            self.db.query('media_put', (name, fingerprint, file_id_of(result), int(time.time())))
+            self._count('uploads')
+            logger.info(f"{name} загружен в Telegram, file_id сохранён")
+            return result
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+media_cache = MediaCache(db)
+
 # --- Вспомогательные функции ---
+AGE_OPTIONS = ["10-13", "14-16", "17-20", "21-25", "30-35", "35+"]
+LEVELS = ['Начинающий', 'Средний', 'Продвинутый', 'Носитель']
+GENDERS = ['Мужской', 'Женский']
+ANY_GENDER = 'Не важно'
+
 def age_range_to_tuple(age_str):
     """Преобразует строку возраста в кортеж (min, max)"""
     if '+' in age_str:
         return (int(age_str.replace('+', '')), 99)
     return tuple(map(int, age_str.split('-')))
 
+def ranges_overlap(r1, r2):
+    return max(r1[0], r2[0]) <= min(r1[1], r2[1])
+
+# Атрибуты профиля кодируются малыми целыми числами один раз при регистрации,
+# а совместимость кодов заранее сведена в битовые маски:
+# бит j в AGE_COMPAT[i] означает, что возрасты с кодами i и j пересекаются.
+AGE_CODES = {age: i for i, age in enumerate(AGE_OPTIONS)}
+LEVEL_CODES = {level: i for i, level in enumerate(LEVELS)}
+GENDER_CODES = {gender: i for i, gender in enumerate(GENDERS + [ANY_GENDER])}
+ANY_GENDER_CODE = GENDER_CODES[ANY_GENDER]
+
+def compatibility_masks(size, compatible):
+    return [sum(1 << j for j in range(size) if compatible(i, j)) for i in range(size)]
+
+def mask_bits(mask):
+    return [i for i in range(mask.bit_length()) if mask >> i & 1]
+
+_AGE_RANGES = [age_range_to_tuple(age) for age in AGE_OPTIONS]
+AGE_COMPAT = compatibility_masks(
+    len(AGE_OPTIONS), lambda i, j: ranges_overlap(_AGE_RANGES[i], _AGE_RANGES[j]))
+LEVEL_COMPAT = compatibility_masks(len(LEVELS), lambda i, j: abs(i - j) <= 1)
+# Какие коды пола допускает код желаемого пола
+PREF_GENDERS = [1 << code for code in range(len(GENDERS))] + [(1 << len(GENDERS)) - 1]
+
+def encode_profile(profile):
+    """Кодирует профиль в кортеж (пол, желаемый пол, уровень, возраст) или None"""
+    try:
+        return (GENDER_CODES[profile['gender']], GENDER_CODES[profile['preferred_gender']],
+                LEVEL_CODES[profile['kazakh_level']], AGE_CODES[profile['age']])
+    except KeyError:
+        return None
+
+def _compatible_codes(code):
+    gender, preferred_gender, level, age = code
+    return [(g, p, l, a)
+            for g in mask_bits(PREF_GENDERS[preferred_gender])
+            for p in (gender, ANY_GENDER_CODE)
+            for l in mask_bits(LEVEL_COMPAT[level])
+            for a in mask_bits(AGE_COMPAT[age])]
+
+# Все совместимые коды для каждого возможного кода профиля (таблица на 216 записей)
+COMPATIBLE_CODES = {
+    (g, p, l, a): _compatible_codes((g, p, l, a))
+    for g in range(len(GENDERS)) for p in range(len(GENDER_CODES))
+    for l in range(len(LEVELS)) for a in range(len(AGE_OPTIONS))
+}
+
 def age_overlap(age1, age2):
     """Проверяет пересечение возрастных диапазонов"""
-    r1 = age_range_to_tuple(age1)
-    r2 = age_range_to_tuple(age2)
-    return max(r1[0], r2[0]) <= min(r1[1], r2[1])
+    code1, code2 = AGE_CODES.get(age1), AGE_CODES.get(age2)
+    if code1 is not None and code2 is not None:
+        return bool(AGE_COMPAT[code1] >> code2 & 1)
+    return ranges_overlap(age_range_to_tuple(age1), age_range_to_tuple(age2))
 
 def level_match(level1, level2):
     """Проверяет совместимость уровней языка"""
-    LEVELS = ['Начинающий', 'Средний', 'Продвинутый', 'Носитель']
-    return abs(LEVELS.index(level1) - LEVELS.index(level2)) <= 1
+    code1, code2 = LEVEL_CODES.get(level1), LEVEL_CODES.get(level2)
+    if code1 is None or code2 is None:
+        return False
+    return bool(LEVEL_COMPAT[code1] >> code2 & 1)
 
 def get_average_feedback(user_id):
-    """Возвращает средний рейтинг пользователя"""
-    result = db.execute(
-        "SELECT AVG(question1), AVG(question2), AVG(question3) FROM feedback WHERE to_user = ?",
-        (user_id,)
-    )
-    if result and all(r is not None for r in result[0]):
-        return sum(result[0]) / 3
-    return None
+    """Возвращает средний рейтинг пользователя (из агрегата user_ratings)"""
+    return db.query('avg_feedback', (user_id,))
+
+def save_feedback(from_user, to_user, scores, comment):
+    """Сохраняет отзыв и обновляет агрегат рейтинга в одной транзакции"""
+    now = int(time.time())
+
+    def write(conn):
+        db.run(conn, 'insert_feedback', (from_user, to_user, *scores, comment, now))
+        db.run(conn, 'add_rating', (to_user, *scores, now))
+        avg_rating = db.run(conn, 'avg_feedback', (to_user,))
+        db.run(conn, 'set_rating', (round(avg_rating, 2), to_user))
+        return avg_rating
+
+    avg_rating = db.transaction(write)
+    match_index.update_rating(to_user, avg_rating)
+    return avg_rating
+
+# --- Индекс кандидатов для мэтчинга ---
+MATCH_INDEX_ENABLED = os.getenv('MATCH_INDEX', '1') == '1'
+DEFAULT_RATING = 3.0
+PROFILE_FIELDS = ('id', 'name', 'age', 'kazakh_level', 'gender', 'preferred_gender', 'telegram_username')
+
+class MatchIndex:
+    """Индекс свободных пользователей в памяти
+
+    Пользователи разложены по корзинам - кодам encode_profile
+    (пол, желаемый пол, уровень, возраст), внутри корзины отсортированы по рейтингу. Поиск перебирает только
+    совместимые корзины и берёт ближайшего по рейтингу кандидата.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._buckets = {}     # ключ -> отсортированный список (rating, user_id)
+        self._profiles = {}    # user_id -> профиль (dict)
+        self._keys = {}        # user_id -> ключ корзины
+        self._busy_until = {}  # user_id -> время окончания активной пары
+        self.ready = False
+
+    @staticmethod
+    def bucket_key(profile):
+        return encode_profile(profile)
+
+    def load(self, database):
+        """Заполняет индекс из БД (при старте)"""
+        now = int(time.time())
+        rows = database.query('indexed_users')
+        busy = database.query('active_pairs', (now,))
+        with self._lock:
+            self._buckets.clear()
+            self._profiles.clear()
+            self._keys.clear()
+            self._busy_until.clear()
+            for row in rows:
+                profile = {field: row[field] for field in PROFILE_FIELDS}
+                self.add(profile, row['rating'])
+            for row in busy:
+                self._busy_until[row['user1']] = row['active_until']
+            self.ready = True
+        logger.info(f"Индекс мэтчинга загружен: {len(self._profiles)} пользователей, "
+                    f"{len(self._busy_until)} в активных парах")
+
+    def add(self, profile, rating=None):
+        """Добавляет или обновляет пользователя (регистрация); занятость в активной паре сохраняется"""
+        key = self.bucket_key(profile)
+        if key is None:
+            return
+        rating = DEFAULT_RATING if rating is None else rating
+        with self._lock:
+            self._unlink(profile['id'])
+            profile = dict(profile, rating=rating)
+            bisect.insort(self._buckets.setdefault(key, []), (rating, profile['id']))
+            self._profiles[profile['id']] = profile
+            self._keys[profile['id']] = key
+
+    def remove(self, user_id):
+        """Убирает пользователя из индекса вместе с отметкой занятости (restart)"""
+        with self._lock:
+            self._unlink(user_id)
+            self._busy_until.pop(user_id, None)
+
+    def _unlink(self, user_id):
+        """Убирает пользователя из корзины, не трогая занятость"""
+        with self._lock:
+            key = self._keys.pop(user_id, None)
+            profile = self._profiles.pop(user_id, None)
+            if key is None:
+                return
+            bucket = self._buckets[key]
+            i = bisect.bisect_left(bucket, (profile['rating'], user_id))
+            if i < len(bucket) and bucket[i] == (profile['rating'], user_id):
+                del bucket[i]
+            if not bucket:
+                del self._buckets[key]
+
+    def update_rating(self, user_id, rating):
+        """Переставляет пользователя внутри корзины после нового отзыва"""
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                self.add(profile, rating)
+
+    def mark_busy(self, user_id, until):
+        """Помечает пользователя занятым до окончания пары"""
+        with self._lock:
+            self._busy_until[user_id] = until
+
+    def release(self, user_id):
+        """Снимает отметку занятости (пара удалена)"""
+        with self._lock:
+            self._busy_until.pop(user_id, None)
+
+    def is_busy(self, user_id, now):
+        until = self._busy_until.get(user_id)
+        if until is None:
+            return False
+        if until <= now:
+            # Пара истекла - пользователь снова свободен
+            del self._busy_until[user_id]
+            return False
+        return True
+
+    @staticmethod
+    def keys_compatible_with(key):
+        """Ключи корзин, совместимых с корзиной key (отношение симметрично)"""
+        return COMPATIBLE_CODES.get(key, [])
+
+    def compatible_keys(self, profile):
+        """Ключи корзин, совместимых с профилем"""
+        key = self.bucket_key(profile)
+        return self.keys_compatible_with(key) if key else []
+
+    def _nearest_in_bucket(self, bucket, rating, exclude, now):
+        """Ближайший по рейтингу свободный кандидат в корзине"""
+        right = bisect.bisect_left(bucket, (rating, float('-inf')))
+        left = right - 1
+        while left >= 0 or right < len(bucket):
+            if right >= len(bucket) or (left >= 0 and rating - bucket[left][0] <= bucket[right][0] - rating):
+                candidate, left = bucket[left], left - 1
+            else:
+                candidate, right = bucket[right], right + 1
+            user_id = candidate[1]
+            if user_id not in exclude and not self.is_busy(user_id, now):
+                return candidate
+        return None
+
+    def find(self, profile, rating, exclude=()):
+        """Возвращает профиль лучшего кандидата или None"""
+        now = int(time.time())
+        exclude = set(exclude) | {profile['id']}
+        best = None
+        with self._lock:
+            for key in self.compatible_keys(profile):
+                bucket = self._buckets.get(key)
+                if not bucket:
+                    continue
+                candidate = self._nearest_in_bucket(bucket, rating, exclude, now)
+                if candidate is not None and (best is None or abs(candidate[0] - rating) < abs(best[0] - rating)):
+                    best = candidate
+            return dict(self._profiles[best[1]]) if best else None
+
+    def plan_batch(self, known_pairs, busy_until):
+        """Сводит в пары всех свободных пользователей за один проход
+
+        Точное паросочетание максимального веса (blossom) слишком дорого для
+        десятков тысяч вершин, поэтому используется жадное приближение:
+        пары корзин обходятся по убыванию структурного веса (уровень, возраст),
+        а внутри пары корзин пользователи сводятся по ближайшему рейтингу.
 
-def update_user_rating(user_id):
-    """Обновляет рейтинг пользователя в таблице users"""
+        Под блокировкой индекса только копируется снимок и применяется
+        результат, сам расчёт идёт без неё - find_match и регистрация не ждут
+        весь проход. Пара применяется, только если оба пользователя всё ещё
+        свободны и в тех же корзинах; они сразу помечаются занятыми до busy_until.
+        """
+        now = int(time.time())
+        with self._lock:
+            buckets = {key: list(bucket) for key, bucket in self._buckets.items()}
+            keys = dict(self._keys)
+            busy = dict(self._busy_until)
+
+        pool = {
+            key: [entry for entry in bucket if busy.get(entry[1], 0) <= now]
+            for key, bucket in buckets.items()
+        }
+        bucket_pairs = set()
+        for key in pool:
+            for other in self.keys_compatible_with(key):
+                if other in pool:
+                    bucket_pairs.add((min(key, other), max(key, other)))
+        ordered = sorted(bucket_pairs, key=lambda pair: -bucket_pair_weight(*pair))
+
+        planned = []
+        for key1, key2 in ordered:
+            side1, side2 = pool[key1], pool[key2]
+            if not side1 or not side2:
+                continue
+            matched = pair_by_rating(side1, None if key1 == key2 else side2, known_pairs)
+            if not matched:
+                continue
+            taken = set()
+            for user1, user2 in matched:
+                taken.update((user1, user2))
+                planned.append((user1, user2))
+            pool[key1] = [entry for entry in side1 if entry[1] not in taken]
+            pool[key2] = [entry for entry in pool[key2] if entry[1] not in taken]
+
+        pairs = []
+        with self._lock:
+            for user1, user2 in planned:
+                # Пока считали, пользователя могли занять, перерегистрировать или удалить
+                if (self._keys.get(user1) != keys[user1] or self._keys.get(user2) != keys[user2]
+                        or self.is_busy(user1, now) or self.is_busy(user2, now)):
+                    continue
+                pairs.append((dict(self._profiles[user1]), dict(self._profiles[user2])))
+                self._busy_until[user1] = busy_until
+                self._busy_until[user2] = busy_until
+        return pairs
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'users': len(self._profiles),
+                'busy': len(self._busy_until),
+                'buckets': len(self._buckets),
+            }
+
+def bucket_pair_weight(key1, key2):
+    """Структурный вес пары корзин: одинаковые уровень и возраст ценнее соседних"""
+    return (2 if key1[2] == key2[2] else 1) + (1 if key1[3] == key2[3] else 0)
+
+def pair_by_rating(side1, side2, known_pairs, lookback=8):
+    """Жадно сводит пользователей двух корзин с ближайшими рейтингами
+
+    side1, side2 - отсортированные списки (rating, user_id); side2=None
+    означает пары внутри одной корзины. Уже встречавшиеся пары пропускаются.
+    """
+    if side2 is None:
+        merged = [(rating, 0, user_id) for rating, user_id in side1]
+    else:
+        merged = sorted([(rating, 1, user_id) for rating, user_id in side1] +
+                        [(rating, 2, user_id) for rating, user_id in side2])
+    stack, pairs = [], []
+    for rating, side, user_id in merged:
+        for i in range(len(stack) - 1, max(-1, len(stack) - 1 - lookback), -1):
+            _, other_side, other_id = stack[i]
+            if (side == 0 or other_side != side) and frozenset((user_id, other_id)) not in known_pairs:
+                del stack[i]
+                pairs.append((other_id, user_id))
+                break
+        else:
+            stack.append((rating, side, user_id))
+    return pairs
+
+match_index = MatchIndex()
+if MATCH_INDEX_ENABLED:
     try:
-        avg_rating = db.execute(
-            "SELECT AVG((question1 + question2 + question3) / 3.0) FROM feedback WHERE to_user = ?",
-            (user_id,)
-        )[0][0]
-        
-        if avg_rating is not None:  # Явная проверка на None
-            db.execute(
-                "UPDATE users SET rating = ? WHERE id = ?",
-                (round(avg_rating, 2), user_id),
-                commit=True
-            )
+        match_index.load(db)
     except Exception as e:
-        logger.error(f"Ошибка обновления рейтинга для {user_id}: {e}")
+        logger.error(f"Не удалось загрузить индекс мэтчинга, используем SQL: {traceback.format_exc()}")
+
+# Варианты ответов на шаги анкеты с кнопками
+REGISTRATION_OPTIONS = {
+    'age': AGE_OPTIONS,
+    'kazakh_level': LEVELS,
+    'gender': GENDERS,
+    'preferred_gender': GENDERS + [ANY_GENDER],
+}
 
-def ask_question(chat_id, question, options):
-    """Отправляет вопрос с inline-кнопками"""
-    markup = types.InlineKeyboardMarkup()
-    for option in options:
-        markup.add(types.InlineKeyboardButton(option, callback_data=option))
-    bot.send_message(chat_id, question, reply_markup=markup)
+def inline_keyboard_json(step, options):
+    """JSON inline-клавиатуры: кнопка в ряд, callback_data вида <шаг>:<вариант>"""
+    rows = [[{'text': option, 'callback_data': f"{step}:{option}"}] for option in options]
+    return json.dumps({'inline_keyboard': rows}, ensure_ascii=False)
+
+# Статические клавиатуры сериализуются один раз при импорте;
+# строку в reply_markup telebot передаёт в Bot API как есть
+KEYBOARDS = {step: inline_keyboard_json(step, options) for step, options in REGISTRATION_OPTIONS.items()}
+FORCE_REPLY = json.dumps({'force_reply': True, 'selective': False})
+
+def ask_question(chat_id, question, step):
+    """Отправляет вопрос шага анкеты с готовой клавиатурой"""
+    outbox.send_message(chat_id, question, reply_markup=KEYBOARDS[step])
 
 # Объединённый обработчик start/restart
 def start_registration(message, is_restart=False):
     """Общая функция для начала регистрации"""
     try:
         chat_id = message.chat.id
-        logger.info(f"Starting registration for user {chat_id}, is_restart: {is_restart}")
+        handler_log.info("Starting registration for user %s, is_restart: %s", chat_id, is_restart)
         
         # Более надежная очистка данных при рестарте
         if is_restart:
             try:
-                logger.info(f"Cleaning up data for restart user {chat_id}")
-                with db.lock:
-                    db.execute("DELETE FROM users WHERE id = ?", (chat_id,), commit=True)
-                    db.execute("DELETE FROM matches WHERE user1 = ? OR user2 = ?", 
-                             (chat_id, chat_id), commit=True)
-                    # Очищаем кэшированные данные
-                    user_data.pop(chat_id, None)
-                    user_state.pop(chat_id, None)
-                logger.info(f"Data cleanup completed for user {chat_id}")
+                handler_log.info("Cleaning up data for restart user %s", chat_id)
+                def cleanup(conn):
+                    partners = db.run(conn, 'match_partner_ids', (chat_id,))
+                    db.run(conn, 'delete_user', (chat_id,))
+                    db.run(conn, 'delete_user_matches', (chat_id, chat_id))
+                    return [row['user2'] for row in partners]
+                partners = db.transaction(cleanup)
+                # Очищаем кэшированные данные
+                user_data.delete(chat_id)
+                user_state.delete(chat_id)
+                match_index.remove(chat_id)
+                for partner_id in partners:
+                    match_index.release(partner_id)
+                handler_log.info("Data cleanup completed for user %s", chat_id)
             except Exception as e:
                 logger.error(f"Ошибка очистки данных при restart: {traceback.format_exc()}")
                 raise
 
         # Проверяем username более надежно
         username = getattr(message.from_user, 'username', None)
-        logger.info(f"Username for user {chat_id}: {username}")
+        handler_log.debug("Username for user %s: %s", chat_id, username)
         if not username or not username.strip():
             msg = ("🔁 Анкета сброшена. Введите ваш Telegram username (должен начинаться с @):" 
                   if is_restart else "Введите ваш Telegram username (должен начинаться с @):")
-            sent_msg = bot.send_message(chat_id, msg)
-            bot.register_next_step_handler(sent_msg, get_username)
+            user_data.set(chat_id, {'step': 'username'})
+            outbox.send_message(chat_id, msg)
             return
 
         # Инициализация/сброс данных пользователя
-        user_data[chat_id] = {'telegram_username': username.strip('@')}
-        logger.info(f"User data initialized for {chat_id}: {user_data[chat_id]}")
+        profile = {'step': 'name', 'telegram_username': username.strip('@')}
+        user_data.set(chat_id, profile)
+        handler_log.info("User data initialized for %s", chat_id)
         
         greeting = "🔁 Анкета сброшена. Давайте начнем заново!\n\n" if is_restart else ""
-        sent_msg = bot.send_message(
+        outbox.send_message(
             chat_id,
             f"{greeting}Сәлем! 👋 Добро пожаловать в QazaqTalk!\n\nВведите ваше имя:"
         )
-        bot.register_next_step_handler(sent_msg, get_name)
-        logger.info(f"Registration flow started for user {chat_id}")
+        handler_log.info("Registration flow started for user %s", chat_id)
         
     except Exception as e:
         logger.error(f"Ошибка в {'/restart' if is_restart else '/start'}: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Произошла ошибка. Попробуйте снова через /start")
+        outbox.send_message(chat_id, "⚠️ Произошла ошибка. Попробуйте снова через /start")
 
-@bot.message_handler(commands=['echo'])
 def echo_command(message):
     """Простая команда echo для тестирования"""
-    logger.info(f"Echo command received from {message.chat.id}: {message.text}")
-    bot.send_message(message.chat.id, f"Echo: {message.text}")
+    handler_log.info("Echo command received from %s: %s", message.chat.id, message.text)
+    outbox.send_message(message.chat.id, f"Echo: {message.text}")
 
-@bot.message_handler(commands=['test'])
 def test_command(message):
     """Тестовая команда для проверки работы бота"""
-    logger.info(f"Test command received from {message.chat.id}")
-    bot.send_message(message.chat.id, "✅ Бот работает! Команда /test получена.")
+    handler_log.info("Test command received from %s", message.chat.id)
+    outbox.send_message(message.chat.id, "✅ Бот работает! Команда /test получена.")
 
-@bot.message_handler(commands=['start'])
 def handle_start(message):
     """Обработчик команды /start"""
-    logger.info(f"Start command received from {message.chat.id}")
+    handler_log.info("Start command received from %s", message.chat.id)
     start_registration(message)
 
-@bot.message_handler(commands=['restart'])
 def handle_restart(message):
     """Обработчик команды /restart"""
-    logger.info(f"Restart command received from {message.chat.id}")
+    handler_log.info("Restart command received from %s", message.chat.id)
     start_registration(message, is_restart=True)
 
-@bot.message_handler(commands=['guidebook'])
 def send_guidebook(message):
     """Улучшенный обработчик команды /guidebook"""
-    logger.info(f"Guidebook command received from {message.chat.id}")
+    handler_log.info("Guidebook command received from %s", message.chat.id)
     
     try:
         chat_id = message.chat.id
-        guidebook_path = os.path.join(os.path.dirname(__file__), 'guidebook.docx')
-        logger.info(f"Guidebook path: {guidebook_path}")
-        
-        # Проверяем доступность файла
-        if not os.path.exists(guidebook_path):
-            logger.warning(f"Файл гайдбука не найден: {guidebook_path}")
-            bot.send_message(
-                chat_id,
-                "📚 Гайдбук временно недоступен. Администратор уже уведомлен о проблеме."
-            )
-            return
 
-        # Проверяем размер файла
-        file_size = os.path.getsize(guidebook_path) / (1024 * 1024)  # в MB
-        logger.info(f"Guidebook file size: {file_size:.2f}MB")
-        if file_size > 50:  # Telegram ограничивает 50MB для ботов
-            logger.error(f"Файл гайдбука слишком большой: {file_size:.2f}MB")
-            bot.send_message(
-                chat_id,
-                "⚠️ Файл гайдбука слишком большой. Мы работаем над этим."
-            )
+        # Наличие и размер файла проверены при запуске (AssetRegistry)
+        guidebook = assets.get('guidebook.docx')
+        if guidebook is None:
+            if 'guidebook.docx' in assets.rejected:
+                logger.error(f"Файл гайдбука отклонён: {assets.rejected['guidebook.docx']}")
+                outbox.send_message(
+                    chat_id,
+                    "⚠️ Файл гайдбука слишком большой. Мы работаем над этим."
+                )
+            else:
+                logger.warning(f"Файл гайдбука не найден в {assets.directory}")
+                outbox.send_message(
+                    chat_id,
+                    "📚 Гайдбук временно недоступен. Администратор уже уведомлен о проблеме."
+                )
             return
 
-        # Отправляем файл с обработкой возможных ошибок
-        logger.info(f"Отправка гайдбука пользователю {chat_id}")
-        with open(guidebook_path, 'rb') as f:
-            bot.send_chat_action(chat_id, 'upload_document')
-            bot.send_document(
-                chat_id=chat_id,
-                document=f,
-                caption="📘 QazaqTalk Guidebook",
-                timeout=30,
-                visible_file_name="QazaqTalk_Guide.docx"  # Красивое имя файла
-            )
-        logger.info(f"Гайдбук успешно отправлен пользователю {chat_id}")
+        # Отправляем файл с обработкой возможных ошибок (повторно - по file_id)
+        handler_log.info("Отправка гайдбука пользователю %s", chat_id)
+        media_cache.send(
+            chat_id, guidebook, 'document',
+            caption="📘 QazaqTalk Guidebook",
+            upload_kwargs={
+                'timeout': 30,
+                'visible_file_name': "QazaqTalk_Guide.docx"  # Красивое имя файла
+            }
+        )
+        handler_log.info("Гайдбук успешно отправлен пользователю %s", chat_id)
             
     except Exception as e:
         logger.error(f"Ошибка отправки гайдбука: {traceback.format_exc()}")
-        bot.send_message(
+        outbox.send_message(
             chat_id,
             "⚠️ Произошла непредвиденная ошибка при отправке гайдбука. Попробуйте позже."
         )
 
-@bot.message_handler(func=lambda message: not message.text.strip().startswith('/'))
 def handle_all_messages(message):
     """Обработка всех остальных сообщений"""
-    bot.send_message(message.chat.id, "Спасибо за сообщение! Пожалуйста, используйте /start для начала работы.")
+    outbox.send_message(message.chat.id, "Спасибо за сообщение! Пожалуйста, используйте /start для начала работы.")
 
 def get_username(message):
     """Получение username пользователя"""
     try:
-        user_data[message.chat.id] = {'telegram_username': message.text.strip()}
-        bot.send_message(message.chat.id, "Введите ваше имя:")
-        bot.register_next_step_handler(message, get_name)
+        user_data.set(message.chat.id, {'step': 'name', 'telegram_username': message.text.strip()})
+        outbox.send_message(message.chat.id, "Введите ваше имя:")
     except Exception as e:
         logger.error(f"Ошибка получения username: {traceback.format_exc()}")
-        bot.send_message(message.chat.id, "⚠️ Ошибка. Попробуйте /start")
+        outbox.send_message(message.chat.id, "⚠️ Ошибка. Попробуйте /start")
 
 def get_name(message):
     """Получение имени пользователя"""
     try:
-        user_data[message.chat.id]['name'] = message.text.strip()
+        profile = user_data.get(message.chat.id)
+        profile['name'] = message.text.strip()
+        profile['step'] = 'age'
+        user_data.set(message.chat.id, profile)
         ask_question(
             message.chat.id,
             "Сколько вам лет?",
-            ["10-13", "14-16", "17-20", "21-25", "30-35", "35+"]
+            'age'
         )
     except Exception as e:
         logger.error(f"Ошибка получения имени: {traceback.format_exc()}")
-        bot.send_message(message.chat.id, "⚠️ Ошибка. Попробуйте /start")
+        outbox.send_message(message.chat.id, "⚠️ Ошибка. Попробуйте /start")
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_callback(call):
-    """Обработчик inline-кнопок"""
+# Шаги анкеты с кнопками: шаг -> (допустимые ответы, следующий шаг)
+REGISTRATION_CHOICES = {
+    'age': (frozenset(REGISTRATION_OPTIONS['age']), 'kazakh_level'),
+    'kazakh_level': (frozenset(REGISTRATION_OPTIONS['kazakh_level']), 'gender'),
+    'gender': (frozenset(REGISTRATION_OPTIONS['gender']), 'preferred_gender'),
+    'preferred_gender': (frozenset(REGISTRATION_OPTIONS['preferred_gender']), None),
+}
+
+# Вопрос, который задаётся при переходе на шаг
+REGISTRATION_QUESTIONS = {
+    'kazakh_level': "Ваш уровень казахского?",
+    'gender': "Ваш пол?",
+    'preferred_gender': "С кем хотите практиковаться?",
+}
+
+def handle_callback(call, step, value):
+    """Ответ на вопрос анкеты (callback_data вида <шаг>:<вариант>)"""
     try:
         chat_id = call.message.chat.id
-        data = call.data
 
-        if 'age' not in user_data.get(chat_id, {}):
-            user_data[chat_id]['age'] = data
-            ask_question(chat_id, "Ваш уровень казахского?", 
-                        ["Начинающий", "Средний", "Продвинутый", "Носитель"])
-        
-        elif 'kazakh_level' not in user_data.get(chat_id, {}):
-            user_data[chat_id]['kazakh_level'] = data
-            ask_question(chat_id, "Ваш пол?", ["Мужской", "Женский"])
-        
-        elif 'gender' not in user_data.get(chat_id, {}):
-            user_data[chat_id]['gender'] = data
-            ask_question(chat_id, "С кем хотите практиковаться?", 
-                        ["Мужской", "Женский", "Не важно"])
-        
-        elif 'preferred_gender' not in user_data.get(chat_id, {}):
-            user_data[chat_id]['preferred_gender'] = data
-            save_to_db(chat_id)
+        profile = user_data.get(chat_id)
+        if profile is None:
+            outbox.send_message(chat_id, "⚠️ Сессия устарела. Начните заново через /start")
+            return
+        options, next_step = REGISTRATION_CHOICES[step]
+        if profile.get('step') != step or value not in options:
+            handler_log.info("Устаревшая кнопка %s от %s", step, chat_id)
+            return
+
+        profile[step] = value
+        if next_step is None:
+            del profile['step']
+            save_to_db(chat_id, profile)
+            return
+        profile['step'] = next_step
+        user_data.set(chat_id, profile)
+        ask_question(chat_id, REGISTRATION_QUESTIONS[next_step], next_step)
 
     except Exception as e:
         logger.error(f"Ошибка обработки callback: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Ошибка. Попробуйте /start")
+        outbox.send_message(chat_id, "⚠️ Ошибка. Попробуйте /start")
 
-def save_to_db(chat_id):
-    """Сохраняет данные пользователя в БД"""
+def save_to_db(chat_id, user):
+    """Сохраняет анкету пользователя в БД и завершает регистрацию"""
     try:
-        user = user_data[chat_id]
-        db.execute(
-            """INSERT OR REPLACE INTO users 
-            (id, name, age, kazakh_level, gender, preferred_gender, telegram_username) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (chat_id, user['name'], user['age'], user['kazakh_level'], 
-             user['gender'], user['preferred_gender'], user['telegram_username']),
-            commit=True
+        db.query(
+            'upsert_user',
+            (chat_id, user['name'], user['age'], user['kazakh_level'],
+             user['gender'], user['preferred_gender'], user['telegram_username'])
         )
+        user_data.delete(chat_id)
+        match_index.add(dict(user, id=chat_id), get_average_feedback(chat_id))
         find_match(chat_id)
     except Exception as e:
         logger.error(f"Ошибка сохранения в БД: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Ошибка сохранения. Попробуйте /start")
+        outbox.send_message(chat_id, "⚠️ Ошибка сохранения. Попробуйте /start")
 
 # --- Система мэтчинга ---
+def find_candidates_sql(current_user, current_rating):
+    """Подбор кандидатов запросом к БД (без индекса в памяти)"""
+    now = int(time.time())
+    return db.query('match_candidates', (
+        current_user['id'], now, current_user['gender'],
+        current_user['preferred_gender'], current_rating))
+
+def send_match_notification(chat_id, partner):
+    """Сообщает пользователю о найденном собеседнике"""
+    outbox.send_message(
+        chat_id,
+        f"🎉 Вы совпали с @{partner['telegram_username']}!\n"
+        f"👤 Имя: {partner['name']}\n"
+        f"📅 Возраст: {partner['age']}\n"
+        f"⚧ Пол: {partner['gender']}\n"
+        f"🗣 Уровень: {partner['kazakh_level']}"
+    )
+
+def claim_pair(conn, user_id, partner_id, now):
+    """Создаёт пару и оба запроса отзыва в текущей транзакции; False - кто-то уже занят"""
+    review_time = now + MATCH_DURATION
+    if not db.run(conn, 'claim_match', (user_id, partner_id, now, review_time)):
+        return False
+    db.run(conn, 'insert_match', (partner_id, user_id, now, review_time))
+    db.run(conn, 'insert_review', (user_id, partner_id, review_time))
+    db.run(conn, 'insert_review', (partner_id, user_id, review_time))
+    return True
+
+def match_candidates(current_user, current_rating, past_partners, attempts=5):
+    """Кандидаты в порядке предпочтения; следующий нужен, если предыдущего уже заняли"""
+    if not match_index.ready:
+        yield from find_candidates_sql(current_user, current_rating)
+        return
+    exclude = set(past_partners)
+    for _ in range(attempts):
+        candidate = match_index.find(current_user, current_rating, exclude=exclude)
+        if candidate is None:
+            return
+        yield candidate
+        exclude.add(candidate['id'])
+
 def find_match(chat_id):
     
     """Поиск совместимого собеседника"""
     try:
-        logger.info(f"Поиск пары для {chat_id}")
+        handler_log.info("Поиск пары для %s", chat_id)
         
         # Проверка активных совпадений
-        active_matches = db.execute(
-            "SELECT user2, match_time FROM matches WHERE user1 = ?",
-            (chat_id,)
-        )
+        active_match = db.query('active_match', (chat_id, int(time.time())))
         
-        if active_matches:
-            match_time = datetime.fromisoformat(active_matches[0]['match_time'])
-            if datetime.now(timezone.utc) < match_time + timedelta(hours=48):
-                bot.send_message(chat_id, "⏳ У вас уже есть активная пара. Попробуйте позже.")
-                return
+        if active_match:
+            outbox.send_message(chat_id, "⏳ У вас уже есть активная пара. Попробуйте позже.")
+            return
 
         # Поиск совместимых пользователей
-        current_user = db.execute(
-            "SELECT * FROM users WHERE id = ?", 
-            (chat_id,)
-        )[0]
+        current_user = db.query('user_by_id', (chat_id,))
 
         if not current_user:
-                bot.send_message(chat_id, "❌ Ваш профиль не найден. Пожалуйста, пройдите регистрацию снова.")
+                outbox.send_message(chat_id, "❌ Ваш профиль не найден. Пожалуйста, пройдите регистрацию снова.")
                 return
         
-        exclude_users = {row['user1'] for row in db.execute(
-            "SELECT user1 FROM matches"
-        )}.union({chat_id})
-
         # Получаем средний рейтинг текущего пользователя
         current_rating = get_average_feedback(chat_id) or 3.0  # 3.0 - дефолтный рейтинг
         
         # Исключаем пользователей из past_matches
-        exclude_users |= {row['user2'] for row in db.execute(
-            "SELECT user2 FROM past_matches WHERE user1 = ?",
-            (chat_id,)
-        )}
-        
-        potential_matches = db.execute(
-    """SELECT 
-        u.id, u.name, u.age, u.kazakh_level, 
-        u.gender, u.preferred_gender, u.telegram_username,
-        COALESCE(f.avg_rating, 3.0) as rating
-    FROM users u
-    LEFT JOIN (
-        SELECT 
-            to_user, 
-            (AVG(question1) + AVG(question2) + AVG(question3)) / 3.0 as avg_rating
-        FROM feedback 
-        GROUP BY to_user
-    ) f ON u.id = f.to_user
-    WHERE u.id NOT IN ({}) 
-    AND u.preferred_gender IN (?, 'Не важно')
-    AND u.gender IN (?, 'Не важно')
-    ORDER BY ABS(COALESCE(f.avg_rating, 3.0) - ?) ASC
-    LIMIT 50""".format(','.join('?'*len(exclude_users))),
-    [*exclude_users, current_user['gender'], current_user['preferred_gender'], current_rating]
-)
-        for match in potential_matches:
+        past_partners = {row['user2'] for row in db.query('past_partner_ids', (chat_id,))}
+
+        for match in match_candidates(current_user, current_rating, past_partners):
             if (level_match(current_user['kazakh_level'], match['kazakh_level']) and 
                age_overlap(current_user['age'], match['age'])):
                 
-                # Создаем пару
-                match_time = datetime.now(timezone.utc).isoformat()
-                db.execute(
-                    "INSERT INTO matches (user1, user2, match_time) VALUES (?, ?, ?)",
-                    (chat_id, match['id'], match_time),
-                    commit=True
-                )
-                db.execute(
-                    "INSERT INTO matches (user1, user2, match_time) VALUES (?, ?, ?)",
-                    (match['id'], chat_id, match_time),
-                    commit=True
-                )
+                # Создаем пару и запросы отзыва одной транзакцией; если кандидата
+                # успели занять параллельно, пробуем следующего
+                now = int(time.time())
+                if not db.transaction(lambda conn: claim_pair(conn, chat_id, match['id'], now)):
+                    continue
+                busy_until = now + MATCH_DURATION
+                match_index.mark_busy(chat_id, busy_until)
+                match_index.mark_busy(match['id'], busy_until)
                 
                 # Отправляем уведомления
-                bot.send_message(
-                    chat_id,
-                    f"🎉 Вы совпали с @{match['telegram_username']}!\n"
-                    f"👤 Имя: {match['name']}\n"
-                    f"📅 Возраст: {match['age']}\n"
-                    f"⚧ Пол: {match['gender']}\n"
-                    f"🗣 Уровень: {match['kazakh_level']}"
-                )
-                
-                bot.send_message(
-                    match['id'],
-                    f"🎉 Вы совпали с @{current_user['telegram_username']}!\n"
-                    f"👤 Имя: {current_user['name']}\n"
-                    f"📅 Возраст: {current_user['age']}\n"
-                    f"⚧ Пол: {current_user['gender']}\n"
-                    f"🗣 Уровень: {current_user['kazakh_level']}"
-                )
+                send_match_notification(chat_id, match)
+                send_match_notification(match['id'], current_user)
                 
-                # Планируем отзыв
-                schedule_review(chat_id, match['id'])  # Для первого пользователя
-                schedule_review(match['id'], chat_id)  # Для второго пользователя
+                # Планируем отзыв (записи в review_queue уже созданы в транзакции)
+                review_scheduler.schedule(chat_id, match['id'], busy_until)
+                review_scheduler.schedule(match['id'], chat_id, busy_until)
                 return
 
-        bot.send_message(chat_id, "😕 Пока нет подходящих пар. Попробуйте позже.")
+        outbox.send_message(chat_id, "😕 Пока нет подходящих пар. Попробуйте позже.")
 
     except Exception as e:
         logger.error(f"Ошибка поиска пары: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Ошибка поиска пары. Попробуйте позже.")
+        outbox.send_message(chat_id, "⚠️ Ошибка поиска пары. Попробуйте позже.")
+
+# --- Пакетный мэтчинг ---
+BATCH_MATCH_INTERVAL = int(os.getenv('BATCH_MATCH_INTERVAL', 300))
+
+def run_batch_matching():
+    """Один проход пакетного мэтчинга по всем ожидающим пользователям"""
+    started = time.monotonic()
+    known_pairs = {frozenset((row['user1'], row['user2'])) for row in db.query('known_pairs')}
+    now = int(time.time())
+    pairs = match_index.plan_batch(known_pairs, now + MATCH_DURATION)
+    if not pairs:
+        return 0
+
+    review_time = now + MATCH_DURATION
+
+    def write_pairs(conn):
+        claimed, free = [], []
+        for user, partner in pairs:
+            if claim_pair(conn, user['id'], partner['id'], now):
+                claimed.append((user, partner))
+                continue
+            # Кого-то из двоих успел занять параллельный find_match: свободного возвращаем в пул
+            for user_id in (user['id'], partner['id']):
+                if db.run(conn, 'active_match', (user_id, now)) is None:
+                    free.append(user_id)
+        return claimed, free
 
-# --- Система отзывов ---
-def schedule_review(chat_id1, chat_id2):
-    """Планирует отправку запроса отзыва через 48 часов"""
     try:
-        review_time = (datetime.now(timezone.utc) + timedelta(hours=48)).isoformat()
-        db.execute(
-            "INSERT INTO review_queue (chat_id1, chat_id2, send_time) VALUES (?, ?, ?)",
-            (chat_id1, chat_id2, review_time),
-            commit=True
-        )
-    except Exception as e:
-        logger.error(f"Ошибка планирования отзыва: {traceback.format_exc()}")
+        pairs, free = db.transaction(write_pairs)
+    except Exception:
+        for user, partner in pairs:
+            match_index.release(user['id'])
+            match_index.release(partner['id'])
+        raise
+    for user_id in free:
+        match_index.release(user_id)
+    if not pairs:
+        return 0
 
-def schedule_review_check():
-    """Фоновая проверка очереди отзывов"""
+    for user, partner in pairs:
+        review_scheduler.schedule(user['id'], partner['id'], review_time)
+        review_scheduler.schedule(partner['id'], user['id'], review_time)
+        send_match_notification(user['id'], partner)
+        send_match_notification(partner['id'], user)
+    logger.info(f"Пакетный мэтчинг: {len(pairs)} пар за {time.monotonic() - started:.2f}с")
+    return len(pairs)
+
+def schedule_batch_matching():
+    """Фоновый периодический пакетный мэтчинг"""
     while True:
+        time.sleep(BATCH_MATCH_INTERVAL)
         try:
-            now = datetime.now(timezone.utc)
-            reviews = db.execute(
-    "SELECT chat_id1, chat_id2, send_time FROM review_queue "
-    "WHERE send_time <= ? ORDER BY send_time LIMIT 100",
-    (now.isoformat(),)
-)
-            
-            for review in reviews:
-                if datetime.fromisoformat(review['send_time']) <= now:
-                    send_review_request(review['chat_id1'], review['chat_id2'])
-                    db.execute(
-                        "DELETE FROM review_queue WHERE chat_id1 = ? AND chat_id2 = ?",
-                        (review['chat_id1'], review['chat_id2']),
-                        commit=True
-                    )
-            
-            time.sleep(60)
+            if match_index.ready:
+                run_batch_matching()
+        except Exception as e:
+            logger.error(f"Ошибка пакетного мэтчинга: {traceback.format_exc()}")
+
+# --- Завершение пар ---
+MATCH_SWEEP_INTERVAL = int(os.getenv('MATCH_SWEEP_INTERVAL', 600))
+
+def expire_matches(now=None):
+    """Переносит закончившиеся пары из matches в past_matches одной транзакцией"""
+    now = int(time.time()) if now is None else now
+
+    def expire(conn):
+        db.run(conn, 'archive_expired_matches', (now,))
+        return db.run(conn, 'delete_expired_matches', (now,))
+
+    return db.transaction(expire)
+
+def sweep_matches():
+    """Фоновое завершение пар: в matches остаются только активные"""
+    while True:
+        try:
+            expired = expire_matches()
+            if expired:
+                logger.info(f"Завершено пар: {expired // 2}")
         except Exception as e:
-            logger.error(f"Ошибка проверки отзывов: {traceback.format_exc()}")
-            time.sleep(300)
+            logger.error(f"Ошибка завершения пар: {traceback.format_exc()}")
+        time.sleep(MATCH_SWEEP_INTERVAL)
+
+# --- Система отзывов ---
+class ReviewScheduler:
+    """Планировщик запросов отзыва на min-куче
+
+    Куча восстанавливается из review_queue при старте. Поток спит ровно до
+    ближайшего срока и просыпается раньше, если добавлен более ранний отзыв.
+    Наступившие отзывы забираются из БД пачкой одной транзакцией.
+    """
+
+    def __init__(self, batch_size=100, retry_delay=60):
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self._heap = []  # (send_ts, chat_id1, chat_id2)
+        self._cond = threading.Condition()
+        self.stats = {'dispatched': 0, 'batches': 0, 'failed_batches': 0,
+                      'last_lag_s': 0.0, 'max_lag_s': 0.0}
+
+    def load(self, database):
+        """Восстанавливает кучу из таблицы review_queue
+
+        Запросы, добавленные через schedule() до загрузки, остаются в куче.
+        """
+        rows = database.query('pending_reviews')
+        with self._cond:
+            loaded = {(row['send_ts'], row['chat_id1'], row['chat_id2']) for row in rows}
+            self._heap = list(loaded.union(self._heap))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        logger.info(f"Очередь отзывов загружена: {len(rows)} запросов")
+
+    def schedule(self, chat_id1, chat_id2, send_ts):
+        """Добавляет запрос в кучу (строка в review_queue уже записана)"""
+        with self._cond:
+            heapq.heappush(self._heap, (send_ts, chat_id1, chat_id2))
+            if self._heap[0][0] == send_ts:
+                self._cond.notify()
+
+    def _wait_for_due(self):
+        """Ждёт наступления ближайшего срока и снимает с кучи пачку готовых запросов"""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                        due.append(heapq.heappop(self._heap))
+                    return due
+                # Ограничиваем ожидание на случай перевода системных часов
+                timeout = min(self._heap[0][0] - now, 3600) if self._heap else 3600
+                self._cond.wait(timeout)
+
+    def _dispatch(self, due):
+        """Забирает пачку из review_queue и рассылает запросы отзыва"""
+        def claim(conn):
+            # Устаревшие записи кучи (отзыв перенесён на более позднее время) не забираются
+            return [item for item in due if db.run(conn, 'claim_review', (item[1], item[2], item[0]))]
+
+        claimed = db.transaction(claim)
+        now = time.time()
+        for send_ts, chat_id1, chat_id2 in claimed:
+            send_review_request(chat_id1, chat_id2)
+            lag = now - send_ts
+            self.stats['last_lag_s'] = round(lag, 3)
+            self.stats['max_lag_s'] = round(max(self.stats['max_lag_s'], lag), 3)
+        self.stats['dispatched'] += len(claimed)
+        self.stats['batches'] += 1
+
+    def run(self):
+        """Основной цикл планировщика (в фоновом потоке)"""
+        while True:
+            due = self._wait_for_due()
+            try:
+                self._dispatch(due)
+            except Exception as e:
+                logger.error(f"Ошибка отправки пачки отзывов: {traceback.format_exc()}")
+                self.stats['failed_batches'] += 1
+                retry_at = int(time.time()) + self.retry_delay
+                for _, chat_id1, chat_id2 in due:
+                    self.schedule(chat_id1, chat_id2, retry_at)
+
+    def snapshot(self):
+        with self._cond:
+            pending = len(self._heap)
+            next_due = self._heap[0][0] if self._heap else None
+        return dict(self.stats, pending=pending, next_due=next_due)
+
+review_scheduler = ReviewScheduler()
+
+def schedule_review_check():
+    """Фоновая рассылка запросов отзыва по расписанию"""
+    try:
+        review_scheduler.load(db)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки очереди отзывов: {traceback.format_exc()}")
+    review_scheduler.run()
 
 # Улучшенная send_review_request
 def send_review_request(chat_id, partner_id):
     """Отправляет запрос на отзыв"""
     try:
-        partner_info = db.execute(
-            "SELECT name, telegram_username FROM users WHERE id = ?", 
-            (partner_id,)
-        )
+        partner = db.query('user_contact', (partner_id,))
         
-        if not partner_info or len(partner_info) == 0:
+        if not partner:
             logger.error(f"Данные партнёра {partner_id} не найдены")
             return
-        partner = partner_info[0]
 
         message = (
             f"📝 *Время оставить отзыв о вашей практике с {partner['name']} (@{partner['telegram_username']})*\n\n"
@@ -581,54 +2189,47 @@ def send_review_request(chat_id, partner_id):
             "Если не общались - отправьте `0`"
         )
         
-        markup = types.ForceReply(selective=False)
-        msg = bot.send_message(
+        outbox.send_message(
             chat_id, 
             message, 
             parse_mode='Markdown',
-            reply_markup=markup
+            reply_markup=FORCE_REPLY
         )
         
-        user_state[chat_id] = {
+        user_state.set(chat_id, {
             'step': 'awaiting_feedback',
-            'partner_id': partner_id,
-            'message_id': msg.message_id  # Сохраняем ID сообщения для возможного редактирования
-        }
+            'partner_id': partner_id
+        })
     
     except Exception as e:
         logger.error(f"Ошибка отправки отзыва: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Не удалось отправить запрос отзыва")
+        outbox.send_message(chat_id, "⚠️ Не удалось отправить запрос отзыва")
 
-# Улучшенная process_feedback
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id, {}).get('step') == 'awaiting_feedback')
+# Улучшенная process_feedback (вызывается из handle_step_message)
 def process_feedback(message):
     """Обработка отзыва от пользователя"""
     try:
         chat_id = message.chat.id
-        state = user_state.get(chat_id, {})
+        state = user_state.get(chat_id) or {}
         
         if not state or 'partner_id' not in state:
-            bot.send_message(chat_id, "⚠️ Сессия устарела. Начните заново.")
+            outbox.send_message(chat_id, "⚠️ Сессия устарела. Начните заново.")
             return
 
         partner_id = state['partner_id']
 
-        is_valid_pair = db.execute(
-            "SELECT 1 FROM matches WHERE user1 = ? AND user2 = ?",
-            (chat_id, partner_id)
-        )
-        if not is_valid_pair or len(is_valid_pair) == 0:
-            bot.send_message(chat_id, "❌ Нельзя оставить отзыв этому пользователю")
-            if chat_id in user_state:
-                del user_state[chat_id]
+        is_valid_pair = db.query('pair_exists', (chat_id, partner_id))
+        if not is_valid_pair:
+            outbox.send_message(chat_id, "❌ Нельзя оставить отзыв этому пользователю")
+            user_state.delete(chat_id)
             return
         
         text = message.text.strip()
 
         # Обработка отмены
         if text == '0':
-            bot.send_message(chat_id, "✅ Спасибо, мы учтём что встреча не состоялась")
-            del user_state[chat_id]
+            outbox.send_message(chat_id, "✅ Спасибо, мы учтём что встреча не состоялась")
+            user_state.delete(chat_id)
             return
 
         # Валидация и парсинг
@@ -645,70 +2246,299 @@ def process_feedback(message):
             raise ValueError("Для низких оценок нужен комментарий")
 
         # Сохранение в БД
-        db.execute(
-    """INSERT INTO feedback 
-    (from_user, to_user, question1, question2, question3, comment, timestamp) 
-    VALUES (?, ?, ?, ?, ?, ?, ?)""",
-    (chat_id, partner_id, *scores, comment, datetime.now(timezone.utc).isoformat()),
-    commit=True
-)
-        update_user_rating(partner_id)
+        save_feedback(chat_id, partner_id, scores, comment)
 
         # Уведомление
-        bot.send_message(chat_id, "✅ Спасибо за ваш отзыв!")
+        outbox.send_message(chat_id, "✅ Спасибо за ваш отзыв!")
         
         # Очистка состояния
-        if chat_id in user_state:
-            del user_state[chat_id]
+        user_state.delete(chat_id)
 
     except ValueError as ve:
         logger.warning(f"Некорректный отзыв: {ve}")
-        bot.send_message(chat_id, f"⚠️ {ve}\nПожалуйста, используйте правильный формат")
+        outbox.send_message(chat_id, f"⚠️ {ve}\nПожалуйста, используйте правильный формат")
     except Exception as e:
         logger.error(f"Ошибка обработки отзыва: {traceback.format_exc()}")
-        bot.send_message(chat_id, "⚠️ Ошибка обработки. Попробуйте позже")
-        if chat_id in user_state:
-            del user_state[chat_id]
+        outbox.send_message(chat_id, "⚠️ Ошибка обработки. Попробуйте позже")
+        user_state.delete(chat_id)
+
+# --- Маршрутизация обновлений ---
+# telebot получает по одному обработчику на сообщения и на кнопки, а выбор
+# конкретного обработчика - поиск в словаре, а не перебор фильтров.
+
+# Команды: /<команда> -> обработчик
+COMMANDS = {
+    'start': handle_start,
+    'restart': handle_restart,
+    'guidebook': send_guidebook,
+    'echo': echo_command,
+    'test': test_command,
+}
+
+# Текстовые шаги диалога: шаг из хранилища состояния -> обработчик
+STEP_HANDLERS = {
+    'username': get_username,
+    'name': get_name,
+    'awaiting_feedback': process_feedback,
+}
+
+# Кнопки: префикс callback_data -> обработчик(call, префикс, значение)
+CALLBACK_HANDLERS = {step: handle_callback for step in REGISTRATION_CHOICES}
+
+def message_step(chat_id):
+    """Текущий текстовый шаг чата: сначала регистрация, затем отзыв"""
+    for store in (user_data, user_state):
+        state = store.get(chat_id)
+        if state is not None and state.get('step') in STEP_HANDLERS:
+            return state['step']
+    return None
+
+@bot.message_handler(func=lambda message: True)
+def route_message(message):
+    """Команда, ответ на текущий шаг диалога или общее сообщение"""
+    text = message.text or ''
+    if text.startswith('/'):
+        # "/start@QazaqTalkBot arg" -> "start"
+        command = (text[1:].split(maxsplit=1) or [''])[0].split('@', 1)[0]
+        handler = COMMANDS.get(command)
+        if handler is not None:
+            handler(message)
+        return
+    step = message_step(message.chat.id)
+    if step is not None:
+        STEP_HANDLERS[step](message)
+    elif text.strip():
+        handle_all_messages(message)
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    """Кнопка по префиксу callback_data"""
+    prefix, _, value = (call.data or '').partition(':')
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        logger.warning(f"Неизвестная кнопка: {call.data}")
+        return
+    handler(call, prefix, value)
 
 @app.route('/test')
 def test():
     return "Тест успешен!", 200
 
+def collect_metrics():
+    """Метрики подсистем бота"""
+    return {
+        'db': db.stats(),
+        'match_index': match_index.stats(),
+        'reviews': review_scheduler.snapshot(),
+        'updates': update_queue.snapshot(),
+        'outbox': outbox.snapshot(),
+        'media': media_cache.snapshot(),
+        'states': {store.kind: store.stats() for store in (user_data, user_state)},
+    }
+
+@app.route('/assets')
+def asset_registry():
+    """Статические файлы, загруженные при запуске"""
+    return jsonify(assets.snapshot())
+
+@app.route('/metrics')
+def metrics():
+    """Метрики подсистем бота"""
+    return jsonify(collect_metrics())
+
+# --- Очередь входящих обновлений ---
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv('UPDATE_ENQUEUE_TIMEOUT', 1.0))
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (для сохранения порядка внутри чата)"""
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None:
+        query = update.callback_query
+        return query.message.chat.id if query.message is not None else query.from_user.id
+    return update.update_id
+
+class UpdateQueue:
+    """Пул воркеров для обработки обновлений вне HTTP-запроса
+
+    Каждый воркер читает свою ограниченную очередь, а обновление попадает
+    в очередь по chat_id, поэтому обновления одного чата обрабатываются
+    строго по порядку. При переполнении очереди webhook отвечает 503, и
+    Telegram повторит доставку позже.
+    """
+
+    def __init__(self, process, workers=4, queue_size=1000):
+        self.process = process
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.stats = {'enqueued': 0, 'processed': 0, 'failed': 0, 'rejected': 0,
+                      'max_depth': 0, 'max_latency_s': 0.0}
+        self._threads = [
+            threading.Thread(target=self._worker, args=(q,), name=f'update-worker-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update, timeout=None):
+        """Ставит обновление в очередь своего чата; False - очередь переполнена"""
+        target = self._queues[hash(update_chat_id(update)) % len(self._queues)]
+        try:
+            target.put((time.monotonic(), update), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self.stats['rejected'] += 1
+            return False
+        with self._lock:
+            self.stats['enqueued'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], target.qsize())
+        return True
+
+    def _worker(self, updates):
+        while True:
+            try:
+                enqueued_at, update = updates.get(timeout=0.5)
+            except queue.Empty:
+                # Выходим только после остановки и когда очередь разобрана
+                if self._stopping.is_set():
+                    return
+                continue
+            log_context.chat_id = update_chat_id(update)
+            log_context.update_id = update.update_id
+            try:
+                self.process(update)
+                result = 'processed'
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {traceback.format_exc()}")
+                result = 'failed'
+            finally:
+                log_context.chat_id = log_context.update_id = None
+            latency = time.monotonic() - enqueued_at
+            with self._lock:
+                self.stats[result] += 1
+                self.stats['max_latency_s'] = round(max(self.stats['max_latency_s'], latency), 3)
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stop(self, timeout=30):
+        """Дообрабатывает уже принятые обновления и останавливает воркеров (не дольше timeout)"""
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        logger.info(f"Очередь обновлений остановлена, не обработано: {self.depth()}")
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['depth'] = [q.qsize() for q in self._queues]
+        return stats
+
+update_queue = UpdateQueue(lambda update: bot.process_new_updates([update]),
+                           workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE)
+atexit.register(update_queue.stop)
+
 # --- Webhook обработчики ---
-@app.route('/' + BOT_TOKEN, methods=['POST'])
-def webhook():
-    """Endpoint для обработки webhook-запросов от Telegram"""
-    logger.info(f"Webhook received: {request.headers.get('content-type')}")
-    
-    if request.headers.get('content-type') == 'application/json':
+# Типы обновлений, на которые подписан webhook (allowed_updates)
+ALLOWED_UPDATES = ('message', 'callback_query')
+
+# Вложенные сообщения, которые обработчики не читают: не строим для них объекты
+SKIPPED_MESSAGE_FIELDS = ('reply_to_message', 'external_reply', 'quote', 'pinned_message')
+
+def parse_update(body):
+    """Update из тела запроса или None, если тип обновления бот не обрабатывает
+
+    JSON разбирается один раз из байтов; объекты telebot строятся только
+    для поля подписанного типа, без тяжёлых вложенных сообщений.
+    """
+    data = json.loads(body)
+    for kind in ALLOWED_UPDATES:
+        payload = data.get(kind)
+        if payload is not None:
+            break
+    else:
+        return None
+    message = payload if kind == 'message' else payload.get('message')
+    if message is not None:
+        for field in SKIPPED_MESSAGE_FIELDS:
+            message.pop(field, None)
+    return types.Update.de_json({'update_id': data['update_id'], kind: payload})
+
+def accept_update(content_type, body):
+    """Принимает тело webhook-запроса в очередь; возвращает (ответ, статус, заголовки)"""
+    if content_type == 'application/json':
         try:
-            json_data = request.get_data().decode('utf-8')
-            logger.info(f"Webhook data: {json_data[:200]}...")  # Log first 200 chars
+            update = parse_update(body)
+            if update is None:
+                return '', 200, {}
             
-            update = types.Update.de_json(json_data)
-            logger.info(f"Update object created: {update}")
+            if not update_queue.submit(update, timeout=UPDATE_ENQUEUE_TIMEOUT):
+                webhook_log.warning("Очередь обновлений переполнена, просим Telegram повторить")
+                return 'Update queue is full', 503, {'Retry-After': '1'}
+            webhook_log.debug("Update %s queued", update.update_id)
             
-            bot.process_new_updates([update])
-            logger.info("Update processed successfully")
-            
-            return '', 200
+            return '', 200, {}
         except Exception as e:
-            logger.error(f"Error processing webhook: {traceback.format_exc()}")
-            return 'Error processing update', 500
+            webhook_log.error("Error processing webhook: %s", traceback.format_exc())
+            return 'Error processing update', 500, {}
     else:
-        logger.warning(f"Invalid content-type: {request.headers.get('content-type')}")
-        return 'Bad request', 400
+        webhook_log.warning("Invalid content-type: %s", content_type)
+        return 'Bad request', 400, {}
+
+@app.route('/' + BOT_TOKEN, methods=['POST'])
+def webhook():
+    """Endpoint для обработки webhook-запросов от Telegram"""
+    return accept_update(request.headers.get('content-type'), request.get_data())
 
 @app.route('/')
 def index():
     """Корневой endpoint для проверки работы сервера"""
     return 'QazaqTalk Bot is running!'
 
+def run_maintenance(command, *args):
+    """Служебные команды: python main2.py check-ratings | rebuild-ratings | migrate-db [файлы...]"""
+    if command == 'migrate-db':
+        # Однократный перевод старых файлов БД (например, local.db, database.db) на новую схему
+        for path in args or [DB_PATH]:
+            target = db if os.path.abspath(path) == os.path.abspath(DB_PATH) else Database(path)
+            target.add_missing_columns()
+            print(f"{path}: схема обновлена")
+            if target is not db:
+                target.close()
+        return 0
+    if command == 'check-ratings':
+        mismatched = db.check_ratings()
+        print(f"Расхождений в user_ratings: {len(mismatched)}")
+        for user_id in mismatched:
+            print(f"  - {user_id}")
+        return 1 if mismatched else 0
+    if command == 'rebuild-ratings':
+        print(f"Пересчитано агрегатов: {db.rebuild_ratings()}")
+        return 0
+    print(f"Неизвестная команда: {command}")
+    return 2
+
 # --- Запуск приложения ---
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_maintenance(*sys.argv[1:]))
+
+    # SIGTERM (остановка контейнера) превращаем в SystemExit: иначе процесс
+    # завершится без atexit, и принятые обновления, исходящие сообщения и
+    # отложенная запись состояния будут потеряны
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     try:
         # 1. Запуск фоновых процессов
         threading.Thread(target=schedule_review_check, daemon=True).start()
+        threading.Thread(target=sweep_states, daemon=True).start()
+        threading.Thread(target=sweep_matches, daemon=True).start()
+        if MATCH_INDEX_ENABLED and BATCH_MATCH_INTERVAL > 0:
+            threading.Thread(target=schedule_batch_matching, daemon=True).start()
         
         # 2. Настройка webhook
         logger.info("Настройка webhook...")
@@ -722,13 +2552,12 @@ if __name__ == '__main__':
             raise ValueError("WEBHOOK_URL не установлен")
         
         logger.info(f"Setting webhook to: {webhook_url}")
-        logger.info(f"BOT_TOKEN: {BOT_TOKEN[:10]}..." if BOT_TOKEN else "Not set!")
         logger.info(f"WEBHOOK_URL: {WEBHOOK_URL}")
             
         bot.set_webhook(
             url=webhook_url,
             max_connections=50,
-            allowed_updates=["message", "callback_query"]
+            allowed_updates=list(ALLOWED_UPDATES)
         )
         logger.info(f"Webhook установлен на: {webhook_url}")
         
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+# main2 читает настройки при импорте: фиктивный токен и временная БД вместо .env
+os.environ['BOT_TOKEN'] = '123456:test-token'
+os.environ['LOG_LEVEL'] = 'WARNING'
+# Лимиты Telegram к заглушке Bot API не относятся
+os.environ['OUTBOX_GLOBAL_RATE'] = os.environ['OUTBOX_CHAT_RATE'] = '10000'
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='qazaqtalk-'), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import main2
+
+TABLES = ('users', 'matches', 'past_matches', 'feedback', 'user_ratings', 'review_queue', 'conversation_state',
+          'media_cache')
+
+
+BOT_METHODS = ('send_message', 'send_document', 'send_chat_action', 'answer_callback_query')
+bot_calls = []
+
+
+@pytest.fixture(autouse=True, scope='session')
+def offline_bot():
+    """Вызовы Bot API не уходят в сеть, а записываются: (метод, args, kwargs).
+    Заглушки стоят всю сессию, и outbox дорабатывает очередь до их снятия."""
+    def recorder(method):
+        def call(*args, **kwargs):
+            bot_calls.append((method, args, kwargs))
+        return call
+
+    with pytest.MonkeyPatch.context() as patch:
+        for method in BOT_METHODS:
+            patch.setattr(main2.bot, method, recorder(method))
+        yield
+        main2.outbox.stop()
+
+
+@pytest.fixture
+def sent():
+    bot_calls.clear()
+    return bot_calls
+
+
+@pytest.fixture
+def db():
+    """Пустые таблицы и индекс мэтчинга перед тестом"""
+    def wipe(conn):
+        for table in TABLES:
+            conn.execute(f'DELETE FROM {table}')
+    main2.db.transaction(wipe)
+    main2.match_index.load(main2.db)
+    return main2.db
+
+
+def register(user_id, age='17-20', kazakh_level='Средний', gender='Мужской', preferred_gender='Не важно'):
+    """Сохраняет анкету так же, как save_to_db, но без поиска пары"""
+    profile = {'id': user_id, 'name': f'user{user_id}', 'age': age, 'kazakh_level': kazakh_level,
+               'gender': gender, 'preferred_gender': preferred_gender, 'telegram_username': f'user{user_id}'}
+    main2.db.query('upsert_user', (user_id, profile['name'], age, kazakh_level, gender,
+                                   preferred_gender, profile['telegram_username']))
+    main2.match_index.add(profile)
+    return profile
@@ -0,0 +1,71 @@
+import hashlib
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main2
+from main2 import AssetRegistry
+
+
+@pytest.fixture
+def directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(main2, 'ASSET_MAX_SIZE', 4096)
+    (tmp_path / 'small.pdf').write_bytes(b's' * 100)
+    (tmp_path / 'large.docx').write_bytes(b'l' * 2048)
+    (tmp_path / 'huge.mp3').write_bytes(b'h' * 5000)
+    (tmp_path / 'notes.txt').write_bytes(b'skip')
+    (tmp_path / 'folder.png').mkdir()
+    return tmp_path
+
+
+def test_scan_rejects_oversize_and_keeps_small_files_in_memory(directory):
+    registry = AssetRegistry(str(directory), memory_limit=1024)
+    registry.scan()
+    assert sorted(registry.assets) == ['large.docx', 'small.pdf']
+    assert list(registry.rejected) == ['huge.mp3']
+    small, large = registry.get('small.pdf'), registry.get('large.docx')
+    assert small.data == b's' * 100 and large.data is None
+    assert large.size == 2048 and large.sha256 == hashlib.sha256(b'l' * 2048).hexdigest()
+    assert registry.get('notes.txt') is None
+
+
+def test_open_reads_from_memory_or_disk(directory):
+    registry = AssetRegistry(str(directory), memory_limit=1024)
+    registry.scan()
+    with registry.open(registry.get('small.pdf')) as f:
+        assert f.name == 'small.pdf' and f.read() == b's' * 100
+    with registry.open(registry.get('large.docx')) as f:
+        assert f.read() == b'l' * 2048
+
+
+def test_rescan_replaces_the_registry(directory):
+    registry = AssetRegistry(str(directory), memory_limit=1024)
+    registry.scan()
+    (directory / 'small.pdf').unlink()
+    registry.scan()
+    assert registry.get('small.pdf') is None
+
+
+def test_assets_endpoint_lists_registry(directory, monkeypatch):
+    registry = AssetRegistry(str(directory), memory_limit=1024)
+    registry.scan()
+    monkeypatch.setattr(main2, 'assets', registry)
+    data = main2.app.test_client().get('/assets').get_json()
+    assert data['directory'] == str(directory)
+    assert [(a['name'], a['size'], a['in_memory']) for a in data['assets']] == \
+        [('large.docx', 2048, False), ('small.pdf', 100, True)]
+    assert data['rejected'] == {'huge.mp3': 'слишком большой: 0.00MB'}
+
+
+def test_guidebook_reports_rejected_file(directory, monkeypatch, sent):
+    (directory / 'guidebook.docx').write_bytes(b'g' * 5000)
+    registry = AssetRegistry(str(directory))
+    registry.scan()
+    monkeypatch.setattr(main2, 'assets', registry)
+    main2.send_guidebook(SimpleNamespace(chat=SimpleNamespace(id=7)))
+    deadline = time.monotonic() + 5
+    while not sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [(method, args[0]) for method, args, _ in sent] == [('send_message', 7)]
+    assert 'слишком большой' in sent[0][1][1]
@@ -0,0 +1,134 @@
+import sqlite3
+import threading
+
+import pytest
+
+from main2 import ConnectionPool, Database
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'))
+    yield pool
+    pool.close()
+
+
+def connection_in_thread(pool):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.get()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_connection_is_reused_within_a_thread(pool):
+    assert pool.get() is pool.get()
+    assert connection_in_thread(pool) is not pool.get()
+    assert pool.size() == 2
+
+
+def test_connections_of_finished_threads_are_closed(pool):
+    stale = connection_in_thread(pool)
+    connection_in_thread(pool)  # новое соединение чистит реестр
+    with pytest.raises(sqlite3.ProgrammingError):
+        stale.execute("SELECT 1")
+    assert pool.size() == 1
+
+
+def test_broken_connection_is_replaced(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), health_check_interval=0)
+    broken = pool.get()
+    broken.close()
+    conn = pool.get()
+    assert conn is not broken
+    assert conn.execute("SELECT 1").fetchone()[0] == 1
+    pool.close()
+
+
+def test_invalidate_and_close(pool):
+    conn = pool.get()
+    pool.invalidate()
+    assert pool.get() is not conn
+    pool.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        pool.get()
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'writer.db'))
+    yield database
+    database.close()
+
+
+def test_database_uses_wal(database):
+    assert database.execute("PRAGMA journal_mode")[0][0] == 'wal'
+
+
+def test_failed_write_does_not_roll_back_its_batch(database):
+    def insert(user_id):
+        return lambda conn: conn.execute("INSERT INTO users (id, name) VALUES (?, ?)", (user_id, 'x')).rowcount
+
+    def fail(conn):
+        conn.execute("INSERT INTO users (id, name) VALUES (99, 'x')")
+        raise ValueError('boom')
+
+    # Писатель занят, пока операции копятся в очереди, - они попадут в одну пачку
+    release = threading.Event()
+    blocker = database.writer.submit(lambda conn: release.wait(5))
+    futures = [database.writer.submit(insert(1)), database.writer.submit(fail), database.writer.submit(insert(2))]
+    release.set()
+    blocker.result()
+    assert futures[0].result() == 1 and futures[2].result() == 1
+    with pytest.raises(ValueError):
+        futures[1].result()
+    assert [row['id'] for row in database.execute("SELECT id FROM users ORDER BY id")] == [1, 2]
+
+
+def test_concurrent_writes_are_serialized(database):
+    def write(base):
+        for i in range(50):
+            database.execute("INSERT INTO users (id, name) VALUES (?, ?)", (base + i, 'x'), commit=True)
+
+    threads = [threading.Thread(target=write, args=(base,)) for base in range(0, 400, 50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert database.execute("SELECT COUNT(*) AS n FROM users")[0]['n'] == 400
+    assert database.stats()['writer']['errors'] == 0
+
+
+def test_readers_see_committed_data_while_writer_is_busy(database):
+    database.execute("INSERT INTO users (id, name) VALUES (1, 'x')", commit=True)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_write(conn):
+        conn.execute("INSERT INTO users (id, name) VALUES (2, 'y')")
+        started.set()
+        release.wait(5)
+
+    blocker = database.writer.submit(slow_write)
+    assert started.wait(5)
+    try:
+        # Писатель держит открытую транзакцию, чтение не ждёт и не видит незакоммиченное
+        assert [row['id'] for row in database.execute("SELECT id FROM users")] == [1]
+    finally:
+        release.set()
+    blocker.result()
+    assert database.execute("SELECT COUNT(*) AS n FROM users")[0]['n'] == 2
+
+
+def test_migration_converts_iso_past_matches(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE past_matches (user1 INTEGER, user2 INTEGER, match_time TEXT, PRIMARY KEY (user1, user2))")
+    conn.execute("INSERT INTO past_matches VALUES (1, 2, '2025-01-01T00:00:00+00:00')")
+    conn.commit()
+    conn.close()
+    database = Database(path)
+    try:
+        database.add_missing_columns()
+        assert database.execute("SELECT match_ts FROM past_matches")[0]['match_ts'] == 1735689600
+    finally:
+        database.close()
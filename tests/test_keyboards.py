@@ -0,0 +1,29 @@
+import json
+
+from telebot import types
+
+import main2
+
+
+def markup_like_before(step, options):
+    """Клавиатура, как её строил ask_question до кэша"""
+    markup = types.InlineKeyboardMarkup()
+    for option in options:
+        markup.add(types.InlineKeyboardButton(text=option, callback_data=f"{step}:{option}"))
+    return json.loads(markup.to_json())
+
+
+def test_cached_keyboards_match_telebot_markup():
+    for step, options in main2.REGISTRATION_OPTIONS.items():
+        assert json.loads(main2.KEYBOARDS[step]) == markup_like_before(step, options)
+
+
+def test_callback_data_fits_telegram_limit():
+    for keyboard in main2.KEYBOARDS.values():
+        for row in json.loads(keyboard)['inline_keyboard']:
+            for button in row:
+                assert len(button['callback_data'].encode('utf-8')) <= 64
+
+
+def test_force_reply_matches_telebot():
+    assert json.loads(main2.FORCE_REPLY) == json.loads(types.ForceReply(selective=False).to_json())
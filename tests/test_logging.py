@@ -0,0 +1,84 @@
+import atexit
+import io
+import json
+import logging
+import traceback
+
+import pytest
+
+import main2
+
+TOKEN = main2.BOT_TOKEN
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Логирование как при запуске, но в StringIO; возвращает функцию, которая
+    дожидается записи очереди и отдаёт строки лога как JSON"""
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    monkeypatch.setattr(main2, 'LOG_FORMAT', 'json')
+    monkeypatch.setattr(main2, 'LOG_LEVELS', 'handlers = WARNING, webhook=debug, sampled=INFO')
+    monkeypatch.setattr(main2, 'LOG_SAMPLE', 'sampled=0,kept=1')
+    stream = io.StringIO()
+    listener = main2.setup_logging(stream)
+
+    def lines():
+        # stop() дописывает всё, что уже в очереди
+        if listener._thread is not None:
+            listener.stop()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    yield lines
+    lines()
+    atexit.unregister(listener.stop)
+    root.handlers[:], root.level = saved_handlers, saved_level
+    for category in ('handlers', 'webhook', 'sampled'):
+        logging.getLogger(f'qazaqtalk.{category}').setLevel(logging.NOTSET)
+
+
+def test_parse_log_settings():
+    assert main2.parse_log_settings(' handlers = WARNING ,webhook=DEBUG,junk,') == \
+        {'handlers': 'WARNING', 'webhook': 'DEBUG'}
+    assert main2.parse_log_settings('') == {}
+
+
+def test_token_is_redacted_from_messages_tracebacks_and_telebot(pipeline):
+    url = f'https://api.telegram.org/bot{TOKEN}/sendMessage'
+    main2.logger.warning("Запрос к %s", url)
+    try:
+        raise ConnectionError(f'Max retries exceeded with url: {url}')
+    except ConnectionError:
+        main2.logger.exception("Ошибка запроса")
+        main2.logger.error(f"Ошибка: {traceback.format_exc()}")
+    logging.getLogger('TeleBot').error(f'Threaded polling exception: {url}')
+    lines = pipeline()
+    assert len(lines) == 4
+    for line in lines:
+        assert TOKEN not in line['msg'] and '<redacted>' in line['msg']
+    assert 'Traceback' in lines[1]['msg'] and 'Traceback' in lines[2]['msg']
+    assert lines[3]['logger'] == 'TeleBot'
+
+
+def test_text_format_is_redacted_too():
+    formatter = main2.RedactingFormatter('text', [TOKEN, None])
+    record = logging.LogRecord('qazaqtalk', logging.INFO, __file__, 1, 'token %s', (TOKEN,), None)
+    assert formatter.format(record).endswith('token <redacted>')
+
+
+def test_category_levels_and_sampling(pipeline):
+    main2.handler_log.info("отброшено уровнем")
+    main2.handler_log.warning("handlers %s", 1)
+    main2.webhook_log.debug("webhook %s", 2)
+    sampled = main2.logger.getChild('sampled')
+    sampled.info("отброшено прореживанием")
+    sampled.warning("sampled %s", 3)
+    main2.logger.getChild('kept').warning("kept %s", 4)
+    main2.log_context.chat_id = 42
+    try:
+        main2.handler_log.error("context")
+    finally:
+        main2.log_context.chat_id = None
+    lines = pipeline()
+    assert [line['msg'] for line in lines] == ['handlers 1', 'webhook 2', 'sampled 3', 'kept 4', 'context']
+    assert lines[-1]['chat_id'] == 42 and 'chat_id' not in lines[0]
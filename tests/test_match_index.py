@@ -0,0 +1,172 @@
+import random
+import time
+
+import main2
+from main2 import AGE_OPTIONS, ANY_GENDER, GENDERS, LEVELS, MatchIndex
+
+
+def profile(user_id, age='17-20', kazakh_level='Средний', gender='Мужской', preferred_gender=ANY_GENDER):
+    return {'id': user_id, 'name': f'user{user_id}', 'age': age, 'kazakh_level': kazakh_level,
+            'gender': gender, 'preferred_gender': preferred_gender, 'telegram_username': f'user{user_id}'}
+
+
+def compatible(a, b):
+    """Совместимость профилей без индекса - как её проверяла старая SQL-выборка"""
+    return (a['preferred_gender'] in (b['gender'], ANY_GENDER)
+            and b['preferred_gender'] in (a['gender'], ANY_GENDER)
+            and main2.level_match(a['kazakh_level'], b['kazakh_level'])
+            and main2.age_overlap(a['age'], b['age']))
+
+
+def test_find_returns_nearest_compatible_rating():
+    rng = random.Random(7)
+    index = MatchIndex()
+    users = {}
+    for user_id in range(1, 501):
+        users[user_id] = (profile(user_id, rng.choice(AGE_OPTIONS), rng.choice(LEVELS), rng.choice(GENDERS),
+                                  rng.choice(GENDERS + [ANY_GENDER])), round(rng.uniform(1, 5), 2))
+        index.add(*users[user_id])
+    for user_id in range(1, 51):
+        me, rating = users[user_id]
+        expected = [abs(other_rating - rating) for other_id, (other, other_rating) in users.items()
+                    if other_id != user_id and compatible(me, other)]
+        found = index.find(me, rating)
+        if not expected:
+            assert found is None
+            continue
+        assert compatible(me, found)
+        assert abs(found['rating'] - rating) == min(expected)
+
+
+def test_busy_and_excluded_users_are_skipped():
+    index = MatchIndex()
+    for user_id in (1, 2, 3):
+        index.add(profile(user_id), 3.0 + user_id / 10)
+    now = int(time.time())
+    index.mark_busy(2, now + 100)
+    assert index.find(profile(1), 3.1)['id'] == 3
+    assert index.find(profile(1), 3.1, exclude={3}) is None
+    index.release(2)
+    assert index.find(profile(1), 3.1)['id'] == 2
+
+
+def test_expired_busy_mark_frees_the_user():
+    index = MatchIndex()
+    index.add(profile(1))
+    index.add(profile(2))
+    index.mark_busy(2, int(time.time()) - 1)
+    assert index.find(profile(1), 3.0)['id'] == 2
+
+
+def test_reregistration_keeps_busy_state_and_restart_clears_it():
+    index = MatchIndex()
+    index.add(profile(1))
+    index.add(profile(2))
+    now = int(time.time())
+    index.mark_busy(2, now + 100)
+    index.add(profile(2, kazakh_level='Продвинутый'))
+    index.update_rating(2, 4.5)
+    assert index.is_busy(2, now)
+    assert index.find(profile(1), 3.0) is None
+    index.remove(2)
+    assert not index.is_busy(2, now)
+    assert index.stats()['users'] == 1
+
+
+def test_load_restores_busy_users(db):
+    now = int(time.time())
+    for user_id in (1, 2, 3):
+        main2.db.query('upsert_user', (user_id, f'user{user_id}', '17-20', 'Средний', 'Мужской', ANY_GENDER, 'x'))
+    main2.db.transaction(lambda conn: main2.claim_pair(conn, 1, 2, now))
+    index = MatchIndex()
+    index.load(main2.db)
+    assert index.ready
+    assert index.is_busy(1, now) and index.is_busy(2, now)
+    assert index.find(profile(3), 3.0) is None
+
+
+def test_load_reads_ratings_from_the_aggregate(db):
+    for user_id in (1, 2):
+        main2.db.query('upsert_user', (user_id, f'user{user_id}', '17-20', 'Средний', 'Мужской', ANY_GENDER, 'x'))
+    main2.save_feedback(2, 1, [5, 5, 5], None)
+    # Повторная регистрация перезаписывает строку users вместе с users.rating
+    main2.db.query('upsert_user', (1, 'user1', '17-20', 'Средний', 'Мужской', ANY_GENDER, 'x'))
+    index = MatchIndex()
+    index.load(main2.db)
+    assert index.find(profile(2), 5.0)['rating'] == 5.0
+    assert index.find(profile(1), 5.0)['rating'] == 3.0
+
+
+def random_index(rng, size):
+    index = MatchIndex()
+    users = {}
+    for user_id in range(1, size + 1):
+        users[user_id] = profile(user_id, rng.choice(AGE_OPTIONS), rng.choice(LEVELS), rng.choice(GENDERS),
+                                 rng.choice(GENDERS + [ANY_GENDER]))
+        index.add(users[user_id], round(rng.uniform(1, 5), 2))
+    return index, users
+
+
+def test_plan_batch_pairs_are_disjoint_compatible_and_new():
+    rng = random.Random(11)
+    index, users = random_index(rng, 400)
+    known_pairs = {frozenset(rng.sample(range(1, 401), 2)) for _ in range(300)}
+    busy_until = int(time.time()) + 100
+    pairs = index.plan_batch(known_pairs, busy_until)
+    assert len(pairs) > 50
+    seen = [user['id'] for pair in pairs for user in pair]
+    assert len(seen) == len(set(seen))
+    for user, partner in pairs:
+        assert compatible(users[user['id']], users[partner['id']])
+        assert frozenset((user['id'], partner['id'])) not in known_pairs
+    assert all(index.is_busy(user_id, busy_until - 1) for user_id in seen)
+    # Второй проход не трогает уже сведённых
+    assert not {user['id'] for pair in index.plan_batch(known_pairs, busy_until) for user in pair} & set(seen)
+
+
+def test_plan_batch_skips_known_pairs():
+    index = MatchIndex()
+    index.add(profile(1))
+    index.add(profile(2))
+    assert index.plan_batch({frozenset((1, 2))}, int(time.time()) + 100) == []
+    assert not index.is_busy(1, int(time.time()))
+
+
+def test_plan_batch_skips_users_changed_after_snapshot(monkeypatch):
+    index = MatchIndex()
+    for user_id in range(1, 7):
+        index.add(profile(user_id), 3.0 + user_id / 100)
+    now = int(time.time())
+    plan = main2.pair_by_rating
+
+    def pair_and_interfere(*args, **kwargs):
+        pairs = plan(*args, **kwargs)
+        # Пока идёт расчёт: одного заняли, другой перерегистрировался, третий сделал /restart
+        index.mark_busy(1, now + 100)
+        index.add(profile(3, kazakh_level='Продвинутый'))
+        index.remove(5)
+        return pairs
+
+    monkeypatch.setattr(main2, 'pair_by_rating', pair_and_interfere)
+    pairs = index.plan_batch(set(), now + 50)
+    assert pairs == []
+    assert not any(index.is_busy(user_id, now) for user_id in (2, 3, 4, 6))
+    assert index._busy_until[1] == now + 100
+
+
+def test_pair_by_rating_pairs_neighbours_across_sides():
+    side1 = [(3.0, 1), (4.0, 2)]
+    side2 = [(3.1, 3), (4.2, 4), (4.3, 5)]
+    pairs = main2.pair_by_rating(side1, side2, {frozenset((2, 4))})
+    assert sorted(map(sorted, pairs)) == [[1, 3], [2, 5]]
+    assert main2.pair_by_rating([(3.0, 1), (3.0, 2), (3.5, 3)], None, set()) == [(1, 2)]
+
+
+def test_bucket_pair_weight_prefers_same_level_and_age():
+    key = main2.encode_profile(profile(1))
+    other_age = main2.encode_profile(profile(2, age='21-25'))
+    other_level = main2.encode_profile(profile(3, kazakh_level='Продвинутый'))
+    other_both = main2.encode_profile(profile(4, age='21-25', kazakh_level='Продвинутый'))
+    assert main2.bucket_pair_weight(key, key) == 3
+    assert main2.bucket_pair_weight(key, other_age) == main2.bucket_pair_weight(key, other_level) == 2
+    assert main2.bucket_pair_weight(key, other_both) == 1
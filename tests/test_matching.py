@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import main2
+from conftest import register
+
+
+def active_pairs():
+    rows = main2.db.execute("SELECT user1, user2 FROM matches WHERE active_until > ?", (int(time.time()),))
+    return [(row['user1'], row['user2']) for row in rows]
+
+
+@pytest.mark.parametrize('use_index', [True, False], ids=['index', 'sql'])
+def test_concurrent_find_match_never_double_books(db, sent, monkeypatch, use_index):
+    users = list(range(1, 41))
+    for user_id in users:
+        register(user_id)
+    monkeypatch.setattr(main2.match_index, 'ready', use_index)
+
+    barrier = threading.Barrier(len(users))
+
+    def run(user_id):
+        barrier.wait()
+        main2.find_match(user_id)
+
+    threads = [threading.Thread(target=run, args=(user_id,)) for user_id in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    pairs = active_pairs()
+    assert pairs
+    counts = Counter(user1 for user1, _ in pairs)
+    assert max(counts.values()) == 1
+    assert all((user2, user1) in pairs for user1, user2 in pairs)
+    reviews = Counter(row['chat_id1'] for row in db.execute("SELECT chat_id1 FROM review_queue"))
+    assert reviews == counts
+
+
+def test_claim_pair_rejects_busy_partner(db):
+    register(1)
+    register(2)
+    register(3)
+    now = int(time.time())
+    assert db.transaction(lambda conn: main2.claim_pair(conn, 1, 2, now))
+    assert not db.transaction(lambda conn: main2.claim_pair(conn, 3, 2, now))
+    assert not db.transaction(lambda conn: main2.claim_pair(conn, 1, 3, now))
+    assert sorted(active_pairs()) == [(1, 2), (2, 1)]
+
+
+def test_sql_candidates_exclude_self_past_partners_and_busy_users(db):
+    for user_id in range(1, 8):
+        register(user_id)
+    now = int(time.time())
+    db.transaction(lambda conn: main2.claim_pair(conn, 3, 4, now))
+    main2.db.execute("INSERT INTO past_matches (user1, user2, match_ts) VALUES (1, 2, 0)", commit=True)
+    current = main2.db.query('user_by_id', (1,))
+    assert sorted(row['id'] for row in main2.find_candidates_sql(current, 3.0)) == [5, 6, 7]
+
+
+def test_sql_candidates_use_indexes(db):
+    plan = [row['detail'] for row in main2.db.execute(
+        "EXPLAIN QUERY PLAN " + main2.QUERIES['match_candidates'].sql, (1, 0, 'Мужской', 'Не важно', 3.0))]
+    assert any('idx_matches_active' in step for step in plan)
+    assert any('past_matches' in step and 'INDEX' in step for step in plan)
+
+
+def test_expired_pairs_are_archived_with_epoch_time(db):
+    register(1)
+    register(2)
+    now = int(time.time())
+    db.transaction(lambda conn: main2.claim_pair(conn, 1, 2, now))
+    assert main2.expire_matches(now + main2.MATCH_DURATION) == 2
+    assert active_pairs() == []
+    rows = db.execute("SELECT user1, user2, match_ts FROM past_matches ORDER BY user1")
+    assert [tuple(row) for row in rows] == [(1, 2, now), (2, 1, now)]
+    assert db.query('pair_exists', (1, 2)) is not None
+
+
+def test_batch_matching_claims_pairs_and_schedules_reviews(db, sent):
+    for user_id in range(1, 5):
+        register(user_id)
+    main2.db.execute("INSERT INTO past_matches (user1, user2, match_ts) VALUES (1, 2, 0)", commit=True)
+    main2.db.execute("INSERT INTO past_matches (user1, user2, match_ts) VALUES (2, 1, 0)", commit=True)
+    assert main2.run_batch_matching() == 2
+    pairs = active_pairs()
+    assert len(pairs) == 4 and (1, 2) not in pairs
+    assert Counter(row['chat_id1'] for row in db.execute("SELECT chat_id1 FROM review_queue")) == \
+        Counter({1: 1, 2: 1, 3: 1, 4: 1})
+    assert main2.run_batch_matching() == 0
+
+
+def test_batch_matching_releases_only_the_free_user_after_failed_claim(db, sent):
+    register(1)
+    register(2)
+    now = int(time.time())
+    # Пользователя 1 занял find_match, а индекс об этом ещё не знает
+    db.transaction(lambda conn: main2.claim_pair(conn, 1, 99, now))
+    assert main2.run_batch_matching() == 0
+    assert sorted(active_pairs()) == [(1, 99), (99, 1)]
+    assert main2.match_index.is_busy(1, now)
+    assert not main2.match_index.is_busy(2, now)
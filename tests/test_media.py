@@ -0,0 +1,94 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import main2
+from main2 import AssetRegistry, MediaCache
+
+
+def telegram_error(code, description):
+    return ApiTelegramException('sendDocument', None, {'error_code': code, 'description': description})
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """send_document: загрузка потока отвечает новым file_id, отправка по file_id - тем же;
+    errors - исключения на очередные вызовы"""
+    api = SimpleNamespace(uploads=[], resent=[], errors=[])
+    lock = threading.Lock()
+
+    def send_document(chat_id, document, **kwargs):
+        with lock:
+            if isinstance(document, str):
+                api.resent.append(document)
+            else:
+                api.uploads.append(len(document.read()))
+            if api.errors:
+                raise api.errors.pop(0)
+            file_id = document if isinstance(document, str) else f'file-{len(api.uploads)}'
+        return SimpleNamespace(document=SimpleNamespace(file_id=file_id))
+
+    monkeypatch.setattr(main2.bot, 'send_document', send_document)
+    return api
+
+
+@pytest.fixture
+def guidebook(tmp_path):
+    (tmp_path / 'guide.docx').write_bytes(b'x' * 1000)
+    registry = AssetRegistry(str(tmp_path))
+    registry.scan()
+    return registry.get('guide.docx')
+
+
+@pytest.fixture
+def cache(db):
+    return MediaCache(db)
+
+
+def test_first_send_uploads_and_later_sends_reuse_file_id(cache, guidebook, telegram, sent):
+    cache.send(1, guidebook, caption='guide')
+    cache.send(2, guidebook, caption='guide')
+    cache.send(3, guidebook, caption='guide')
+    assert telegram.uploads == [1000]
+    assert telegram.resent == ['file-1', 'file-1']
+    assert main2.db.query('media_get', ('guide.docx',))['file_id'] == 'file-1'
+    assert cache.snapshot() == {'hits': 2, 'uploads': 1, 'invalidated': 0}
+
+
+def test_rejected_file_id_is_uploaded_again(cache, guidebook, telegram, sent):
+    cache.send(1, guidebook)
+    telegram.errors.append(telegram_error(400, 'Bad Request: wrong file identifier/HTTP URL specified'))
+    cache.send(2, guidebook)
+    assert telegram.uploads == [1000, 1000]
+    assert main2.db.query('media_get', ('guide.docx',))['file_id'] == 'file-2'
+    assert cache.snapshot() == {'hits': 0, 'uploads': 2, 'invalidated': 1}
+
+
+def test_other_client_errors_are_raised_without_upload(cache, guidebook, telegram, sent):
+    cache.send(1, guidebook)
+    telegram.errors.append(telegram_error(400, 'Bad Request: chat not found'))
+    with pytest.raises(ApiTelegramException):
+        cache.send(2, guidebook)
+    assert telegram.uploads == [1000]
+    assert main2.db.query('media_get', ('guide.docx',))['file_id'] == 'file-1'
+
+
+def test_changed_file_is_uploaded_again(cache, guidebook, telegram, sent, tmp_path):
+    cache.send(1, guidebook)
+    (tmp_path / 'guide.docx').write_bytes(b'y' * 500)
+    registry = AssetRegistry(str(tmp_path))
+    registry.scan()
+    cache.send(2, registry.get('guide.docx'))
+    assert telegram.uploads == [1000, 500]
+    row = main2.db.query('media_get', ('guide.docx',))
+    assert (row['file_id'], row['fingerprint']) == ('file-2', registry.get('guide.docx').sha256)
+    assert cache.snapshot()['invalidated'] == 1
+
+
+def test_upload_retried_after_server_error_sends_the_whole_file(cache, guidebook, telegram, sent):
+    telegram.errors.append(telegram_error(502, 'Bad Gateway'))
+    cache.send(1, guidebook)
+    assert telegram.uploads == [1000, 1000]
+    assert main2.db.query('media_get', ('guide.docx',))['file_id'] == 'file-2'
@@ -0,0 +1,114 @@
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import main2
+from main2 import Outbox
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """send_message, который записывает (chat_id, текст, время) в log и отвечает ошибками из errors"""
+    log = []
+    errors = {}  # текст -> список исключений на очередные попытки
+    lock = threading.Lock()
+
+    def send_message(chat_id, text, **kwargs):
+        with lock:
+            pending = errors.get(text)
+            if pending:
+                raise pending.pop(0)
+            log.append((chat_id, text, time.monotonic()))
+        return text
+
+    monkeypatch.setattr(main2.bot, 'send_message', send_message)
+    return SimpleNamespace(log=log, errors=errors)
+
+
+def telegram_error(code, **parameters):
+    return ApiTelegramException('sendMessage', None,
+                                {'error_code': code, 'description': 'error', 'parameters': parameters})
+
+
+@pytest.fixture
+def outbox():
+    outbox = Outbox(workers=1, global_rate=1000, chat_rate=1)
+    yield outbox
+    outbox.stop(timeout=5)
+
+
+def test_throttled_chat_does_not_block_other_chats(api, outbox):
+    started = time.monotonic()
+    futures = [outbox.send_message(1, f'a{i}') for i in range(3)] + [outbox.send_message(2, 'b0')]
+    assert [future.result(timeout=5) for future in futures] == ['a0', 'a1', 'a2', 'b0']
+    sent = {text: at - started for _, text, at in api.log}
+    assert sent['b0'] < 0.5
+    assert sent['a1'] >= 0.9 and sent['a2'] >= 1.9
+    assert [text for chat_id, text, _ in api.log if chat_id == 1] == ['a0', 'a1', 'a2']
+    assert outbox.snapshot()['deferred'] >= 2
+
+
+def test_retry_after_defers_only_its_chat(api, outbox):
+    api.errors['a0'] = [telegram_error(429, retry_after=1)]
+    started = time.monotonic()
+    first, second, other = outbox.send_message(1, 'a0'), outbox.send_message(1, 'a1'), outbox.send_message(2, 'b0')
+    assert other.result(timeout=5) == 'b0'
+    assert time.monotonic() - started < 0.5
+    assert first.result(timeout=5) == 'a0' and second.result(timeout=5) == 'a1'
+    assert [text for _, text, _ in api.log] == ['b0', 'a0', 'a1']
+    assert outbox.snapshot()['retried'] == 1
+
+
+def test_client_errors_fail_without_retry(api, outbox):
+    api.errors['bad'] = [telegram_error(400)]
+    failed, next_call = outbox.send_message(1, 'bad'), outbox.send_message(1, 'ok')
+    with pytest.raises(ApiTelegramException):
+        failed.result(timeout=5)
+    assert next_call.result(timeout=5) == 'ok'
+    stats = outbox.snapshot()
+    assert stats['failed'] == 1 and stats['retried'] == 0
+
+
+def test_server_errors_are_retried_until_the_limit(api):
+    outbox = Outbox(workers=1, global_rate=1000, chat_rate=1000, max_retries=1)
+    api.errors['flaky'] = [telegram_error(502)]
+    api.errors['down'] = [telegram_error(502), telegram_error(502)]
+    try:
+        assert outbox.send_message(1, 'flaky').result(timeout=5) == 'flaky'
+        with pytest.raises(ApiTelegramException):
+            outbox.send_message(2, 'down').result(timeout=5)
+    finally:
+        outbox.stop(timeout=5)
+
+
+def test_stop_delivers_deferred_calls(api):
+    outbox = Outbox(workers=1, global_rate=1000, chat_rate=2)
+    futures = [outbox.send_message(1, f'a{i}') for i in range(3)]
+    outbox.stop(timeout=5)
+    assert all(future.done() for future in futures)
+    assert [text for _, text, _ in api.log] == ['a0', 'a1', 'a2']
+
+
+def test_upload_is_rewound_before_retry(monkeypatch):
+    uploaded = []
+    attempts = iter([telegram_error(502)])
+
+    def send_document(chat_id, document, **kwargs):
+        uploaded.append(len(document.read()))
+        error = next(attempts, None)
+        if error:
+            raise error
+        return 'ok'
+
+    monkeypatch.setattr(main2.bot, 'send_document', send_document)
+    outbox = Outbox(workers=1, global_rate=1000, chat_rate=1000)
+    stream = io.BytesIO(b'x' * 1000)
+    try:
+        assert outbox.call(1, 'send_document', 1, stream).result(timeout=5) == 'ok'
+    finally:
+        outbox.stop(timeout=5)
+    assert uploaded == [1000, 1000]
@@ -0,0 +1,157 @@
+import difflib
+import sqlite3
+import threading
+
+import pytest
+
+import chck2
+from chck2 import SEED_ALIASES, ProfileIndex, Vocabulary
+
+# id, страна, родной язык, уровень, другие языки, причина, темы
+PROFILES = [
+    (1, 'Казахстан', 'Русский', 'Средний', 'Английский, Немецкий', 'Для работы', 'Спорт,Музыка,История'),
+    (2, 'казахстан ', 'русский', 'Средний', 'английский', 'Для работы', 'Спорт,Музыка,Политика'),
+    (3, 'Казахстан', 'Казахский', 'Носитель', 'Русский', 'Для учебы', 'Спорт'),
+    (4, 'Россия', 'Русский', 'Начинающий', 'Немецкий', 'Другое', 'Еда и кулинария,Фильмы и сериалы,Бизнес и экономика'),
+    (5, 'Германия', 'Немецкий', 'Начинающий', 'Английский', 'Для переезда', 'История,Политика,Образование,Спорт'),
+    (6, 'Узбекистан', 'Узбекский', 'Средний', 'Русский, Английский', 'Для общения', 'Музыка'),
+    (7, 'Казахстан', 'Русский', 'Продвинутый', 'Английский', 'Для учебы', 'Спорт,Музыка,История,Образование'),
+    (8, 'Кыргызстан', 'Кыргызский', 'Средний', 'Русский', 'Просто интересно', 'Повседневная жизнь,Другое,Музыка'),
+    (9, 'Россия', 'Русский', 'Средний', 'Английский, Французский', 'Для работы', 'Спорт,Музыка,История,Политика,Путешествия'),
+    (10, 'Казахстан', 'Русский', 'Средний', 'Английский', 'Для учебы', 'Путешествия,Спорт'),
+]
+
+
+def fuzzy_match(str1, str2, threshold=0.7):
+    return difflib.SequenceMatcher(None, str1.lower(), str2.lower()).ratio() >= threshold
+
+
+def has_common_language(lang1, lang2):
+    set1 = set(map(str.strip, lang1.lower().split(',')))
+    set2 = set(map(str.strip, lang2.lower().split(',')))
+    return not set1.isdisjoint(set2)
+
+
+def old_score(me, user):
+    """Счёт и порог из прежнего find_match (темы сравниваются без учёта регистра с обеих сторон)"""
+    _, country, native, level, languages, reason, topics = me
+    score = fuzzy_match(country, user[1]) + fuzzy_match(native, user[2]) + fuzzy_match(level, user[3])
+    score += has_common_language(languages, user[4])
+    required = 3
+    if reason == 'Другое' or user[5] == 'Другое':
+        required -= 1
+    else:
+        score += fuzzy_match(reason, user[5])
+    user_topics = set(map(str.strip, user[6].lower().split(',')))
+    current_topics = set(map(str.strip, topics.lower().split(',')))
+    shared = user_topics & current_topics
+    if len(current_topics) <= 2 or len(user_topics) <= 2:
+        score += bool(shared)
+    else:
+        score += len(shared) / max(len(current_topics), len(user_topics)) >= 0.5
+    return score, required
+
+
+@pytest.fixture
+def index():
+    index = ProfileIndex()
+    for row in PROFILES:
+        index.add(*row)
+    return index
+
+
+def test_top_matches_agree_with_the_old_rules(index):
+    for me in PROFILES:
+        expected = {}
+        for user in PROFILES:
+            if user[0] != me[0]:
+                score, required = old_score(me, user)
+                if score >= required:
+                    expected[user[0]] = score
+        found = index.top_matches(me[0], k=len(PROFILES))
+        assert {uid: score for score, uid in found} == expected
+        if expected:
+            assert index.top_matches(me[0])[0][0] == max(expected.values())
+
+
+def test_re_registration_updates_the_row_in_place(index):
+    index.add(3, 'Казахстан', 'Русский', 'Средний', 'Английский', 'Для работы', 'Спорт,Музыка,История')
+    assert len(index.ids) == len(PROFILES)
+    assert (6, 3) in index.top_matches(1, k=len(PROFILES))
+
+
+def test_concurrent_adds_keep_columns_aligned():
+    index = ProfileIndex()
+
+    def register(first):
+        for user_id in range(first, first + 200):
+            row = PROFILES[user_id % len(PROFILES)]
+            index.add(user_id, *row[1:])
+            index.top_matches(user_id)
+
+    threads = [threading.Thread(target=register, args=(i * 1000,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    columns = (index.ids, index.country, index.native, index.level, index.langs, index.reason,
+               index.topics, index.topic_count)
+    assert {len(column) for column in columns} == {1600}
+    assert all(index.ids[pos] == user_id for user_id, pos in index.positions.items())
+
+
+def test_misspellings_are_learned_as_aliases():
+    vocab = Vocabulary('country', fuzzy=True)
+    code = vocab.code('Казахстан')
+    assert vocab.code('Казахстанн') == code
+    assert vocab.code('KZ') == code  # из SEED_ALIASES
+    assert vocab.code('Германия') != code
+    assert vocab.learned == [('казахстанн', 'казахстан')]
+    assert vocab.values == ['казахстан', 'германия']
+    # 'казахстанн' теперь находится по алиасу, без difflib
+    vocab.code('казахстанн')
+    assert vocab.stats() == {'values': 2, 'aliases': len(SEED_ALIASES['country']) + 1,
+                             'hits': 2, 'misses': 3, 'hit_rate': 0.4}
+
+
+def test_exact_vocabularies_do_not_learn():
+    vocab = Vocabulary('topics')
+    assert vocab.code('спорт') != vocab.code('спорта')
+    assert vocab.learned == []
+
+
+def test_aliases_survive_save_and_load():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, country TEXT, native_language TEXT, kazakh_level TEXT, '
+                 'other_languages TEXT, learning_reason TEXT, topics TEXT)')
+    conn.execute('CREATE TABLE aliases (field TEXT, alias TEXT, canonical TEXT, PRIMARY KEY (field, alias))')
+    index = ProfileIndex()
+    for row in PROFILES[:2]:
+        index.add(*row)
+    index.add(11, 'Казахстанн', 'Руский', 'Средний', 'Английский', 'Для работы', 'Спорт')
+    index.save_aliases(conn)
+    assert sorted(conn.execute('SELECT field, alias, canonical FROM aliases')) == [
+        ('country', 'казахстанн', 'казахстан'), ('native_language', 'руский', 'русский')]
+    index.save_aliases(conn)  # выученное сохраняется один раз
+    assert conn.execute('SELECT COUNT(*) FROM aliases').fetchone()[0] == 2
+
+    conn.execute("INSERT INTO users VALUES (11, 'Казахстанн', 'Руский', 'Средний', 'Английский', 'Для работы', 'Спорт')")
+    restored = ProfileIndex()
+    restored.load(conn)
+    assert restored.countries.aliases['казахстанн'] == 'казахстан'
+    assert restored.countries.values == ['казахстан']
+    assert restored.native_languages.values == ['русский']
+
+
+def test_cache_stats_counts_similarity_hits(monkeypatch):
+    monkeypatch.setattr(chck2, 'profiles', ProfileIndex())
+    chck2._similarity.cache_clear()
+    chck2.similarity('Спорт', 'спорта')
+    chck2.similarity('спорта', 'СПОРТ')
+    chck2.similarity('Спорт', 'Музыка')
+    chck2.profiles.countries.code('Казахстан')
+    chck2.profiles.countries.code('казахстан')
+    stats = chck2.cache_stats()
+    assert stats['similarity'] == {'size': 2, 'hits': 1, 'misses': 2, 'hit_rate': 1 / 3}
+    assert stats['country']['hits'] == 1 and stats['country']['misses'] == 1
+    assert set(stats) == {'similarity', *chck2.profiles.vocabularies}
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+import main2
+from conftest import register
+from main2 import ReviewScheduler
+
+
+def queue_review(user_id, partner_id, send_ts):
+    main2.db.query('insert_review', (user_id, partner_id, send_ts))
+
+
+def pending_rows():
+    return sorted(tuple(row) for row in main2.db.execute("SELECT chat_id1, chat_id2, send_ts FROM review_queue"))
+
+
+def review_requests(sent):
+    return [args[0] for method, args, _ in sent if method == 'send_message' and 'отзыв' in args[1]]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def users(db):
+    for user_id in range(1, 7):
+        register(user_id)
+
+
+def test_earlier_schedule_wakes_the_scheduler(users, sent):
+    scheduler = ReviewScheduler()
+    now = int(time.time())
+    queue_review(1, 2, now + 3600)
+    scheduler.load(main2.db)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    time.sleep(0.1)  # поток уже спит до срока через час
+    queue_review(3, 4, now)
+    scheduler.schedule(3, 4, now)
+    wait_for(lambda: scheduler.snapshot()['dispatched'] == 1)
+    wait_for(lambda: review_requests(sent) == [3])
+    assert pending_rows() == [(1, 2, now + 3600)]
+    assert main2.user_state.get(3) == {'step': 'awaiting_feedback', 'partner_id': 4}
+
+
+def test_due_reviews_are_claimed_in_batches(users, sent):
+    scheduler = ReviewScheduler(batch_size=3)
+    now = int(time.time())
+    for user_id in range(1, 6):
+        queue_review(user_id, 6, now - 10)
+    scheduler.load(main2.db)
+    first = scheduler._wait_for_due()
+    assert len(first) == 3
+    scheduler._dispatch(first)
+    second = scheduler._wait_for_due()
+    assert len(second) == 2
+    scheduler._dispatch(second)
+    assert pending_rows() == []
+    stats = scheduler.snapshot()
+    assert stats['dispatched'] == 5 and stats['batches'] == 2 and stats['pending'] == 0
+    wait_for(lambda: sorted(review_requests(sent)) == [1, 2, 3, 4, 5])
+
+
+def test_stale_heap_entry_does_not_send_a_rescheduled_review(users, sent):
+    scheduler = ReviewScheduler()
+    now = int(time.time())
+    queue_review(1, 2, now - 10)
+    scheduler.schedule(1, 2, now - 10)
+    # INSERT OR REPLACE перенёс отзыв на потом, а старая запись осталась в куче
+    queue_review(1, 2, now + 3600)
+    scheduler.schedule(1, 2, now + 3600)
+    scheduler._dispatch(scheduler._wait_for_due())
+    assert scheduler.snapshot()['dispatched'] == 0
+    assert pending_rows() == [(1, 2, now + 3600)]
+
+
+def test_failed_batch_is_requeued(users, monkeypatch):
+    scheduler = ReviewScheduler(retry_delay=3600)
+    now = int(time.time())
+    for user_id in (1, 2):
+        queue_review(user_id, 6, now - 10)
+    scheduler.load(main2.db)
+
+    def fail(due):
+        raise RuntimeError('база недоступна')
+
+    monkeypatch.setattr(scheduler, '_dispatch', fail)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    wait_for(lambda: scheduler.snapshot()['failed_batches'] == 1)
+    stats = scheduler.snapshot()
+    assert stats['pending'] == 2
+    assert stats['next_due'] >= now + 3600
+    assert len(pending_rows()) == 2
+
+
+def test_load_keeps_reviews_scheduled_before_it(users):
+    scheduler = ReviewScheduler()
+    now = int(time.time())
+    queue_review(1, 2, now + 100)
+    queue_review(3, 4, now + 200)
+    scheduler.schedule(3, 4, now + 200)
+    scheduler.schedule(5, 6, now + 50)  # ещё не записан в review_queue
+    scheduler.load(main2.db)
+    assert sorted(scheduler._heap) == [(now + 50, 5, 6), (now + 100, 1, 2), (now + 200, 3, 4)]
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main2
+
+
+def message(text, chat_id=42):
+    return SimpleNamespace(text=text, chat=SimpleNamespace(id=chat_id),
+                           from_user=SimpleNamespace(id=chat_id, username='aidana'))
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Подменяет обработчики в таблицах маршрутизации на запись (имя, текст)"""
+    calls = []
+
+    def recorder(name):
+        return lambda message, *args: calls.append((name, message.text))
+
+    for table in (main2.COMMANDS, main2.STEP_HANDLERS):
+        for name in list(table):
+            monkeypatch.setitem(table, name, recorder(name))
+    monkeypatch.setattr(main2, 'handle_all_messages', recorder('other'))
+    return calls
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('/start', 'start'),
+    ('/start@QazaqTalkBot', 'start'),
+    ('/guidebook please', 'guidebook'),
+])
+def test_commands_are_dispatched(handled, text, expected):
+    main2.route_message(message(text))
+    assert handled == [(expected, text)]
+
+
+@pytest.mark.parametrize('text', ['/', '/ ', '/\n', '/unknown'])
+def test_empty_or_unknown_commands_are_ignored(handled, text):
+    main2.route_message(message(text))
+    assert handled == []
+
+
+def test_text_goes_to_current_step(db, handled):
+    main2.user_data.set(42, {'step': 'name'})
+    try:
+        main2.route_message(message('Айдана'))
+    finally:
+        main2.user_data.delete(42)
+    main2.route_message(message('привет'))
+    assert handled == [('name', 'Айдана'), ('other', 'привет')]
+
+
+def test_callbacks_are_dispatched_by_prefix(monkeypatch):
+    calls = []
+    monkeypatch.setitem(main2.CALLBACK_HANDLERS, 'age', lambda call, step, value: calls.append((step, value)))
+    main2.route_callback(SimpleNamespace(data='age:17-20'))
+    main2.route_callback(SimpleNamespace(data='unknown:1'))
+    assert calls == [('age', '17-20')]
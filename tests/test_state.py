@@ -0,0 +1,68 @@
+import tracemalloc
+
+import main2
+from main2 import MemoryStateStore, SqliteStateStore
+
+
+def test_lru_evicts_least_recently_used():
+    store = MemoryStateStore('registration', ttl=3600, max_sessions=3)
+    for chat_id in (1, 2, 3):
+        store.set(chat_id, {'step': 'name'})
+    assert store.get(1) == {'step': 'name'}  # 1 становится самым свежим
+    store.set(4, {'step': 'age'})
+    assert store.get(2) is None
+    assert store.get(1) is not None and store.get(3) is not None and store.get(4) is not None
+    stats = store.stats()
+    assert stats['evicted'] == 1
+    assert stats['sessions'] == 3
+    assert stats['misses'] == 1
+
+
+def test_expired_sessions_are_dropped_and_counted():
+    store = MemoryStateStore('review', ttl=-1)  # всё сразу устаревшее
+    store.set(1, {'step': 'feedback'})
+    store.set(2, {'step': 'feedback'})
+    assert store.get(1) is None
+    assert store.expire() == 1
+    stats = store.stats()
+    assert stats['expired'] == 2
+    assert stats['sessions'] == 0
+
+
+def test_get_returns_a_copy():
+    store = MemoryStateStore('registration', ttl=3600)
+    store.set(1, {'step': 'name'})
+    store.get(1)['step'] = 'age'
+    assert store.get(1) == {'step': 'name'}
+
+
+def test_memory_stays_flat_under_many_sessions():
+    store = MemoryStateStore('registration', ttl=3600, max_sessions=1000)
+    tracemalloc.start()
+    try:
+        for chat_id in range(20000):
+            store.set(chat_id, {'step': 'name', 'name': f'user{chat_id}'})
+        warm, _ = tracemalloc.get_traced_memory()
+        for chat_id in range(20000, 200000):
+            store.set(chat_id, {'step': 'name', 'name': f'user{chat_id}'})
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert store.stats()['sessions'] == 1000
+    assert store.stats()['evicted'] == 199000
+    assert current < warm * 1.1
+
+
+def test_sqlite_store_round_trip_without_cache(db):
+    store = SqliteStateStore(main2.db, 'registration', ttl=3600, cache=False)
+    store.set(1, {'step': 'age', 'name': 'Айгерим'})
+    assert store.get(1) == {'step': 'age', 'name': 'Айгерим'}
+    store.delete(1)
+    assert store.get(1) is None
+
+
+def test_sqlite_store_expires_rows(db):
+    store = SqliteStateStore(main2.db, 'review', ttl=-1, cache=False)
+    store.set(1, {'step': 'feedback'})
+    assert store.get(1) is None
+    assert store.expire() == 1
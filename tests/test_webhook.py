@@ -0,0 +1,83 @@
+import json
+
+import pytest
+from telebot import types
+
+import main2
+
+MESSAGE = {
+    'update_id': 10,
+    'message': {
+        'message_id': 5, 'date': 1700000000, 'text': '/start',
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Айдана', 'username': 'aidana'},
+        'reply_to_message': {'message_id': 4, 'date': 1700000000, 'text': 'old',
+                             'chat': {'id': 42, 'type': 'private'}},
+    },
+}
+
+CALLBACK = {
+    'update_id': 11,
+    'callback_query': {
+        'id': 'q1', 'chat_instance': 'c', 'data': 'age:17-20',
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Айдана'},
+        'message': {'message_id': 6, 'date': 1700000000, 'text': 'Сколько вам лет?',
+                    'chat': {'id': 42, 'type': 'private'}},
+    },
+}
+
+
+def body(update):
+    return json.dumps(update, ensure_ascii=False).encode('utf-8')
+
+
+def test_message_matches_full_parse_without_reply():
+    update = main2.parse_update(body(MESSAGE))
+    full = types.Update.de_json(json.dumps(MESSAGE))
+    assert update.update_id == full.update_id
+    assert update.message.text == full.message.text
+    assert update.message.chat.id == full.message.chat.id
+    assert update.message.from_user.username == full.message.from_user.username
+    assert update.message.reply_to_message is None
+
+
+def test_callback_query_is_parsed():
+    update = main2.parse_update(body(CALLBACK))
+    assert update.callback_query.data == 'age:17-20'
+    assert update.callback_query.message.chat.id == 42
+    assert update.message is None
+
+
+def test_unsubscribed_update_is_skipped():
+    assert main2.parse_update(body({'update_id': 12, 'edited_message': MESSAGE['message']})) is None
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    updates = []
+    monkeypatch.setattr(main2.update_queue, 'submit', lambda update, timeout=None: updates.append(update) or True)
+    return updates
+
+
+def test_webhook_queues_updates(queued):
+    client = main2.app.test_client()
+    url = '/' + main2.BOT_TOKEN
+    assert client.post(url, data=body(MESSAGE), content_type='application/json').status_code == 200
+    assert client.post(url, data=body({'update_id': 12, 'poll': {}}), content_type='application/json').status_code == 200
+    assert [update.update_id for update in queued] == [10]
+
+
+def test_webhook_rejects_bad_requests(queued):
+    client = main2.app.test_client()
+    url = '/' + main2.BOT_TOKEN
+    assert client.post(url, data=body(MESSAGE), content_type='text/plain').status_code == 400
+    assert client.post(url, data=b'{not json', content_type='application/json').status_code == 500
+    assert queued == []
+
+
+def test_webhook_answers_503_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(main2.update_queue, 'submit', lambda update, timeout=None: False)
+    response = main2.app.test_client().post('/' + main2.BOT_TOKEN, data=body(MESSAGE),
+                                            content_type='application/json')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'